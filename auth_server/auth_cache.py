@@ -0,0 +1,70 @@
+# auth_server/auth_cache.py
+# Локальный (в памяти процесса) LRU-кэш с ограничением времени жизни записей.
+# Используется как кэш первого уровня перед Redis для результатов проверки учетных данных:
+# повторные входы "горячих" пользователей (например, переподключение игровых клиентов)
+# обслуживаются поиском в словаре, без сетевого обращения.
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    LRU-кэш фиксированного размера с TTL для каждой записи.
+
+    Не потокобезопасен: предназначен для использования из одного цикла событий asyncio.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0, timer=time.monotonic):
+        """
+        Args:
+            maxsize (int): Максимальное количество записей; при переполнении вытесняется
+                           давно не использовавшаяся запись.
+            ttl (float): Время жизни записи по умолчанию, секунд.
+            timer (Callable[[], float]): Источник времени (для тестов).
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._data = OrderedDict() # key -> (expires_at, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        Возвращает значение по ключу или default, если записи нет или она устарела.
+        Найденная запись становится самой "свежей" для LRU.
+        """
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at <= self._timer():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Сохраняет значение.
+
+        Args:
+            key (Hashable): Ключ.
+            value (Any): Значение.
+            ttl (float, optional): Время жизни записи, секунд. По умолчанию self.ttl.
+        """
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (self._timer() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Удаляет запись и возвращает ее значение (без учета TTL) или default."""
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
@@ -1,7 +1,13 @@
 import asyncio
+import functools
 import grpc
-from concurrent import futures
 import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import secrets
+import signal
+import sys
 
 # Предполагается, что .proto файлы находятся в ./protos, а сгенерированные файлы - в ./grpc_generated относительно пути выполнения этого скрипта
 # При необходимости скорректируйте sys.path или структурируйте как правильный пакет
@@ -16,58 +22,221 @@ import logging
 # Используйте полные импорты, предполагая, что 'auth_server' - это пакет верхнего уровня, видимый в PYTHONPATH
 from auth_server.grpc_generated import auth_service_pb2
 from auth_server.grpc_generated import auth_service_pb2_grpc
-from auth_server.user_service import UserService
-from passlib.hash import pbkdf2_sha256 # Импорт перемещен на верхний уровень
+from google.protobuf.internal import api_implementation as _protobuf_api
+from auth_server.user_service import UserService, get_user_service, MAX_USERNAME_LENGTH, MAX_PASSWORD_LENGTH
+from auth_server import event_loop
+from auth_server.kdf import hash_password, shutdown_kdf_pool # PBKDF2-SHA256 в пуле процессов, формат passlib
+from auth_server.logging_config import configure_logging
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Логирование настраивается в точке входа (configure_logging). Сообщения о каждом вызове RPC
+# пишутся на уровне DEBUG с ленивым форматированием "%s", чтобы не тратить время на форматирование строк.
+logger = logging.getLogger(__name__)
+
+# Токены сессий: после успешного входа выдается случайный токен, в Redis хранится
+# "sess:<token>" -> username. ValidateToken проверяет токен одним GET вместо повторного PBKDF2.
+SESSION_KEY_PREFIX = "sess:"
+SESSION_TTL = int(os.getenv("AUTH_SESSION_TTL", "1800")) # секунд
+
+# Параметры gRPC-сервера (channel args).
+GRPC_MAX_CONCURRENT_STREAMS = int(os.getenv("AUTH_GRPC_MAX_CONCURRENT_STREAMS", "1000")) # Потоков HTTP/2 на одно соединение
+GRPC_KEEPALIVE_TIME_MS = int(os.getenv("AUTH_GRPC_KEEPALIVE_TIME_MS", "30000")) # Интервал keepalive ping
+# Максимум одновременно обрабатываемых RPC в процессе; сверх лимита сервер сразу отвечает
+# RESOURCE_EXHAUSTED, а не копит очередь корутин. 0 - без ограничения.
+GRPC_MAX_CONCURRENT_RPCS = int(os.getenv("AUTH_GRPC_MAX_CONCURRENT_RPCS", "0"))
+
+def _server_options():
+    """Возвращает список опций для grpc.aio.server."""
+    return [
+        ('grpc.max_concurrent_streams', GRPC_MAX_CONCURRENT_STREAMS),
+        ('grpc.so_reuseport', 1),
+        ('grpc.keepalive_time_ms', GRPC_KEEPALIVE_TIME_MS),
+        ('grpc.keepalive_timeout_ms', 10000),
+        ('grpc.http2.max_pings_without_data', 0),
+    ]
+
+# Очередь регистраций: хеширование пароля и запись пользователя выполняют несколько задач-обработчиков,
+# а RegisterUser только ставит заявку в ограниченную очередь и ждет результат. При переполнении очереди
+# или превышении времени ожидания клиент сразу получает RESOURCE_EXHAUSTED и может повторить запрос позже.
+REGISTER_QUEUE_SIZE = int(os.getenv("AUTH_REGISTER_QUEUE_SIZE", "1000"))
+REGISTER_WORKERS = int(os.getenv("AUTH_REGISTER_WORKERS", "4"))
+REGISTER_TIMEOUT = float(os.getenv("AUTH_REGISTER_TIMEOUT", "2.0")) # секунд
+
+# Дешевые проверки входных данных до обращения к кэшам и KDF: пустые или заведомо слишком
+# длинные значения (MAX_USERNAME_LENGTH, MAX_PASSWORD_LENGTH из user_service) отклоняются сразу.
+def _credentials_valid(username, password):
+    """Возвращает True, если имя и пароль непустые и не длиннее пределов user_service."""
+    return (bool(username) and bool(password)
+            and len(username) <= MAX_USERNAME_LENGTH and len(password) <= MAX_PASSWORD_LENGTH)
+
+# Неизменяемые ответы, создаваемые один раз. Сервисер не изменяет возвращаемые сообщения,
+# поэтому один и тот же объект можно отдавать в каждом RPC, не создавая новый.
+_REGISTRATION_OK = auth_service_pb2.AuthResponse(authenticated=False, message="Регистрация прошла успешно. Пожалуйста, войдите в систему.", token="")
+_INVALID_TOKEN = auth_service_pb2.TokenResponse(valid=False, username="")
+
+@functools.lru_cache(maxsize=64)
+def _auth_failure_response(message):
+    """Ответ на неудачную аутентификацию; сообщений немного, поэтому ответы кэшируются по тексту."""
+    return auth_service_pb2.AuthResponse(authenticated=False, message=message, token="")
+
+@functools.lru_cache(maxsize=64)
+def _registration_failure_response(message):
+    """Ответ на неудачную регистрацию, кэшируется по тексту сообщения от UserService."""
+    return auth_service_pb2.AuthResponse(authenticated=False, message=f"Ошибка регистрации: {message}", token="")
+
+_INVALID_CREDENTIALS = _auth_failure_response("Неверное имя пользователя или пароль.")
+# Ответы после context.abort() - на случай контекста, abort() которого не выбрасывает исключение
+_REGISTRATION_INVALID = _registration_failure_response("недопустимое имя пользователя или пароль")
+_REGISTRATION_BUSY = _registration_failure_response("сервер перегружен")
+_SESSION_UNAVAILABLE = _auth_failure_response("Хранилище сессий недоступно.")
 
 class AuthServiceServicer(auth_service_pb2_grpc.AuthServiceServicer):
-    def __init__(self, user_svc_instance):
+    def __init__(self, user_svc_instance, redis_client=None):
+        # Результаты входа кэширует сам UserService (в памяти процесса и, если задан shared_cache, в Redis)
         self.user_service = user_svc_instance
-        logging.info("AuthServiceServicer initialized.")
+        # Клиент Redis для токенов сессий. None - токеном служит имя пользователя.
+        self.redis_client = redis_client
+        # Очередь и обработчики регистраций создаются при первом RegisterUser (нужен работающий цикл событий).
+        self._register_queue = None
+        self._register_workers = []
+        logger.info("AuthServiceServicer initialized.")
+
+    def _ensure_register_workers(self):
+        """Создает очередь регистраций и задачи-обработчики, если они еще не запущены."""
+        if self._register_queue is None:
+            self._register_queue = asyncio.Queue(maxsize=REGISTER_QUEUE_SIZE)
+            self._register_workers = [
+                asyncio.create_task(self._register_worker(), name=f"auth-register-worker-{i}")
+                for i in range(max(1, REGISTER_WORKERS))
+            ]
+        return self._register_queue
+
+    async def _register_worker(self):
+        """Обрабатывает заявки на регистрацию: хеширует пароль в пуле KDF и создает пользователя."""
+        queue = self._register_queue
+        while True:
+            username, password, fut = await queue.get()
+            try:
+                if fut.done(): # Клиент уже получил отказ по таймауту - регистрацию не выполняем
+                    continue
+                password_hash = await hash_password(password)
+                if fut.done():
+                    continue
+                result = await self.user_service.create_user(username, password_hash)
+                if not fut.done():
+                    fut.set_result(result)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            finally:
+                queue.task_done()
+
+    async def close(self):
+        """Останавливает задачи-обработчики регистраций."""
+        for task in self._register_workers:
+            task.cancel()
+        await asyncio.gather(*self._register_workers, return_exceptions=True)
+        self._register_workers = []
+        self._register_queue = None
+
+    async def _issue_session_token(self, username):
+        """
+        Выдает токен сессии для пользователя.
+
+        Без Redis (redis_client=None) токены негде хранить, поэтому, как и раньше,
+        токеном служит имя пользователя. Если записать сессию в Redis не удалось,
+        возвращается None: токен, который не пройдет ValidateToken, выдавать нельзя.
+        """
+        if self.redis_client is None:
+            return username
+        token = secrets.token_urlsafe(32)
+        try:
+            await self.redis_client.set(f"{SESSION_KEY_PREFIX}{token}", username, ex=SESSION_TTL)
+        except Exception as e:
+            logger.error("Failed to store session token for user %s: %s", username, e)
+            return None
+        return token
 
     async def AuthenticateUser(self, request, context):
-        logging.info(f"AuthenticateUser called for username: {request.username}")
-        authenticated, message = await self.user_service.authenticate_user(request.username, request.password)
-        token = ""
-        if authenticated:
-            token = request.username # Пока используем имя пользователя в качестве токена
-            logging.info(f"User {request.username} authenticated successfully. Token: {token}")
-        else:
-            logging.warning(f"Authentication failed for user {request.username}: {message}")
+        logger.debug("AuthenticateUser called for username: %s", request.username)
+        username, password = request.username, request.password
+        if not _credentials_valid(username, password):
+            return _INVALID_CREDENTIALS
+        authenticated, message = await self.user_service.authenticate_user(username, password)
+
+        if not authenticated:
+            logger.warning("Authentication failed for user %s: %s", request.username, message)
+            return _auth_failure_response(message)
 
+        token = await self._issue_session_token(request.username)
+        if token is None:
+            # Вход без сохраненной сессии считается неудачным: клиент получает UNAVAILABLE и повторяет вход
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "Хранилище сессий недоступно.")
+            return _SESSION_UNAVAILABLE
+        logger.info("User %s authenticated successfully.", request.username)
         return auth_service_pb2.AuthResponse(
-            authenticated=authenticated,
+            authenticated=True,
             message=message,
             token=token
         )
 
+    async def ValidateToken(self, request, context):
+        """Проверяет токен сессии, выданный AuthenticateUser (один GET в Redis)."""
+        if self.redis_client is None or not request.token:
+            return _INVALID_TOKEN
+        try:
+            username = await self.redis_client.get(f"{SESSION_KEY_PREFIX}{request.token}")
+        except Exception as e:
+            logger.error("Session token lookup failed: %s", e)
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "Хранилище сессий недоступно.")
+            return _INVALID_TOKEN # Если abort() не выбросил исключение, username не определен
+        if username is None:
+            return _INVALID_TOKEN
+        return auth_service_pb2.TokenResponse(valid=True, username=username)
+
     async def RegisterUser(self, request, context):
-        logging.info(f"RegisterUser called for username: {request.username}")
-        # Пока регистрация не полностью реализована с user_service,
-        # поэтому мы возвращаем имитацию успеха или "не реализовано".
-        # Попробуем использовать user_service.create_user, если это соответствует требуемому потоку.
-        # user_service.create_user является асинхронным и принимает (username, password_hash)
-        # Здесь нам нужно было бы хешировать пароль. Для простоты, представим, что это не реализовано.
-
-        # Если бы вы хотели это реализовать:
-        # from passlib.hash import pbkdf2_sha256 # Удалено отсюда, перемещено наверх
-        password_hash = pbkdf2_sha256.hash(request.password) # pbkdf2_sha256 теперь из глобальных переменных модуля
-        success, message = await self.user_service.create_user(request.username, password_hash)
+        logger.debug("RegisterUser called for username: %s", request.username)
+        if not _credentials_valid(request.username, request.password):
+            # Пустые и слишком длинные значения не ставятся в очередь и не хешируются
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Недопустимое имя пользователя или пароль для регистрации.")
+            return _REGISTRATION_INVALID
+        # Хеширование (в пуле процессов) и создание пользователя выполняют обработчики очереди.
+        queue = self._ensure_register_workers()
+        fut = asyncio.get_running_loop().create_future()
+        try:
+            queue.put_nowait((request.username, request.password, fut))
+        except asyncio.QueueFull:
+            logger.warning("Registration queue is full, rejecting registration of %s.", request.username)
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Сервер перегружен, повторите регистрацию позже.")
+            return _REGISTRATION_BUSY
+        try:
+            success, message = await asyncio.wait_for(fut, timeout=REGISTER_TIMEOUT) # при таймауте fut отменяется
+        except asyncio.TimeoutError:
+            logger.warning("Registration of %s timed out in queue.", request.username)
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Сервер перегружен, повторите регистрацию позже.")
+            return _REGISTRATION_BUSY
         if success:
-            logging.info(f"User {request.username} registered successfully.")
-            return auth_service_pb2.AuthResponse(authenticated=False, message="Регистрация прошла успешно. Пожалуйста, войдите в систему.", token="")
+            # Кэшированное "пользователь не найден" сбрасывает create_user (UserService.invalidate)
+            logger.info("User %s registered successfully.", request.username)
+            return _REGISTRATION_OK
         else:
-            logging.warning(f"Registration failed for user {request.username}: {message}")
-            return auth_service_pb2.AuthResponse(authenticated=False, message=f"Ошибка регистрации: {message}", token="")
+            logger.warning("Registration failed for user %s: %s", request.username, message)
+            return _registration_failure_response(message)
+
+def _check_protobuf_backend():
+    """
+    Логирует реализацию protobuf, используемую для (де)сериализации сообщений.
 
-        # message = "Регистрация на этом сервере пока не реализована."
-        # logging.info(message)
-        # return auth_service_pb2.AuthResponse(
-        #     authenticated=False,
-        #     message=message,
-        #     token=""
-        # )
+    protobuf>=4.21 по умолчанию использует upb (C). Чистая Python-реализация в десятки раз
+    медленнее; она включается переменной PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=python
+    или при отсутствии бинарного колеса для платформы - об этом стоит предупредить.
+    """
+    backend = _protobuf_api.Type()
+    if backend == "python":
+        logger.warning("Protobuf is using the pure-Python implementation; message (de)serialization will be slow. "
+                       "Unset PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION or install a protobuf wheel with upb.")
+    else:
+        logger.info("Protobuf implementation: %s", backend)
+    return backend
 
 async def serve():
     # Инициализация клиента Redis (и, возможно, других сервисов, от которых зависит user_service)
@@ -77,27 +246,137 @@ async def serve():
 
     # Проверьте, является ли initialize_redis_client асинхронным или синхронным в user_service.py
     # Он синхронный.
-    UserService.initialize_redis_client() # Вызов метода класса для настройки Redis
+    _check_protobuf_backend()
 
-    user_svc_instance = UserService() # Создание экземпляра UserService
+    # Один пул соединений redis.asyncio на процесс: общий уровень кэша результатов входа в UserService
+    # и токены сессий в servicer.
+    redis_client = UserService.initialize_redis_client()
 
-    server = grpc.aio.server(futures.ThreadPoolExecutor(max_workers=10))
-    auth_service_pb2_grpc.add_AuthServiceServicer_to_server(
-        AuthServiceServicer(user_svc_instance), server
+    user_svc_instance = get_user_service() # Общий экземпляр UserService процесса
+    user_svc_instance.shared_cache = redis_client
+
+    # Все обработчики асинхронные, поэтому migration_thread_pool (ThreadPoolExecutor) не нужен:
+    # он используется только для синхронных обработчиков. Если такие появятся, передайте пул нужного размера.
+    # В gRPC Python ввод-вывод выполняется потоками C-ядра (completion queue), а обработчики -
+    # в цикле событий, поэтому отдельных настроек "boss"/"worker" потоков нет. Нагрузку на цикл
+    # событий ограничивает maximum_concurrent_rpcs, а тяжелая работа (KDF) вынесена в пул процессов.
+    server = grpc.aio.server(
+        options=_server_options(),
+        maximum_concurrent_rpcs=GRPC_MAX_CONCURRENT_RPCS or None,
     )
+    servicer = AuthServiceServicer(user_svc_instance, redis_client=redis_client)
+    auth_service_pb2_grpc.add_AuthServiceServicer_to_server(servicer, server)
 
     port = "50051"
     server.add_insecure_port(f'[::]:{port}')
-    logging.info(f"gRPC Auth Server starting on port {port}...")
+    logger.info("gRPC Auth Server starting on port %s...", port)
     await server.start()
-    logging.info(f"gRPC Auth Server started successfully on port {port}.")
+    logger.info("gRPC Auth Server started successfully on port %s.", port)
     try:
         await server.wait_for_termination()
-    except KeyboardInterrupt:
-        logging.info("gRPC Auth Server stopping...")
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        # asyncio.run отменяет serve() при Ctrl+C/SIGTERM - сервер нужно остановить явно.
+        logger.info("gRPC Auth Server stopping...")
         await server.stop(0)
-        logging.info("gRPC Auth Server stopped.")
+        logger.info("gRPC Auth Server stopped.")
+    finally:
+        await servicer.close()
+        shutdown_kdf_pool()
+
+def _grpc_workers():
+    """
+    Число процессов gRPC-сервера из AUTH_GRPC_WORKERS (по умолчанию 1).
+
+    Несколько процессов включаются только явно: MOCK_USERS_DB и кэши результатов входа
+    хранятся в памяти процесса, и пользователь, зарегистрированный в одном процессе,
+    не виден в остальных.
+    """
+    value = os.getenv("AUTH_GRPC_WORKERS")
+    if value:
+        try:
+            return max(1, int(value))
+        except ValueError:
+            logger.warning("Invalid AUTH_GRPC_WORKERS=%r, using a single process.", value)
+    return 1
+
+def _raise_keyboard_interrupt(signum, frame):
+    # SIGTERM обрабатывается как Ctrl+C, чтобы цикл событий корректно отменил serve() и выполнил finally.
+    raise KeyboardInterrupt
+
+def _run_worker(worker_id):
+    """Точка входа дочернего процесса: собственный цикл событий, пул Redis и пул KDF."""
+    configure_logging() # Процесс, запущенный через spawn, не наследует настройку логирования
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    logger.info("gRPC Auth worker %s (pid %s) starting.", worker_id, os.getpid())
+    try:
+        event_loop.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+def main():
+    """
+    Запускает gRPC-сервер в одном или нескольких процессах.
+
+    PBKDF2 и обработка RPC упираются в GIL одного процесса, поэтому при AUTH_GRPC_WORKERS > 1
+    запускаются независимые процессы, каждый из которых слушает порт 50051 с SO_REUSEPORT
+    (опция grpc.so_reuseport), а ядро распределяет между ними входящие соединения.
+    Процессы ничего не разделяют: у каждого свой пул соединений Redis, свой пул KDF,
+    своя MOCK_USERS_DB и свои кэши, поэтому режим нескольких процессов годится только
+    для хранилища пользователей вне процесса.
+
+    Процессы работают до остановки сервера, поэтому завершение любого из них - сбой: его долю
+    соединений взяли бы на себя оставшиеся процессы, а родитель выглядел бы исправным. В этом случае
+    останавливаются все процессы и родитель завершается с кодом 1, чтобы его перезапустил оркестратор.
+    """
+    workers = _grpc_workers()
+    if workers == 1:
+        _run_worker(0)
+        return
+
+    # В каждом процессе сервера достаточно одного процесса KDF: параллелизм дают сами процессы сервера.
+    os.environ.setdefault("AUTH_KDF_WORKERS", "1")
+    ctx = multiprocessing.get_context("spawn") # fork небезопасен для gRPC
+    processes = [
+        ctx.Process(target=_run_worker, args=(worker_id,), name=f"auth-grpc-{worker_id}")
+        for worker_id in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logger.info("gRPC Auth Server started %s worker processes.", workers)
+
+    stopping = False
+
+    def _terminate_workers():
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    def _stop_workers(signum, frame):
+        nonlocal stopping
+        stopping = True
+        logger.info("Received signal %s, stopping gRPC Auth workers...", signum)
+        _terminate_workers()
+
+    signal.signal(signal.SIGTERM, _stop_workers)
+    failed = None
+    try:
+        # Ждем завершения любого процесса; штатно это происходит только после SIGTERM
+        ready = multiprocessing.connection.wait([process.sentinel for process in processes])
+        if not stopping:
+            failed = next(process for process in processes if process.sentinel in ready)
+            _terminate_workers()
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # SIGINT доставляется всей группе процессов; дочерние завершатся сами.
+        for process in processes:
+            process.join()
+    logger.info("gRPC Auth Server stopped.")
+    if failed is not None:
+        logger.error("gRPC Auth worker %s (pid %s) exited unexpectedly with code %s; all workers were stopped.",
+                     failed.name, failed.pid, failed.exitcode)
+        sys.exit(1)
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.INFO)
-    asyncio.run(serve())
+    configure_logging()
+    main()
@@ -0,0 +1,42 @@
+# auth_server/event_loop.py
+# Запуск асинхронных точек входа сервера аутентификации.
+# Если установлен uvloop (цикл событий на основе libuv), он используется вместо
+# стандартного цикла asyncio: обработка готовности сокетов и колбэков выполняется
+# в C, что снижает накладные расходы на каждое соединение.
+import asyncio
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+try:
+    import uvloop
+except ImportError: # uvloop не поддерживает Windows и может быть не установлен
+    uvloop = None
+
+
+def run(main, debug=False):
+    """
+    Выполняет корутину main в новом цикле событий (аналог asyncio.run).
+
+    Отладочный режим asyncio (проверка медленных колбэков, трассировки создания корутин)
+    многократно замедляет обработку соединений, поэтому по умолчанию он отключается явно,
+    даже если включен через PYTHONASYNCIODEBUG или -X dev; в этом случае пишется предупреждение.
+
+    Args:
+        main (Coroutine): Корутина точки входа.
+        debug (bool): Включить отладочный режим asyncio (только для отладки).
+
+    Returns:
+        Any: Результат корутины.
+    """
+    if not debug and (os.environ.get("PYTHONASYNCIODEBUG") or sys.flags.dev_mode):
+        logger.warning("asyncio debug mode requested via PYTHONASYNCIODEBUG/-X dev; "
+                       "it is disabled because it severely degrades server performance.")
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("Using uvloop event loop.")
+    else:
+        logger.info("uvloop is not installed, using default asyncio event loop.")
+    return asyncio.run(main, debug=debug)
@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x12\x61uth_service.proto\x12\x04\x61uth\"1\n\x0b\x41uthRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"E\n\x0c\x41uthResponse\x12\x15\n\rauthenticated\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\r\n\x05token\x18\x03 \x01(\t2\x7f\n\x0b\x41uthService\x12\x39\n\x10\x41uthenticateUser\x12\x11.auth.AuthRequest\x1a\x12.auth.AuthResponse\x12\x35\n\x0cRegisterUser\x12\x11.auth.AuthRequest\x1a\x12.auth.AuthResponseb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x12\x61uth_service.proto\x12\x04\x61uth\"1\n\x0b\x41uthRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"E\n\x0c\x41uthResponse\x12\x15\n\rauthenticated\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\r\n\x05token\x18\x03 \x01(\t\"\x1d\n\x0cTokenRequest\x12\r\n\x05token\x18\x01 \x01(\t\"0\n\rTokenResponse\x12\r\n\x05valid\x18\x01 \x01(\x08\x12\x10\n\x08username\x18\x02 \x01(\t2\xb9\x01\n\x0b\x41uthService\x12\x39\n\x10\x41uthenticateUser\x12\x11.auth.AuthRequest\x1a\x12.auth.AuthResponse\x12\x35\n\x0cRegisterUser\x12\x11.auth.AuthRequest\x1a\x12.auth.AuthResponse\x12\x38\n\rValidateToken\x12\x12.auth.TokenRequest\x1a\x13.auth.TokenResponseb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -35,6 +35,10 @@ if not _descriptor._USE_C_DESCRIPTORS:
   _globals['_AUTHREQUEST']._serialized_end=77
   _globals['_AUTHRESPONSE']._serialized_start=79
   _globals['_AUTHRESPONSE']._serialized_end=148
-  _globals['_AUTHSERVICE']._serialized_start=150
-  _globals['_AUTHSERVICE']._serialized_end=277
+  _globals['_TOKENREQUEST']._serialized_start=150
+  _globals['_TOKENREQUEST']._serialized_end=179
+  _globals['_TOKENRESPONSE']._serialized_start=181
+  _globals['_TOKENRESPONSE']._serialized_end=229
+  _globals['_AUTHSERVICE']._serialized_start=232
+  _globals['_AUTHSERVICE']._serialized_end=417
 # @@protoc_insertion_point(module_scope)
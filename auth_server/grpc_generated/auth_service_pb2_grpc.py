@@ -45,6 +45,11 @@ class AuthServiceStub(object):
                 request_serializer=auth__service__pb2.AuthRequest.SerializeToString,
                 response_deserializer=auth__service__pb2.AuthResponse.FromString,
                 _registered_method=True)
+        self.ValidateToken = channel.unary_unary(
+                '/auth.AuthService/ValidateToken',
+                request_serializer=auth__service__pb2.TokenRequest.SerializeToString,
+                response_deserializer=auth__service__pb2.TokenResponse.FromString,
+                _registered_method=True)
 
 
 class AuthServiceServicer(object):
@@ -65,6 +70,13 @@ class AuthServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def ValidateToken(self, request, context):
+        """Validates a session token issued by AuthenticateUser
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_AuthServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -78,6 +90,11 @@ def add_AuthServiceServicer_to_server(servicer, server):
                     request_deserializer=auth__service__pb2.AuthRequest.FromString,
                     response_serializer=auth__service__pb2.AuthResponse.SerializeToString,
             ),
+            'ValidateToken': grpc.unary_unary_rpc_method_handler(
+                    servicer.ValidateToken,
+                    request_deserializer=auth__service__pb2.TokenRequest.FromString,
+                    response_serializer=auth__service__pb2.TokenResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'auth.AuthService', rpc_method_handlers)
@@ -143,3 +160,30 @@ class AuthService(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def ValidateToken(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/auth.AuthService/ValidateToken',
+            auth__service__pb2.TokenRequest.SerializeToString,
+            auth__service__pb2.TokenResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
@@ -0,0 +1,296 @@
+# auth_server/kdf.py
+# Хеширование паролей PBKDF2-SHA256 без накладных расходов passlib.
+# Формат хешей совместим с passlib.hash.pbkdf2_sha256 (Modular Crypt Format):
+#     $pbkdf2-sha256$<rounds>$<salt ab64>$<checksum ab64>
+# поэтому ранее сохраненные хеши продолжают проверяться, а новые читаются passlib.
+import asyncio
+import base64
+import concurrent.futures
+import functools
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import weakref
+
+logger = logging.getLogger(__name__)
+
+try:
+    # fastpbkdf2 вычисляет HMAC-SHA256 напрямую через функции сжатия SHA-256
+    # (с SHA-NI, если процессор их поддерживает) и заметно быстрее на машинах,
+    # где hashlib собран со старым OpenSSL.
+    from fastpbkdf2 import pbkdf2_hmac as _fast_pbkdf2_hmac
+except ImportError:
+    _fast_pbkdf2_hmac = None
+
+_PROBE_ROUNDS = 2000 # Итераций в пробном замере (доли миллисекунды)
+
+
+def _time_backend(func):
+    """Возвращает лучшее из трех время вычисления пробного PBKDF2, секунд."""
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        func("sha256", b"probe-password", b"probe-salt-16byt", _PROBE_ROUNDS, 32)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _select_backend():
+    """
+    Выбирает самую быструю доступную реализацию PBKDF2-HMAC (один раз при импорте).
+
+    hashlib.pbkdf2_hmac - это PKCS5_PBKDF2_HMAC из OpenSSL (с SHA-NI, если OpenSSL собран
+    с их поддержкой). Если установлен fastpbkdf2, обе реализации замеряются на коротком
+    прогоне и выбирается более быстрая: на части машин OpenSSL быстрее, на части - наоборот.
+
+    Returns:
+        tuple[Callable, str]: Функция pbkdf2_hmac и название бэкенда.
+    """
+    if getattr(hashlib.pbkdf2_hmac, "__module__", "") != "_hashlib":
+        # Без OpenSSL hashlib использует медленную реализацию на Python
+        logger.warning("hashlib.pbkdf2_hmac is not backed by OpenSSL; password hashing will be slow. "
+                       "Install fastpbkdf2 or use a Python build linked against OpenSSL.")
+    if _fast_pbkdf2_hmac is None:
+        return hashlib.pbkdf2_hmac, "hashlib"
+    try:
+        hashlib_time = _time_backend(hashlib.pbkdf2_hmac)
+        fast_time = _time_backend(_fast_pbkdf2_hmac)
+    except Exception as e:
+        logger.warning("PBKDF2 backend probe failed, using hashlib: %s", e)
+        return hashlib.pbkdf2_hmac, "hashlib"
+    logger.debug("PBKDF2 probe: hashlib %.3f ms, fastpbkdf2 %.3f ms", hashlib_time * 1000, fast_time * 1000)
+    if fast_time < hashlib_time:
+        return _fast_pbkdf2_hmac, "fastpbkdf2"
+    return hashlib.pbkdf2_hmac, "hashlib"
+
+
+_pbkdf2_hmac, KDF_BACKEND = _select_backend()
+
+IDENT = "$pbkdf2-sha256$" # Префикс passlib; сохраняется для совместимости хешей
+DEFAULT_ROUNDS = 29000 # Значение passlib.hash.pbkdf2_sha256.default_rounds
+SALT_SIZE = 16 # Размер соли passlib по умолчанию, байт
+CHECKSUM_SIZE = 32 # Длина производного ключа = размер дайджеста SHA-256
+
+
+def _ab64_encode(data):
+    """Кодирует байты в "adapted base64" passlib: '.' вместо '+', без '='."""
+    return base64.b64encode(data, altchars=b"./").rstrip(b"=").decode("ascii")
+
+
+def _ab64_decode(text):
+    """Декодирует строку "adapted base64" passlib в байты."""
+    data = text.encode("ascii")
+    return base64.b64decode(data + b"=" * (-len(data) % 4), altchars=b"./", validate=True)
+
+
+def derive(password, salt, rounds):
+    """
+    Вычисляет PBKDF2-HMAC-SHA256 от пароля.
+
+    Args:
+        password (str | bytes): Пароль; строки кодируются в UTF-8.
+        salt (bytes): Соль.
+        rounds (int): Количество итераций.
+
+    Returns:
+        bytes: Производный ключ длиной CHECKSUM_SIZE.
+    """
+    if isinstance(password, str):
+        password = password.encode("utf-8")
+    return _pbkdf2_hmac("sha256", password, salt, rounds, CHECKSUM_SIZE)
+
+
+def parse_hash(hash_string):
+    """
+    Разбирает хеш в формате passlib pbkdf2_sha256.
+
+    Returns:
+        tuple[int, bytes, bytes]: (rounds, salt, checksum).
+
+    Raises:
+        ValueError: Если строка не является корректным хешем pbkdf2-sha256.
+    """
+    if not hash_string.startswith(IDENT):
+        raise ValueError("not a pbkdf2-sha256 hash")
+    parts = hash_string[len(IDENT):].split("$")
+    if len(parts) != 3:
+        raise ValueError("malformed pbkdf2-sha256 hash")
+    rounds_str, salt_str, checksum_str = parts
+    if not rounds_str.isdigit() or rounds_str.startswith("0"):
+        raise ValueError("malformed pbkdf2-sha256 rounds")
+    try:
+        salt = _ab64_decode(salt_str)
+        checksum = _ab64_decode(checksum_str)
+    except (ValueError, UnicodeEncodeError) as e:
+        raise ValueError("malformed pbkdf2-sha256 hash") from e
+    if len(checksum) != CHECKSUM_SIZE:
+        raise ValueError("malformed pbkdf2-sha256 checksum")
+    return int(rounds_str), salt, checksum
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_hash_cached(hash_string):
+    """
+    То же, что parse_hash, но с запоминанием результата.
+
+    Сохраненный хеш пользователя не меняется между входами, поэтому разбор строки
+    и декодирование ab64 выполняются один раз, а при проверке остается только PBKDF2.
+    Ошибки разбора не кэшируются (lru_cache не запоминает исключения).
+    """
+    return parse_hash(hash_string)
+
+
+def identify(hash_string):
+    """Возвращает True, если строка похожа на хеш pbkdf2-sha256 (без полной проверки)."""
+    return isinstance(hash_string, str) and hash_string.startswith(IDENT)
+
+
+class _Pbkdf2Sha256:
+    """
+    Минимальная замена passlib.hash.pbkdf2_sha256 с тем же интерфейсом hash()/verify()/identify().
+    """
+
+    default_rounds = DEFAULT_ROUNDS
+
+    def hash(self, password, rounds=None, salt=None):
+        """
+        Хеширует пароль со случайной солью.
+
+        Args:
+            password (str | bytes): Пароль.
+            rounds (int, optional): Количество итераций. По умолчанию DEFAULT_ROUNDS.
+            salt (bytes, optional): Соль (для тестов). По умолчанию os.urandom(SALT_SIZE).
+
+        Returns:
+            str: Хеш в формате passlib.
+        """
+        rounds = rounds or self.default_rounds
+        salt = os.urandom(SALT_SIZE) if salt is None else salt
+        checksum = derive(password, salt, rounds)
+        return f"{IDENT}{rounds}${_ab64_encode(salt)}${_ab64_encode(checksum)}"
+
+    def verify(self, password, hash_string):
+        """
+        Проверяет пароль по хешу за постоянное (относительно содержимого) время.
+
+        Raises:
+            ValueError: Если hash_string не является корректным хешем pbkdf2-sha256.
+        """
+        rounds, salt, checksum = parse_hash_cached(hash_string)
+        return hmac.compare_digest(derive(password, salt, rounds), checksum)
+
+    @staticmethod
+    def identify(hash_string):
+        return identify(hash_string)
+
+
+pbkdf2_sha256 = _Pbkdf2Sha256() # Используется как passlib.hash.pbkdf2_sha256
+
+# --- Вынос KDF из цикла событий ---
+# PBKDF2 занимает десятки миллисекунд CPU; вызов в цикле событий блокирует все остальные
+# соединения на это время. Поэтому хеширование и проверка выполняются в пуле процессов.
+# Число процессов задается AUTH_KDF_WORKERS (по умолчанию - число CPU).
+# Разбиение на блоки B_i не используется: длина ключа (32 байта) равна длине дайджеста
+# SHA-256, т.е. вычисляется ровно один блок.
+
+_kdf_pool = None
+_kdf_pool_lock = threading.Lock()
+
+# Ограничение числа одновременно ожидающих KDF корутин. Без него всплеск входов ставит в очередь
+# пула тысячи задач (с их аргументами и future), и задержка каждой растет без предела; с ним
+# лишние запросы ждут на семафоре, а в пуле находится не больше KDF_MAX_CONCURRENCY задач.
+# 0 - удвоенное число процессов пула (пока одна задача вычисляется, следующая уже в очереди).
+KDF_MAX_CONCURRENCY = int(os.getenv("AUTH_KDF_MAX_CONCURRENCY", "0"))
+_kdf_gates = weakref.WeakKeyDictionary() # Цикл событий -> asyncio.Semaphore
+
+
+def _kdf_workers():
+    """Возвращает число процессов пула KDF из AUTH_KDF_WORKERS или число CPU."""
+    value = os.getenv("AUTH_KDF_WORKERS")
+    if value:
+        try:
+            return max(1, int(value))
+        except ValueError:
+            logger.warning("Invalid AUTH_KDF_WORKERS=%r, using CPU count.", value)
+    return os.cpu_count() or 1
+
+
+def get_kdf_pool():
+    """
+    Возвращает пул процессов для KDF, создавая его при первом обращении.
+
+    Используется контекст "spawn": fork процесса с уже запущенными потоками gRPC
+    и цикла событий небезопасен.
+    """
+    global _kdf_pool
+    if _kdf_pool is None:
+        with _kdf_pool_lock:
+            if _kdf_pool is None:
+                workers = _kdf_workers()
+                _kdf_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                logger.info("KDF process pool started with %d workers (backend: %s).", workers, KDF_BACKEND)
+    return _kdf_pool
+
+
+def _kdf_gate():
+    """
+    Возвращает семафор KDF для текущего цикла событий.
+
+    Семафор создается отдельно для каждого цикла: asyncio.Semaphore привязывается к циклу,
+    а модуль используется из разных циклов (несколько asyncio.run() в тестах и утилитах).
+    """
+    loop = asyncio.get_running_loop()
+    gate = _kdf_gates.get(loop)
+    if gate is None:
+        gate = _kdf_gates[loop] = asyncio.Semaphore(KDF_MAX_CONCURRENCY or 2 * _kdf_workers())
+    return gate
+
+
+def shutdown_kdf_pool():
+    """Останавливает пул процессов KDF (при завершении сервера)."""
+    global _kdf_pool
+    with _kdf_pool_lock:
+        pool, _kdf_pool = _kdf_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _hash_password(password):
+    return pbkdf2_sha256.hash(password)
+
+
+async def hash_password(password):
+    """
+    Асинхронно хеширует пароль в пуле процессов, не блокируя цикл событий.
+
+    Returns:
+        str: Хеш в формате passlib pbkdf2_sha256.
+    """
+    loop = asyncio.get_running_loop()
+    async with _kdf_gate():
+        return await loop.run_in_executor(get_kdf_pool(), _hash_password, password)
+
+
+async def verify_password(password, hash_string):
+    """
+    Асинхронно проверяет пароль по хешу в пуле процессов.
+
+    Raises:
+        ValueError: Если hash_string не является корректным хешем pbkdf2-sha256.
+    """
+    # Разбор хеша (с кэшем) и сравнение выполняются здесь; в пул передаются только
+    # параметры PBKDF2 - без повторного разбора строки в процессе-обработчике.
+    rounds, salt, checksum = parse_hash_cached(hash_string)
+    loop = asyncio.get_running_loop()
+    async with _kdf_gate():
+        derived = await loop.run_in_executor(get_kdf_pool(), derive, password, salt, rounds)
+    return hmac.compare_digest(derived, checksum)
+
+logger.debug("PBKDF2-SHA256 backend: %s", KDF_BACKEND)
@@ -0,0 +1,67 @@
+# auth_server/logging_config.py
+# Единая настройка логирования для точек входа сервера аутентификации
+# (TCP-сервер auth_server.main и gRPC-сервер auth_server.auth_grpc_server).
+# Модули пакета только получают логгер через logging.getLogger(__name__)
+# и не настраивают логирование при импорте.
+#
+# Запись в stderr выполняется в фоновом потоке QueueListener: корневой логгер получает
+# только QueueHandler, и вызов logger.info(...) в цикле событий сводится к queue.put
+# без блокирующего ввода-вывода и блокировки обработчика.
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(module)s - %(message)s'
+
+_listener = None # Запущенный QueueListener (один на процесс)
+
+
+def configure_logging(level=None):
+    """
+    Настраивает корневой логгер, если он еще не настроен.
+
+    Корневому логгеру назначается QueueHandler, а реальный StreamHandler(sys.stderr)
+    работает в фоновом потоке QueueListener. Слушатель останавливается (с дозаписью
+    очереди) в stop_logging() или при завершении процесса.
+
+    Повторные вызовы (например, из нескольких точек входа или в дочернем процессе)
+    не добавляют второй обработчик.
+
+    Args:
+        level (str | int, optional): Уровень логирования. По умолчанию берется из
+            переменной окружения LOG_LEVEL, а если она не задана - INFO.
+
+    Returns:
+        logging.handlers.QueueListener | None: Запущенный слушатель или None,
+            если логирование уже было настроено.
+    """
+    global _listener
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    if level is None:
+        level = os.getenv("LOG_LEVEL", "INFO")
+    if isinstance(level, str):
+        level = level.upper()
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Останавливает QueueListener, дописав все записи из очереди. Повторный вызов безопасен."""
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
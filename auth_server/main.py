@@ -3,43 +3,94 @@
 # Отвечает за запуск TCP-сервера для обработки запросов аутентификации
 # и сервера метрик Prometheus.
 import asyncio
+import functools
 import logging # Добавляем импорт
-import sys # Добавлено для вывода в stderr
+import multiprocessing
+import signal
+import sys # print в stderr до настройки логирования и код выхода при сбое обработчика
 import os # Добавлено для os.getenv
-from .tcp_handler import handle_auth_client # Импортируем обработчик клиентских подключений
-from .metrics import ACTIVE_CONNECTIONS_AUTH, SUCCESSFUL_AUTHS, FAILED_AUTHS # Импорт метрик Prometheus
-from prometheus_client import start_http_server # Функция для запуска HTTP-сервера метрик
-import threading # Используется для запуска сервера метрик в отдельном потоке
-
-# Настройка базового логирования для всего приложения.
-# Уровень логирования DEBUG, формат включает время, имя логгера, уровень и сообщение.
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(name)s - %(module)s - %(message)s')
+import shutil
+import tempfile
+from . import event_loop # Запуск цикла событий (uvloop, если установлен)
+from .logging_config import configure_logging, stop_logging # Логирование через QueueHandler/QueueListener (уровень из LOG_LEVEL)
+from .tcp_handler import AuthProtocol # Протокол обработки клиентских подключений
+from .user_service import get_user_service # Общий сервис пользователей, передается обработчику
+from .metrics import flush_metrics, run_metrics_flusher # Сброс пакетных приращений счетчиков Prometheus
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest # Экспорт метрик в текстовом формате Prometheus
+
 logger = logging.getLogger(__name__) # Создаем логгер для текущего модуля
 
-def start_metrics_server():
+METRICS_PORT = 8000 # Порт Prometheus для сервера аутентификации
+METRICS_REQUEST_TIMEOUT = 5.0 # Таймаут чтения HTTP-запроса скрейпера, секунд
+
+async def _handle_metrics_request(reader, writer, registry=REGISTRY):
+    """
+    Обрабатывает HTTP-запрос к серверу метрик.
+
+    Отвечает на GET /metrics (и GET /) текущим состоянием реестра Prometheus,
+    на остальные пути - 404. Соединение закрывается после ответа (Connection: close).
+    """
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=METRICS_REQUEST_TIMEOUT)
+        request_line = head.split(b"\r\n", 1)[0].split()
+        path = request_line[1].split(b"?", 1)[0] if len(request_line) >= 2 else b""
+        if request_line and request_line[0] == b"GET" and path in (b"/metrics", b"/"):
+            flush_metrics() # Отдаем счетчики с учетом еще не сброшенных приращений
+            status, content_type, body = b"200 OK", CONTENT_TYPE_LATEST.encode("ascii"), generate_latest(registry)
+        else:
+            status, content_type, body = b"404 Not Found", b"text/plain; charset=utf-8", b"Not Found\n"
+        writer.write(
+            b"HTTP/1.1 " + status + b"\r\nContent-Type: " + content_type
+            + b"\r\nContent-Length: " + str(len(body)).encode("ascii")
+            + b"\r\nConnection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass # Скрейпер отключился или прислал некорректный запрос - отвечать некому
+    except Exception as e:
+        logger.error("Error serving Prometheus metrics request: %s", e, exc_info=True)
+    finally:
+        writer.close()
+
+async def start_metrics_server(host='0.0.0.0', port=METRICS_PORT, registry=REGISTRY):
     """
-    Запускает HTTP-сервер для сбора метрик Prometheus.
-    Сервер запускается на порту 8000.
+    Запускает HTTP-сервер для сбора метрик Prometheus в текущем цикле событий.
+    По умолчанию сервер запускается на порту 8000.
+
+    Вместо prometheus_client.start_http_server (отдельный поток с блокирующим HTTPServer,
+    конкурирующий за GIL с циклом событий) запросы скрейпера обслуживаются тем же циклом asyncio.
+
+    Args:
+        registry (CollectorRegistry): Реестр для выдачи. По умолчанию - реестр процесса;
+            в многопроцессном режиме - реестр с MultiProcessCollector.
+
+    Returns:
+        asyncio.Server | None: Запущенный сервер или None, если запустить его не удалось.
     """
-    metrics_port = 8000 # Порт Prometheus для сервера аутентификации
+    handler = _handle_metrics_request
+    if registry is not REGISTRY:
+        handler = functools.partial(_handle_metrics_request, registry=registry)
     try:
-        print(f"[AuthServerMetrics] Попытка запуска сервера Prometheus на порту {metrics_port}.", flush=True, file=sys.stderr)
-        start_http_server(metrics_port) 
-        logger.info(f"Prometheus metrics server for Authentication Server started on port {metrics_port}.")
-        print(f"[AuthServerMetrics] Сервер Prometheus запущен на порту {metrics_port}.", flush=True, file=sys.stderr)
+        metrics_server = await asyncio.start_server(handler, host, port)
+        logger.info("Prometheus metrics server for Authentication Server started on port %s.", port)
+        return metrics_server
     except OSError as e:
-        logger.error(f"OSError starting Prometheus metrics server on port {metrics_port}: {e}", exc_info=True)
-        print(f"[AuthServerMetrics] CRITICAL: OSError при запуске сервера Prometheus на порту {metrics_port}: {e}", flush=True, file=sys.stderr)
-        # Эта ошибка в демон-потоке может не остановить основное приложение напрямую, если не обработана выходом.
+        logger.error("OSError starting Prometheus metrics server on port %s: %s", port, e, exc_info=True)
+        # Сервер аутентификации продолжает работу без метрик.
     except Exception as e_metrics:
-        logger.error(f"Failed to start Prometheus metrics server on port {metrics_port}: {e_metrics}", exc_info=True)
-        print(f"[AuthServerMetrics] ERROR: Не удалось запустить сервер Prometheus на порту {metrics_port}: {e_metrics}", flush=True, file=sys.stderr)
+        logger.error("Failed to start Prometheus metrics server on port %s: %s", port, e_metrics, exc_info=True)
+    return None
 
-async def main():
+async def main(reuse_port=False, serve_metrics=True):
     """
     Основная асинхронная функция для запуска сервера аутентификации.
     Инициализирует и запускает TCP-сервер для приема клиентских подключений
     и сервер метрик.
+
+    Args:
+        reuse_port (bool): Слушать порт с SO_REUSEPORT (несколько процессов-обработчиков).
+        serve_metrics (bool): Запускать сервер метрик в этом процессе. В многопроцессном
+            режиме метрики всех процессов отдает родительский процесс.
     """
     DEFAULT_AUTH_HOST = '0.0.0.0'
     DEFAULT_AUTH_PORT = 8888
@@ -52,86 +103,205 @@ async def main():
         port_str = os.environ.get(AUTH_PORT_ENV_VAR)
         if port_str:
             port = int(port_str)
-            logger.info(f"Используется порт из переменной окружения {AUTH_PORT_ENV_VAR}: {port}")
+            logger.info("Используется порт из переменной окружения %s: %s", AUTH_PORT_ENV_VAR, port)
         else:
             port = DEFAULT_AUTH_PORT
-            logger.info(f"Переменная окружения {AUTH_PORT_ENV_VAR} не установлена, используется порт по умолчанию: {port}")
+            logger.info("Переменная окружения %s не установлена, используется порт по умолчанию: %s", AUTH_PORT_ENV_VAR, port)
     except ValueError:
         port_str_val = os.environ.get(AUTH_PORT_ENV_VAR) # Повторно получаем для логирования
         port = DEFAULT_AUTH_PORT
-        logger.warning(f"Не удалось преобразовать значение переменной окружения {AUTH_PORT_ENV_VAR} ('{port_str_val}') в число. Используется порт по умолчанию: {port}")
+        logger.warning("Не удалось преобразовать значение переменной окружения %s ('%s') в число. Используется порт по умолчанию: %s", AUTH_PORT_ENV_VAR, port_str_val, port)
     
-    logger.info(f"Сервер аутентификации будет запущен на {host}:{port}.")
+    logger.info("Сервер аутентификации будет запущен на %s:%s.", host, port)
+
+    # Сервер метрик работает в том же цикле событий, отдельный поток не нужен.
+    metrics_server = await start_metrics_server() if serve_metrics else None
+    metrics_flusher = asyncio.create_task(run_metrics_flusher()) # Периодический сброс пакетных счетчиков
 
-    # Запуск сервера метрик в отдельном потоке.
-    # daemon=True означает, что поток завершится при завершении основного процесса.
-    # metrics_thread = threading.Thread(target=start_metrics_server, daemon=True)
-    # metrics_thread.name = "AuthMetricsServerThread" # Даем имя потоку
-    # metrics_thread.start()
-    logger.info("Prometheus metrics server startup is currently COMMENTED OUT for debugging.") # Запуск сервера метрик Prometheus в данный момент ЗАКОММЕНТИРОВАН для отладки.
+    # Один экземпляр сервиса пользователей на процесс (get_user_service) передается
+    # обработчику явно (вместо глобальной переменной модуля tcp_handler).
+    user_service = get_user_service()
 
     server = None # Инициализируем сервер как None
     try:
         # Запуск TCP-сервера с использованием asyncio.
-        # handle_auth_client будет вызываться для каждого нового клиентского подключения.
-        server = await asyncio.start_server(
-            handle_auth_client, host, port)
+        # Для каждого нового клиентского подключения создается AuthProtocol (BufferedProtocol:
+        # запрос читается в заранее выделенный буфер размером MAX_AUTH_MESSAGE).
+        server = await asyncio.get_running_loop().create_server(
+            functools.partial(AuthProtocol, user_service), host, port,
+            reuse_port=reuse_port or None)
 
         addr = server.sockets[0].getsockname() # Получаем адрес и порт, на котором запущен сервер
-        logger.info(f'Authentication server started on {addr}')
-        print(f"[AuthServerMainLoop] Сервер аутентификации слушает на {addr}", flush=True, file=sys.stderr)
+        logger.info('Authentication server started on %s', addr)
     except OSError as e:
-        logger.critical(f"Could not start Authentication server on {host}:{port}: {e}", exc_info=True)
-        print(f"[AuthServerMainLoop] CRITICAL: OSError при привязке основного сервера аутентификации к {host}:{port}: {e}", flush=True, file=sys.stderr)
+        logger.critical("Could not start Authentication server on %s:%s: %s", host, port, e, exc_info=True)
         # Рассмотрите sys.exit(1) или повторный вызов исключения, чтобы процесс завершился, если сервер не может запуститься
+        metrics_flusher.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
         return # Выход, если сервер не может быть привязан
     except Exception as e_main_server:
-        logger.critical(f"Unexpected error starting main Authentication server: {e_main_server}", exc_info=True)
-        print(f"[AuthServerMainLoop] CRITICAL: Неожиданная ошибка при запуске основного сервера аутентификации: {e_main_server}", flush=True, file=sys.stderr)
+        logger.critical("Unexpected error starting main Authentication server: %s", e_main_server, exc_info=True)
+        metrics_flusher.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
         return
 
 
     # Бесконечный цикл для обслуживания подключений.
     if server:
         try:
-            # async with server: # Временно удаляем async with для упрощения
-            logger.info("Auth Server: About to call server.start_serving().")
-            print("[AuthServerMainLoop] Сейчас будет вызван server.start_serving().", flush=True, file=sys.stderr)
-            await server.start_serving() # Явно начинаем обслуживание
-            logger.info("Auth Server: server.start_serving() completed. Entering wait loop.")
-            print("[AuthServerMainLoop] server.start_serving() завершен. Вход в цикл ожидания.", flush=True, file=sys.stderr)
-            await asyncio.Event().wait() # Поддерживать активность неопределенно долго
-            # logger.info("Auth Server: server.serve_forever() exited normally (SHOULD NOT HAPPEN IN NORMAL RUN).")
-            # print("[AuthServerMainLoop] server.serve_forever() завершился нормально (НЕ ДОЛЖНО ПРОИСХОДИТЬ В ОБЫЧНОМ РЕЖИМЕ).", flush=True, file=sys.stderr)
+            # serve_forever() обслуживает подключения до отмены задачи; при отмене (например, по Ctrl+C)
+            # он сам закрывает сервер, а выход из "async with" дожидается его закрытия.
+            async with server:
+                logger.info("Auth Server: serving connections.")
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            logger.info("Authentication server shutting down (cancelled).")
         except KeyboardInterrupt: # Разрешить чистое завершение через Ctrl+C при прямом запуске
             logger.info("Authentication server shutting down (KeyboardInterrupt).")
-            print("[AuthServerMainLoop] Получено KeyboardInterrupt.", flush=True, file=sys.stderr)
         except Exception as e_serve:
-            logger.error(f"Auth Server: Exception during server operation: {e_serve}", exc_info=True)
-            print(f"[AuthServerMainLoop] Исключение во время работы сервера: {e_serve}", flush=True, file=sys.stderr)
+            logger.error("Auth Server: Exception during server operation: %s", e_serve, exc_info=True)
         finally:
-            logger.info("Authentication server main loop ended (inside finally). Cleaning up server.")
-            print("[AuthServerMainLoop] Вошли в блок finally основного цикла операций.", flush=True, file=sys.stderr)
-            if server and server.is_serving():
-                server.close()
-                await server.wait_closed()
+            metrics_flusher.cancel()
+            if metrics_server is not None:
+                metrics_server.close()
             logger.info("Authentication server fully stopped.")
     else:
         logger.error("Main server object was not created or failed to bind. Auth server cannot start.")
-        print("[AuthServerMainLoop] Главный объект сервера не был создан или не удалось выполнить привязку. Сервер аутентификации не может запуститься.", flush=True, file=sys.stderr)
+
+def _server_workers():
+    """Возвращает число процессов TCP-сервера из AUTH_SERVER_WORKERS (по умолчанию 1)."""
+    value = os.getenv("AUTH_SERVER_WORKERS")
+    if value:
+        try:
+            return max(1, int(value))
+        except ValueError:
+            logger.warning("Invalid AUTH_SERVER_WORKERS=%r, using a single process.", value)
+    return 1
+
+def _raise_keyboard_interrupt(signum, frame):
+    # SIGTERM обрабатывается как Ctrl+C, чтобы цикл событий корректно отменил main() и выполнил finally.
+    raise KeyboardInterrupt
+
+def _run_worker(worker_id):
+    """Точка входа процесса-обработчика: собственный цикл событий на общем порту (SO_REUSEPORT)."""
+    configure_logging() # Процесс, запущенный через spawn, не наследует настройку логирования
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    logger.info("Auth TCP worker %s (pid %s) starting.", worker_id, os.getpid())
+    try:
+        event_loop.run(main(reuse_port=True, serve_metrics=False))
+    except KeyboardInterrupt:
+        pass
+
+async def _wait_for_worker_exit(processes):
+    """
+    Ждет завершения любого из процессов-обработчиков и возвращает его.
+
+    Sentinel процесса (дескриптор, готовый к чтению после завершения процесса) отслеживается
+    циклом событий через add_reader, без отдельного потока.
+    """
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+
+    def _on_exit(process):
+        if not exited.done():
+            exited.set_result(process)
+
+    for process in processes:
+        loop.add_reader(process.sentinel, _on_exit, process)
+    try:
+        return await exited
+    finally:
+        for process in processes:
+            loop.remove_reader(process.sentinel)
+
+async def _supervise_workers(processes):
+    """
+    Отдает метрики всех процессов-обработчиков (prometheus_client multiprocess), пока работают
+    все обработчики, и возвращает первый завершившийся процесс.
+    Если сервер метрик запустить не удалось, обработчики все равно отслеживаются.
+    """
+    from prometheus_client import multiprocess
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    metrics_server = await start_metrics_server(registry=registry)
+    try:
+        return await _wait_for_worker_exit(processes)
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+
+def run():
+    """
+    Запускает сервер аутентификации в одном или нескольких процессах.
+
+    Разбор JSON и проверка паролей упираются в GIL одного процесса, поэтому при
+    AUTH_SERVER_WORKERS > 1 запускаются независимые процессы (spawn), каждый со своим циклом
+    событий, слушающие один порт с SO_REUSEPORT; входящие соединения распределяет ядро.
+    Метрики процессов собираются в режиме multiprocess prometheus_client (каталог
+    PROMETHEUS_MULTIPROC_DIR; если он не задан, создается временный) и отдаются родительским
+    процессом на METRICS_PORT. Счетчики процессов попадают в выдачу после их периодического
+    сброса (METRICS_FLUSH_INTERVAL).
+
+    Обработчики работают до остановки сервера, поэтому завершение любого из них - сбой: его долю
+    соединений взяли бы на себя оставшиеся процессы, а родитель выглядел бы исправным. В этом случае
+    останавливаются все обработчики и процесс завершается с кодом 1, чтобы его перезапустил оркестратор.
+    """
+    workers = _server_workers()
+    if workers == 1:
+        event_loop.run(main())
+        return
+
+    # Переменная должна быть задана до импорта prometheus_client в дочерних процессах.
+    temp_metrics_dir = None
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        temp_metrics_dir = tempfile.mkdtemp(prefix="auth-prometheus-")
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = temp_metrics_dir
+    # Каждому процессу достаточно одного процесса KDF: параллелизм дают сами процессы сервера.
+    os.environ.setdefault("AUTH_KDF_WORKERS", "1")
+    ctx = multiprocessing.get_context("spawn")
+    processes = [
+        ctx.Process(target=_run_worker, args=(worker_id,), name=f"auth-tcp-{worker_id}")
+        for worker_id in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logger.info("Auth Server started %s worker processes.", workers)
+
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    failed = None
+    try:
+        failed = event_loop.run(_supervise_workers(processes))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        from prometheus_client import multiprocess
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+            multiprocess.mark_process_dead(process.pid)
+        if temp_metrics_dir is not None:
+            shutil.rmtree(temp_metrics_dir, ignore_errors=True)
+        logger.info("Auth Server workers stopped.")
+    if failed is not None:
+        logger.error("Auth TCP worker %s (pid %s) exited unexpectedly with code %s; all workers were stopped.",
+                     failed.name, failed.pid, failed.exitcode)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
     # Точка входа в приложение.
-    # Запускает основную асинхронную функцию main.
-    print("[AuthServerMainScript] Инициализация сервера аутентификации.", flush=True, file=sys.stderr)
-    # BasicConfig должен быть в самом начале, если возможно, или используйте специальную функцию конфигурации логирования.
-    # logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(name)s - %(module)s - %(message)s')
+    # Запускает сервер (один процесс или несколько - см. run()).
+    print("[AuthServerMainScript] Инициализация сервера аутентификации.", flush=True, file=sys.stderr) # До configure_logging() логгер еще не выводит сообщения
+    configure_logging()
     try:
-        asyncio.run(main())
+        run()
     except KeyboardInterrupt:
         logger.info("Auth Server application stopped by KeyboardInterrupt (at asyncio.run level).")
-        print("[AuthServerMainScript] Приложение сервера аутентификации остановлено KeyboardInterrupt.", flush=True, file=sys.stderr)
     except Exception as e_run: # Перехват других потенциальных ошибок из asyncio.run или main(), если она возвращается раньше из-за ошибки
-        logger.critical(f"Auth Server application CRASHED: {e_run}", exc_info=True)
-        print(f"[AuthServerMainScript] CRITICAL error running Auth Server application: {e_run}", flush=True, file=sys.stderr)
+        logger.critical("Auth Server application CRASHED: %s", e_run, exc_info=True)
+    finally:
+        stop_logging() # Дописываем записи, оставшиеся в очереди логирования
@@ -3,33 +3,118 @@
 # Метрики включают количество активных соединений, а также счетчики
 # успешных и неудачных попыток аутентификации.
 
+import asyncio
+
 from prometheus_client import Counter, Gauge
 
+# Интервал фонового сброса накопленных приращений счетчиков, секунд.
+METRICS_FLUSH_INTERVAL = 0.5
+# Количество приращений, после которого накопленное значение сбрасывается в счетчик немедленно.
+METRICS_FLUSH_EVERY = 100
+
+
+class BatchedCounter:
+    """
+    Обертка над prometheus_client.Counter, накапливающая приращения локально.
+
+    Каждый Counter.inc() захватывает блокировку внутри prometheus_client; при высокой частоте
+    аутентификаций приращения выгоднее суммировать в обычном int и передавать в счетчик
+    одним вызовом. Накопленное значение сбрасывается при достижении flush_every, фоновой
+    задачей run_metrics_flusher() и перед каждой выдачей метрик (flush_metrics()),
+    поэтому при опросе Prometheus значение счетчика равно сумме всех приращений.
+
+    Не потокобезопасна: inc() и flush() вызываются из одного цикла событий.
+    """
+
+    def __init__(self, counter, flush_every=METRICS_FLUSH_EVERY):
+        self.counter = counter # Исходный счетчик Prometheus
+        self.flush_every = flush_every
+        self._pending = 0
+        _BATCHED_COUNTERS.append(self)
+
+    def inc(self, amount=1):
+        """Добавляет приращение к локальному накопителю."""
+        self._pending += amount
+        if self._pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Передает накопленное приращение в счетчик Prometheus."""
+        pending = self._pending
+        if pending:
+            self._pending = 0
+            self.counter.inc(pending)
+
+
+class BatchedGauge(BatchedCounter):
+    """
+    Обертка над prometheus_client.Gauge для значений, которые меняются через inc()/dec().
+
+    Приращения и уменьшения суммируются в один знаковый int и передаются в датчик
+    одним Gauge.inc(delta) по тем же правилам, что и у BatchedCounter. Пара inc()/dec()
+    одного короткого соединения, попавшая в один интервал сброса, взаимно уничтожается
+    и не обращается к prometheus_client вовсе.
+    """
+
+    def inc(self, amount=1):
+        """Добавляет приращение (может быть отрицательным) к локальному накопителю."""
+        self._pending += amount
+        if abs(self._pending) >= self.flush_every:
+            self.flush()
+
+    def dec(self, amount=1):
+        """Уменьшает значение датчика на amount (локально, до сброса)."""
+        self.inc(-amount)
+
+
+_BATCHED_COUNTERS = [] # Все созданные BatchedCounter/BatchedGauge, сбрасываются flush_metrics()
+
+
+def flush_metrics():
+    """Сбрасывает накопленные приращения всех BatchedCounter/BatchedGauge (вызывается перед выдачей метрик)."""
+    for batched in _BATCHED_COUNTERS:
+        batched.flush()
+
+
+async def run_metrics_flusher(interval=METRICS_FLUSH_INTERVAL):
+    """Фоновая задача: периодически сбрасывает накопленные приращения счетчиков."""
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            flush_metrics()
+    finally:
+        flush_metrics()
+
+
 # Gauge (датчик) для отслеживания текущего количества активных TCP-соединений
 # к серверу аутентификации.
 # 'auth_server_active_connections' - имя метрики.
 # 'Количество активных TCP-соединений с Сервером Аутентификации' - описание метрики.
-ACTIVE_CONNECTIONS_AUTH = Gauge(
+# Изменения накапливаются в BatchedGauge и передаются в датчик пакетами.
+# В многопроцессном режиме (PROMETHEUS_MULTIPROC_DIR) значения живых процессов суммируются.
+ACTIVE_CONNECTIONS_AUTH = BatchedGauge(Gauge(
     'auth_server_active_connections',
-    'Количество активных TCP-соединений с Сервером Аутентификации'
-)
+    'Количество активных TCP-соединений с Сервером Аутентификации',
+    multiprocess_mode='livesum'
+))
 
 # Counter (счетчик) для общего числа успешных аутентификаций.
 # Это кумулятивный счетчик, который только увеличивается.
 # 'auth_server_successful_authentications_total' - имя метрики.
 # 'Общее количество успешных аутентификаций' - описание метрики.
-SUCCESSFUL_AUTHS = Counter(
+# Приращения накапливаются в BatchedCounter и передаются в счетчик пакетами.
+SUCCESSFUL_AUTHS = BatchedCounter(Counter(
     'auth_server_successful_authentications_total',
     'Общее количество успешных аутентификаций'
-)
+))
 
 # Counter (счетчик) для общего числа неудачных аутентификаций.
 # 'auth_server_failed_authentications_total' - имя метрики.
 # 'Общее количество неудачных аутентификаций' - описание метрики.
-FAILED_AUTHS = Counter(
+FAILED_AUTHS = BatchedCounter(Counter(
     'auth_server_failed_authentications_total',
     'Общее количество неудачных аутентификаций'
-)
+))
 
 # Это сообщение будет выведено при импорте модуля,
 # подтверждая, что определения метрик были загружены.
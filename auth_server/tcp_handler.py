@@ -1,176 +1,554 @@
 # auth_server/tcp_handler.py
 # Этот модуль отвечает за обработку TCP-соединений и сообщений от клиентов
 # для сервера аутентификации.
+# Обработчик рассчитан на цикл событий uvloop: точка входа (main.run) запускается через
+# event_loop.run(), который устанавливает uvloop.EventLoopPolicy, если uvloop установлен,
+# а при AUTH_SERVER_WORKERS > 1 процессы делят порт через SO_REUSEPORT. Не заменяйте
+# event_loop.run() на asyncio.run() - обработка коротких запросов станет заметно медленнее.
 import asyncio
+import functools
 import json # Импортируем json для работы с JSON-сообщениями
 import logging # Импортируем logging для логирования
-# Импортируем UserService и глобальные функции (которые теперь обертки) для обратной совместимости или постепенного перехода
-from .user_service import UserService # , authenticate_user, create_user # Убрали authenticate_user, create_user
+import operator
+import os
+import time
+from typing import Any
+from .user_service import MAX_USERNAME_LENGTH, MAX_PASSWORD_LENGTH # Экземпляр UserService передается в AuthProtocol
+from .auth_cache import TTLCache
 from .metrics import ACTIVE_CONNECTIONS_AUTH, SUCCESSFUL_AUTHS, FAILED_AUTHS # Импортируем метрики Prometheus
 
+try:
+    # orjson разбирает и сериализует короткие сообщения в несколько раз быстрее json
+    # и сразу возвращает bytes. orjson.JSONDecodeError - подкласс json.JSONDecodeError.
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # msgspec разбирает запрос сразу в структуру с известными полями, без промежуточного dict.
+    import msgspec
+except ImportError:
+    msgspec = None
+
 # Создаем логгер для этого модуля
 logger = logging.getLogger(__name__)
 
-# Создаем экземпляр UserService для использования в обработчике
-# Это предполагает, что UserService может быть инстанцирован глобально.
-# Если UserService требует специфической конфигурации или управления жизненным циклом,
-# это может потребовать другого подхода (например, передача через DI или фабрику).
-user_service = UserService()
+
+class _PeerLoggerAdapter(logging.LoggerAdapter):
+    """
+    Добавляет адрес клиента в начало сообщения и в поле записи `peer`.
+
+    Префикс строится один раз на соединение; %-аргументы сообщения форматируются
+    только для записей, прошедших проверку уровня (LoggerAdapter проверяет уровень
+    до вызова process()).
+    """
+
+    def __init__(self, logger, extra):
+        super().__init__(logger, extra)
+        self._prefix = f"[{extra['peer']}] "
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = self.extra
+        return self._prefix + msg, kwargs
 
 # Таймаут для операции чтения от клиента
 CLIENT_READ_TIMEOUT = 15.0 # секунд
 
-async def handle_auth_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+# Максимальный размер запроса - размер буфера соединения AuthProtocol (вместе с переводом
+# строки). Более длинная строка отклоняется ответом _ERR_TOO_LARGE.
+MAX_AUTH_MESSAGE = int(os.getenv("AUTH_MAX_MESSAGE", "2048")) # байт
+
+if orjson is not None:
+    _loads = orjson.loads
+
+    def _frame(response):
+        """Сериализует ответ в кадр протокола: JSON в UTF-8, завершенный переводом строки."""
+        # Перевод строки добавляет сам orjson: без конкатенации и второго объекта bytes
+        return orjson.dumps(response, option=orjson.OPT_APPEND_NEWLINE)
+else:
+    _loads = json.loads
+    # Один кодировщик на модуль: json.dumps с нестандартными параметрами создает новый
+    # JSONEncoder при каждом вызове. Тот же вывод, что у orjson: компактный UTF-8 без \uXXXX.
+    _encode_json = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+
+    def _frame(response):
+        """Сериализует ответ в кадр протокола: JSON в UTF-8, завершенный переводом строки."""
+        return (_encode_json(response) + "\n").encode("utf-8")
+
+if msgspec is not None:
+    class _AuthRequest(msgspec.Struct):
+        """Схема запроса. Типы полей не ограничиваются: проверка значений остается за обработчиками."""
+        action: Any = None
+        username: Any = None
+        password: Any = None # Для register это сырой пароль
+
+    _decode_request = msgspec.json.Decoder(_AuthRequest).decode
+    # msgspec.ValidationError (например, JSON не объект) - подкласс msgspec.DecodeError
+    _DECODE_ERRORS = (msgspec.DecodeError, json.JSONDecodeError, UnicodeDecodeError)
+
+    def _parse_request(message):
+        """
+        Разбирает запрос.
+
+        Returns:
+            tuple: (action, username, password); отсутствующие поля - None.
+        """
+        request = _decode_request(message)
+        return request.action, request.username, request.password
+else:
+    _DECODE_ERRORS = (json.JSONDecodeError, UnicodeDecodeError)
+    _request_fields = operator.itemgetter("action", "username", "password") # Три поля одним вызовом в C
+
+    def _parse_request(message):
+        """
+        Разбирает запрос.
+
+        Returns:
+            tuple: (action, username, password); отсутствующие поля - None.
+        """
+        payload = _loads(message)
+        if not isinstance(payload, dict): # Быстрая проверка пропускает только текст, начинающийся с "{"
+            raise json.JSONDecodeError("Expecting JSON object", message.decode("utf-8", "replace"), 0)
+        try:
+            return _request_fields(payload)
+        except KeyError: # Неполный запрос - редкий путь; отсутствующие поля становятся None
+            return payload.get("action"), payload.get("username"), payload.get("password")
+
+# Неизменяемые ответы об ошибках собираются один раз при импорте.
+_ERR_EMPTY = _frame({"status": "error", "message": "Получено пустое сообщение"})
+_ERR_BAD_JSON = _frame({"status": "error", "message": "Неверный формат JSON"})
+_ERR_TIMEOUT = _frame({"status": "error", "message": "Таймаут запроса"})
+_ERR_UNKNOWN_ACTION = _frame({"status": "error", "message": "Неизвестное или отсутствующее действие"})
+_ERR_INTERNAL = _frame({"status": "error", "message": "Внутренняя ошибка сервера при обработке"})
+_ERR_CRITICAL = _frame({"status": "error", "message": "Критическая внутренняя ошибка сервера"})
+_ERR_MISSING_LOGIN = _frame({"status": "failure", "message": "Отсутствует имя пользователя или пароль для входа."})
+_ERR_MISSING_REGISTER = _frame({"status": "error", "message": "Отсутствует имя пользователя или пароль для регистрации."})
+_ERR_UTF8 = _frame({"status": "error", "message": "Неверная кодировка символов. Ожидается UTF-8."})
+_ERR_TOO_LARGE = _frame({"status": "error", "message": "Слишком длинный запрос"})
+_ERR_BUSY = _frame({"status": "error", "message": "Сервер перегружен, повторите попытку позже"})
+_ERR_INVALID_CREDENTIALS = _frame({"status": "failure", "message": "Неверное имя пользователя или пароль."})
+_ERR_INVALID_REGISTER = _frame({"status": "error", "message": "Недопустимое имя пользователя или пароль для регистрации."})
+
+@functools.lru_cache(maxsize=64)
+def _failure_frame(message):
+    """Кадр неудачного входа или регистрации; причин немного, поэтому кадры кэшируются по тексту."""
+    return _frame({"status": "failure", "message": message})
+
+# Ограничение некорректных запросов ("протекающее ведро" на IP клиента): не более
+# BAD_REQUEST_BURST некорректных запросов подряд, ведро полностью опустошается за
+# BAD_REQUEST_WINDOW секунд. Соединения с переполненным ведром сбрасываются без ответа,
+# чтобы поток мусорных запросов обходился серверу дешевле, чем обычные запросы.
+BAD_REQUEST_BURST = int(os.getenv("AUTH_BAD_REQUEST_BURST", "10")) # 0 - ограничение отключено
+BAD_REQUEST_WINDOW = float(os.getenv("AUTH_BAD_REQUEST_WINDOW", "10.0")) # секунд; 0 - ограничение отключено
+BAD_REQUEST_MAX_PEERS = 10000 # Сколько адресов клиентов отслеживается одновременно
+
+class _BadRequestLimiter:
+    """
+    Счетчик некорректных запросов по адресам клиентов с линейным "протеканием".
+
+    Уровень ведра хранится в TTLCache вместе со временем последнего обновления и уменьшается
+    на burst/window в секунду. Запись живет window секунд после обновления: за это время
+    ведро успевает опустеть, так что устаревшие адреса удаляются без отдельной очистки.
+    """
+
+    def __init__(self, burst=BAD_REQUEST_BURST, window=BAD_REQUEST_WINDOW,
+                 maxsize=BAD_REQUEST_MAX_PEERS, timer=time.monotonic):
+        if window <= 0: # Ведро без окна опустошить нельзя - ограничение отключается, как при burst=0
+            burst, window = 0, 1.0
+        self.burst = burst
+        self._leak_per_second = burst / window
+        self._timer = timer
+        self._buckets = TTLCache(maxsize=maxsize, ttl=window, timer=timer)
+
+    def _level(self, peer, now):
+        state = self._buckets.get(peer)
+        if state is None:
+            return 0.0
+        level, updated = state
+        return max(0.0, level - (now - updated) * self._leak_per_second)
+
+    def is_blocked(self, peer):
+        """Возвращает True, если в ведре клиента нет места еще для одного некорректного запроса."""
+        return self.burst > 0 and self._level(peer, self._timer()) + 1.0 > self.burst
+
+    def record(self, peer):
+        """Учитывает один некорректный запрос клиента."""
+        if self.burst > 0:
+            now = self._timer()
+            self._buckets.set(peer, (self._level(peer, now) + 1.0, now))
+
+_bad_requests = _BadRequestLimiter()
+
+# Ограничение числа одновременно обслуживаемых соединений процесса. asyncio само по себе
+# соединения не ограничивает: при всплеске подключений растут число задач, буферов и очередь
+# к KDF. Сверх лимита соединение сразу получает _ERR_BUSY, не ожидая очереди.
+MAX_CONNECTIONS = int(os.getenv("AUTH_MAX_CONCURRENCY", "1024")) # 0 - без ограничения
+_open_connections = 0
+# Отклоненное соединение после ответа и FIN ждет EOF клиента не дольше REJECT_LINGER секунд:
+# закрытие сокета с непрочитанным запросом отправило бы RST, и клиент мог не получить _ERR_BUSY.
+REJECT_LINGER = 1.0 # секунд
+# Общий буфер для отбрасываемого ввода отклоненных соединений: данные не нужны, поэтому
+# соединения одного цикла событий могут читать в один буфер, без выделения на каждое.
+_DISCARD_VIEW = memoryview(bytearray(4096))
+
+def _admit_connection():
+    """Учитывает новое соединение; возвращает False, если лимит MAX_CONNECTIONS исчерпан."""
+    global _open_connections
+    if MAX_CONNECTIONS and _open_connections >= MAX_CONNECTIONS:
+        return False
+    _open_connections += 1
+    return True
+
+def _release_connection():
+    """Освобождает место соединения, ранее принятого _admit_connection()."""
+    global _open_connections
+    _open_connections -= 1
+
+def _is_utf8(data):
+    """Возвращает True, если байты являются корректным UTF-8."""
+    try:
+        data.decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def _credentials_valid(username, password):
+    """
+    Дешевая проверка учетных данных до кэша и KDF: обе строки, не длиннее пределов.
+    Из JSON может прийти число, список или строка в мегабайт - такие запросы дальше не идут.
+    """
+    return (type(username) is str and type(password) is str
+            and len(username) <= MAX_USERNAME_LENGTH and len(password) <= MAX_PASSWORD_LENGTH)
+
+async def _handle_login(user_service, username, password, log, peer_host):
+    """
+    Выполняет действие "login".
+
+    Returns:
+        bytes: Кадр ответа клиенту.
+    """
+    if not username or not password:
+        log.warning("Попытка входа с отсутствующим именем пользователя или паролем.")
+        _bad_requests.record(peer_host)
+        FAILED_AUTHS.inc()
+        return _ERR_MISSING_LOGIN
+    if not _credentials_valid(username, password):
+        log.warning("Попытка входа с недопустимыми именем пользователя или паролем.")
+        _bad_requests.record(peer_host)
+        FAILED_AUTHS.inc()
+        return _ERR_INVALID_CREDENTIALS
+    log.info("Обработка действия 'login' для пользователя '%s'.", username)
+    # Повторные входы обслуживаются кэшем результатов внутри UserService
+    log.debug("Вызов user_service.authenticate_user для пользователя '%s'.", username)
+    authenticated, detail = await user_service.authenticate_user(username, password)
+    log.info("Результат аутентификации для '%s': успех=%s, детали='%s'", username, authenticated, detail)
+
+    if authenticated:
+        SUCCESSFUL_AUTHS.inc()
+        return _frame({"status": "success", "message": detail, "token": username}) # detail уже на русском от user_service
+    FAILED_AUTHS.inc()
+    return _failure_frame(detail) # detail уже на русском от user_service
+
+async def _handle_register(user_service, username, password, log, peer_host):
+    """
+    Выполняет действие "register".
+
+    Returns:
+        bytes: Кадр ответа клиенту.
+    """
+    if not username or not password:
+        log.warning("Попытка регистрации с отсутствующим именем пользователя или паролем.")
+        _bad_requests.record(peer_host)
+        # Не инкрементируем FAILED_AUTHS здесь, т.к. это не неудачная попытка входа, а ошибка запроса.
+        # Однако, если считать это неудачной попыткой операции, можно и добавить. Пока не будем.
+        return _ERR_MISSING_REGISTER
+    if not _credentials_valid(username, password):
+        log.warning("Попытка регистрации с недопустимыми именем пользователя или паролем.")
+        _bad_requests.record(peer_host)
+        return _ERR_INVALID_REGISTER
+    log.info("Обработка действия 'register' для пользователя '%s'.", username)
+    # ВАЖНО: UserService.create_user ожидает ХЕШИРОВАННЫЙ пароль.
+    # Текущий tcp_handler получает сырой пароль.
+    # Для выполнения задачи "Проверь, что create_user вызывается с ("newuser", "newpassword")"
+    # мы передадим сырой пароль. Это означает, что либо UserService.create_user
+    # должен быть изменен для хеширования, либо этот handler должен хешировать пароль.
+    # Пока что, следуя тестовому требованию, передаем как есть.
+    # В реальной системе здесь должно быть хеширование пароля перед вызовом create_user.
+    # Например: password_hash = await hash_password_utility(password)
+    # И затем: created, detail = await user_service.create_user(username, password_hash)
+    log.debug("Вызов user_service.create_user для пользователя '%s'. Пароль будет передан как есть (в реальном сценарии должен быть хеширован).", username)
+    created, detail = await user_service.create_user(username, password) # Передаем сырой пароль
+    log.info("Результат регистрации для '%s': создано=%s, детали='%s'", username, created, detail)
+    if created:
+        # SUCCESSFUL_REGISTRATIONS.inc() # Потенциальная новая метрика
+        return _frame({"status": "success", "message": detail}) # detail уже на русском от user_service
+    # FAILED_REGISTRATIONS.inc() # Потенциальная новая метрика
+    return _failure_frame(detail) # detail уже на русском от user_service
+
+# Обработчики действий: один поиск в словаре вместо цепочки сравнений строк.
+# Каждый обработчик принимает (user_service, username, password, log, peer_host) и возвращает кадр ответа.
+_ACTIONS = {
+    "login": _handle_login,
+    "register": _handle_register,
+}
+
+def _prepare_request(data, log, peer_host):
+    """
+    Синхронная часть обработки строки запроса: быстрые проверки, разбор и выбор действия.
+
+    Все отказы (пустая строка, не JSON-объект, неверный JSON, неизвестное действие)
+    определяются здесь без await, поэтому AuthProtocol отвечает на них прямо в
+    buffer_updated, не создавая задачу. Некорректные запросы учитываются в _bad_requests.
+
+    Args:
+        data (bytes): Строка запроса (с завершающим переводом строки или без него).
+        log (logging.LoggerAdapter): Логгер соединения.
+        peer_host (str): IP клиента для учета некорректных запросов.
+
+    Returns:
+        bytes | tuple: Готовый кадр ответа об ошибке или (handler, username, password)
+            для _run_action.
     """
-    Обрабатывает входящее клиентское подключение для аутентификации.
+    # Сообщение остается в bytes: json/orjson сами декодируют UTF-8 при разборе,
+    # отдельные decode() и промежуточная str не нужны.
+    message = data.strip()
+
+    log.info("Получено обработанное сообщение: %r", message)
+
+    if not message:
+        log.warning("Пустое сообщение после обработки из сырых данных: %r.", data)
+        _bad_requests.record(peer_host)
+        return _ERR_EMPTY
+
+    # Быстрый отказ до разбора JSON: запрос - всегда объект с ключом "action".
+    # Срез и поиск подстроки в bytes выполняются в C и дешевле любого разбора.
+    # Строка без закрывающей "}" (обрезанный объект) отклоняется так же, без вызова парсера.
+    if message[:1] != b"{" or message[-1:] != b"}":
+        log.warning("Запрос не является JSON-объектом: %r", message)
+        _bad_requests.record(peer_host)
+        return _ERR_BAD_JSON if _is_utf8(message) else _ERR_UTF8
+    if b'"action"' not in message:
+        log.warning("В запросе отсутствует действие: %r", message)
+        _bad_requests.record(peer_host)
+        return _ERR_UNKNOWN_ACTION
+
+    try:
+        log.debug("Попытка разбора JSON: %r", message)
+        action, username, password = _parse_request(message)
+    except _DECODE_ERRORS as e:
+        # Некорректный UTF-8 проявляется как ошибка разбора; причину уточняем только здесь,
+        # в редком пути ошибки, а не декодированием каждого запроса.
+        _bad_requests.record(peer_host)
+        if _is_utf8(message):
+            log.error("Получен неверный JSON: %r", message, exc_info=True)
+            return _ERR_BAD_JSON
+        log.error("Ошибка декодирования Unicode: %s. Сырые данные могут быть не в UTF-8.", e, exc_info=True)
+        return _ERR_UTF8
+    except Exception as e: # Перехват других ошибок во время разбора
+        log.error("Ошибка обработки сообщения: %s", e, exc_info=True)
+        return _ERR_INTERNAL
 
-    Читает данные от клиента, ожидает JSON-сообщение с действием (login/register),
-    обрабатывает его и отправляет ответ. Обновляет метрики Prometheus.
+    log.info("Разобранный запрос: действие '%s', пользователь '%s'", action, username)
+
+    # action может оказаться списком или объектом (валидный JSON): такие значения не хешируются
+    handler = _ACTIONS.get(action) if type(action) is str else None
+    if handler is None:
+        log.warning("Неизвестное или отсутствующее действие: '%s'.", action)
+        _bad_requests.record(peer_host)
+        # FAILED_AUTHS.inc() # Можно считать это ошибкой запроса, а не неудачным входом
+        return _ERR_UNKNOWN_ACTION
+    return handler, username, password
+
+async def _run_action(prepared, user_service, log, peer_host):
+    """
+    Выполняет действие, выбранное _prepare_request, и возвращает кадр ответа.
 
     Args:
-        reader: Объект asyncio.StreamReader для чтения данных от клиента.
-        writer: Объект asyncio.StreamWriter для отправки данных клиенту.
+        prepared (tuple): (handler, username, password) из _prepare_request.
+        user_service (UserService): Сервис пользователей.
+        log (logging.LoggerAdapter): Логгер соединения.
+        peer_host (str): IP клиента для учета некорректных запросов.
+
+    Returns:
+        bytes: Кадр ответа.
     """
-    addr = writer.get_extra_info('peername') # Получаем адрес клиента
-    logger.info(f"Новое соединение от {addr}, ожидается JSON.")
-    ACTIVE_CONNECTIONS_AUTH.inc()
+    handler, username, password = prepared
     try:
-        logger.debug(f"handle_auth_client: [{addr}] Ожидание данных от клиента с таймаутом {CLIENT_READ_TIMEOUT}с.")
-        data = await asyncio.wait_for(reader.readuntil(b"\n"), timeout=CLIENT_READ_TIMEOUT)
-        logger.debug(f"handle_auth_client: [{addr}] Получены сырые данные: {data!r}")
-        message = data.decode('utf-8').strip()
-        
-        logger.info(f"handle_auth_client: [{addr}] Получено обработанное сообщение: '{message}'")
-
-        if not message:
-            logger.warning(f"handle_auth_client: [{addr}] Пустое сообщение после обработки из сырых данных: {data!r}.")
-            response_payload = {"status": "error", "message": "Получено пустое сообщение"}
-            writer.write(json.dumps(response_payload).encode('utf-8') + b'\n')
-            await writer.drain()
+        return await handler(user_service, username, password, log, peer_host)
+    except Exception as e: # Перехват ошибок во время выполнения действия
+        log.error("Ошибка обработки сообщения: %s", e, exc_info=True)
+        return _ERR_INTERNAL
+
+class AuthProtocol(asyncio.BufferedProtocol):
+    """
+    Обработчик соединения на уровне протокола asyncio, без StreamReader/StreamWriter.
+
+    Цикл событий читает данные прямо в заранее выделенный буфер соединения
+    (get_buffer/buffer_updated): нет растущего bytearray StreamReader и копирования строки
+    из него. Размер буфера - MAX_AUTH_MESSAGE, поэтому запрос длиннее лимита отклоняется
+    без дополнительных выделений. Отказы определяет синхронный _prepare_request,
+    действие выполняет _run_action в отдельной задаче.
+
+    Создается через functools.partial(AuthProtocol, user_service) в loop.create_server().
+    """
+
+    def __init__(self, user_service):
+        self.user_service = user_service
+        self.transport = None
+        self.log = None
+        self.peer_host = None
+        self._buffer = None
+        self._view = None
+        self._pos = 0 # Сколько байт буфера заполнено
+        self._timeout_handle = None
+        self._received = False # Строка запроса получена
+        self._task = None # Задача выполнения действия (только если ответ требует await)
+        self._discard = False # Запрос отклонен как слишком длинный: остаток ввода отбрасывается
+        self._closed = False # close() транспорта уже вызван или соединение потеряно
+
+    def connection_made(self, transport):
+        self.transport = transport
+        addr = transport.get_extra_info('peername')
+        self.peer_host = addr[0] if isinstance(addr, tuple) else addr # Ограничение ведется по IP, без порта
+        if _bad_requests.is_blocked(self.peer_host):
+            # Клиент превысил лимит некорректных запросов: сбрасываем соединение без чтения и ответа
+            logger.debug("Соединение от %s сброшено: превышен лимит некорректных запросов.", addr)
+            transport.abort()
+            return
+        if not _admit_connection():
+            logger.debug("Соединение от %s отклонено: обслуживается %d соединений.", addr, MAX_CONNECTIONS)
+            self._view = _DISCARD_VIEW
+            self._reply_and_discard(_ERR_BUSY)
+            if not self._closed:
+                self._timeout_handle = asyncio.get_running_loop().call_later(REJECT_LINGER, self._on_timeout)
             return
+        self.log = _PeerLoggerAdapter(logger, {"peer": addr})
+        self.log.info("Новое соединение, ожидается JSON.")
+        ACTIVE_CONNECTIONS_AUTH.inc()
+        self._buffer = bytearray(MAX_AUTH_MESSAGE)
+        self._view = memoryview(self._buffer)
+        self._timeout_handle = asyncio.get_running_loop().call_later(CLIENT_READ_TIMEOUT, self._on_timeout)
 
-        try:
-            logger.debug(f"handle_auth_client: [{addr}] Попытка разбора JSON: '{message}'")
-            payload = json.loads(message)
-            action = payload.get("action")
-            username = payload.get("username")
-            password = payload.get("password") # Для register это будет сырой пароль
-
-            logger.info(f"handle_auth_client: [{addr}] Разобранная полезная нагрузка: {payload}, Действие: '{action}'")
-
-            response = {}
-            if action == "login":
-                if not username or not password:
-                    logger.warning(f"handle_auth_client: [{addr}] Попытка входа с отсутствующим именем пользователя или паролем.")
-                    FAILED_AUTHS.inc()
-                    response = {"status": "failure", "message": "Отсутствует имя пользователя или пароль для входа."}
-                else:
-                    logger.info(f"handle_auth_client: [{addr}] Обработка действия 'login' для пользователя '{username}'.")
-                    logger.debug(f"handle_auth_client: [{addr}] Вызов user_service.authenticate_user для пользователя '{username}'.")
-                    # Используем экземпляр user_service
-                    authenticated, detail = await user_service.authenticate_user(username, password)
-                    logger.info(f"handle_auth_client: [{addr}] Результат аутентификации для '{username}': успех={authenticated}, детали='{detail}'")
-
-                    if authenticated:
-                        SUCCESSFUL_AUTHS.inc()
-                        response = {"status": "success", "message": detail, "token": username} # detail уже на русском от user_service
-                    else:
-                        FAILED_AUTHS.inc()
-                        response = {"status": "failure", "message": detail} # detail уже на русском от user_service
-
-            elif action == "register":
-                if not username or not password:
-                    logger.warning(f"handle_auth_client: [{addr}] Попытка регистрации с отсутствующим именем пользователя или паролем.")
-                    # Не инкрементируем FAILED_AUTHS здесь, т.к. это не неудачная попытка входа, а ошибка запроса.
-                    # Однако, если считать это неудачной попыткой операции, можно и добавить. Пока не будем.
-                    response = {"status": "error", "message": "Отсутствует имя пользователя или пароль для регистрации."}
-                else:
-                    logger.info(f"handle_auth_client: [{addr}] Обработка действия 'register' для пользователя '{username}'.")
-                    # ВАЖНО: UserService.create_user ожидает ХЕШИРОВАННЫЙ пароль.
-                    # Текущий tcp_handler получает сырой пароль.
-                    # Для выполнения задачи "Проверь, что create_user вызывается с ("newuser", "newpassword")"
-                    # мы передадим сырой пароль. Это означает, что либо UserService.create_user
-                    # должен быть изменен для хеширования, либо этот handler должен хешировать пароль.
-                    # Пока что, следуя тестовому требованию, передаем как есть.
-                    # В реальной системе здесь должно быть хеширование пароля перед вызовом create_user.
-                    # Например: password_hash = await hash_password_utility(password)
-                    # И затем: created, detail = await user_service.create_user(username, password_hash)
-                    logger.debug(f"handle_auth_client: [{addr}] Вызов user_service.create_user для пользователя '{username}'. Пароль будет передан как есть (в реальном сценарии должен быть хеширован).")
-                    created, detail = await user_service.create_user(username, password) # Передаем сырой пароль
-                    logger.info(f"handle_auth_client: [{addr}] Результат регистрации для '{username}': создано={created}, детали='{detail}'")
-                    if created:
-                        # SUCCESSFUL_REGISTRATIONS.inc() # Потенциальная новая метрика
-                        response = {"status": "success", "message": detail} # detail уже на русском от user_service
-                    else:
-                        # FAILED_REGISTRATIONS.inc() # Потенциальная новая метрика
-                        response = {"status": "failure", "message": detail} # detail уже на русском от user_service
-            else:
-                logger.warning(f"handle_auth_client: [{addr}] Неизвестное или отсутствующее действие: '{action}'.")
-                # FAILED_AUTHS.inc() # Можно считать это ошибкой запроса, а не неудачным входом
-                response = {"status": "error", "message": "Неизвестное или отсутствующее действие"}
-            
-            response_str = json.dumps(response) + "\n"
-            logger.info(f"handle_auth_client: [{addr}] Отправка ответа: {response_str.strip()}")
-            writer.write(response_str.encode('utf-8'))
-            await writer.drain()
-
-        except json.JSONDecodeError:
-            logger.error(f"handle_auth_client: [{addr}] Получен неверный JSON: {message}", exc_info=True)
-            error_response = {"status": "error", "message": "Неверный формат JSON"}
-            writer.write(json.dumps(error_response).encode('utf-8') + b'\n')
-            await writer.drain()
-            # Здесь нет return, очистка будет в finally. FAILED_AUTHS может быть релевантен.
-        except Exception as e: # Перехват других ошибок во время обработки полезной нагрузки или действия
-            logger.error(f"handle_auth_client: [{addr}] Ошибка обработки сообщения: {e}", exc_info=True)
-            error_response = {"status": "error", "message": "Внутренняя ошибка сервера при обработке"}
-            if not writer.is_closing():
-                try:
-                    writer.write(json.dumps(error_response).encode('utf-8') + b'\n')
-                    await writer.drain()
-                except Exception as ex_send:
-                    logger.error(f"handle_auth_client: [{addr}] Не удалось отправить ответ об ошибке во время общего исключения: {ex_send}", exc_info=True)
-            # Здесь нет return, очистка будет в finally.
-
-    except asyncio.TimeoutError: # Специально для таймаута reader.readuntil
-        logger.warning(f"handle_auth_client: [{addr}] Таймаут ожидания сообщения от клиента ({CLIENT_READ_TIMEOUT}с).")
-        # Попытка отправить ответ о таймауте, если writer все еще открыт
-        if not writer.is_closing():
-            try:
-                error_response = {"status": "error", "message": "Таймаут запроса"}
-                writer.write(json.dumps(error_response).encode('utf-8') + b'\n')
-                await writer.drain()
-            except Exception as ex_send:
-                logger.error(f"handle_auth_client: [{addr}] Не удалось отправить ответ об ошибке таймаута: {ex_send}", exc_info=True)
-    except asyncio.IncompleteReadError as e:
-        logger.warning(f"handle_auth_client: [{addr}] Незавершенное чтение. Клиент преждевременно закрыл соединение. Частичные данные: {e.partial!r}", exc_info=True)
-    except ConnectionResetError as e:
-        logger.warning(f"handle_auth_client: [{addr}] Соединение сброшено клиентом.", exc_info=True)
-    except UnicodeDecodeError as ude: 
-        logger.error(f"handle_auth_client: [{addr}] Ошибка декодирования Unicode: {ude}. Сырые данные могут быть не в UTF-8.", exc_info=True)
-        if not writer.is_closing():
-            try:
-                error_response = {"status":"error", "message":"Неверная кодировка символов. Ожидается UTF-8."}
-                writer.write(json.dumps(error_response).encode('utf-8') + b'\n')
-                await writer.drain()
-            except Exception as ex_send:
-                logger.error(f"handle_auth_client: [{addr}] Не удалось отправить ответ об ошибке UnicodeDecodeError: {ex_send}", exc_info=True)
-    except Exception as e:
-        logger.critical(f"handle_auth_client: [{addr}] Критическая ошибка в обработчике: {e}", exc_info=True)
-        if not writer.is_closing():
+    def get_buffer(self, sizehint):
+        return self._view[self._pos:]
+
+    def buffer_updated(self, nbytes):
+        if self._discard:
+            self._pos = 0
+            return
+        start = self._pos
+        self._pos += nbytes
+        end = self._buffer.find(b"\n", start, self._pos)
+        if end >= 0:
+            # Один запрос на соединение: остаток после перевода строки не читается
+            self._stop_reading()
+            self._received = True
+            data = bytes(self._view[:end + 1])
+            self.log.debug("Получены сырые данные: %r", data)
             try:
-                error_response = {"status": "error", "message": "Критическая внутренняя ошибка сервера"}
-                writer.write(json.dumps(error_response).encode('utf-8') + b'\n')
-                await writer.drain()
-            except Exception as ex_send:
-                logger.error(f"handle_auth_client: [{addr}] Не удалось отправить ответ о критической ошибке: {ex_send}", exc_info=True)
-    finally:
-        logger.info(f"handle_auth_client: [{addr}] Закрытие соединения.")
+                prepared = _prepare_request(data, self.log, self.peer_host)
+            except Exception as e: # Исключение из buffer_updated оборвало бы соединение без ответа
+                self.log.error("Ошибка обработки сообщения: %s", e, exc_info=True)
+                prepared = _ERR_INTERNAL
+            if type(prepared) is bytes:
+                # Отказ определен синхронно: ответ без задачи и без переключения корутин
+                self.log.info("Отправка ответа: %r", prepared)
+                self._reply_and_close(prepared)
+            else:
+                self._task = asyncio.ensure_future(self._respond(prepared))
+        elif self._pos == len(self._buffer):
+            # Строка запроса длиннее MAX_AUTH_MESSAGE: остаток отбрасывается до EOF клиента или до таймаута
+            self.log.warning("Запрос превышает %d байт.", MAX_AUTH_MESSAGE)
+            _bad_requests.record(self.peer_host)
+            self._reply_and_discard(_ERR_TOO_LARGE)
+
+    def eof_received(self):
+        if self._discard:
+            return False
+        if self._received:
+            return True # Запрос уже получен: клиент закрыл только свою сторону, ответ еще отправляется
+        self.log.warning("Незавершенное чтение. Клиент преждевременно закрыл соединение. Частичные данные: %r",
+                         bytes(self._view[:self._pos]))
+        return False # Транспорт закрывается
+
+    def connection_lost(self, exc):
+        self._closed = True
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
+        if self.log is None: # Соединение было отклонено в connection_made
+            return
+        _release_connection()
+        if exc is not None and not self._received:
+            self.log.warning("Соединение сброшено клиентом.")
+        self.log.info("Закрытие соединения.")
         ACTIVE_CONNECTIONS_AUTH.dec()
-        if writer and not writer.is_closing(): 
-            logger.debug(f"handle_auth_client: [{addr}] Фактическое закрытие writer сейчас.")
-            writer.close()
-            try:
-                await writer.wait_closed()
-            except Exception as e_close: 
-                logger.error(f"handle_auth_client: [{addr}] Ошибка во время writer.wait_closed(): {e_close}", exc_info=True)
-        logger.debug(f"handle_auth_client: [{addr}] Соединение с {addr} полностью закрыто.")
+        self._view.release()
+
+    def _stop_reading(self):
+        """Прекращает чтение и отменяет таймаут ожидания запроса."""
+        self.transport.pause_reading()
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
+
+    def _on_timeout(self):
+        self._timeout_handle = None
+        if self._discard:
+            self._close()
+            return
+        self.log.warning("Таймаут ожидания сообщения от клиента (%sс).", CLIENT_READ_TIMEOUT)
+        _bad_requests.record(self.peer_host)
+        self.transport.pause_reading()
+        self._reply_and_close(_ERR_TIMEOUT)
+
+    def _close(self):
+        """Закрывает транспорт один раз: флаг вместо вызова is_closing() на каждом пути закрытия."""
+        if not self._closed:
+            self._closed = True
+            self.transport.close()
+
+    def _reply_and_discard(self, frame):
+        """
+        Отправляет кадр и FIN, а непрочитанный ввод клиента читает и отбрасывает.
+
+        Закрытие сокета с непрочитанными данными отправило бы RST, и клиент мог не получить
+        ответ, поэтому соединение закрывается по EOF клиента (eof_received) или по таймеру.
+        """
+        self._discard = True
+        self._pos = 0
+        self.transport.write(frame)
+        if self.transport.can_write_eof():
+            self.transport.write_eof()
+        else:
+            self._close()
+
+    def _reply_and_close(self, frame):
+        """
+        Отправляет кадр и закрывает соединение; после закрытия или потери соединения ничего не делает.
+
+        close() транспорта дожидается отправки буфера записи, поэтому drain() не нужен.
+        """
+        if self._closed:
+            return
+        self.transport.write(frame)
+        self._close()
+
+    async def _respond(self, prepared):
+        """
+        Выполняет действие и отправляет ответ через _reply_and_close - единственный путь записи.
+
+        Соединение закрывается при любом исходе, в том числе при отмене задачи
+        (остановка сервера): иначе дескриптор сокета оставался бы открытым.
+        """
+        frame = None
+        try:
+            frame = await _run_action(prepared, self.user_service, self.log, self.peer_host)
+            self.log.info("Отправка ответа: %r", frame)
+        except Exception as e:
+            self.log.critical("Критическая ошибка в обработчике: %s", e, exc_info=True)
+            frame = _ERR_CRITICAL
+        finally:
+            if frame is None: # Задача отменена: ответа нет, но соединение закрывается
+                self._close()
+        self._reply_and_close(frame)
@@ -3,12 +3,23 @@
 # такие как аутентификация и регистрация.
 # В текущей реализации используется mock-база данных.
 import asyncio
+import functools
+import hashlib
+import hmac
+import json
+import os
+import time
 import logging # Добавлен импорт для логирования
 
+from auth_server.auth_cache import TTLCache
+from auth_server.kdf import pbkdf2_sha256, verify_password
+from core.redis_client import RedisClient
+
 logger = logging.getLogger(__name__) # Инициализация логгера для этого модуля
 
 # MOCK_USERS_DB: Заглушка для базы данных пользователей.
-# Ключ - имя пользователя (строка), значение - пароль (строка).
+# Ключ - имя пользователя (строка), значение - пароль (строка) или хеш pbkdf2-sha256
+# в формате passlib (так сохраняются пользователи, зарегистрированные через gRPC).
 # Эта структура данных используется для имитации хранения учетных записей.
 # В реальном приложении здесь было бы взаимодействие с настоящей базой данных (например, PostgreSQL).
 MOCK_USERS_DB = {
@@ -19,25 +30,208 @@ MOCK_USERS_DB = {
     "integ_user2": "integ_pass2"      # Пользователь для интеграционного теста test_08 (чат)
 }
 
+# Имитация задержки обращения к БД, секунд (для нагрузочных и хаос-тестов). По умолчанию 0:
+# MOCK_USERS_DB - словарь в памяти, и фиксированная задержка лишь ограничивала пропускную способность.
+SIMULATED_DB_LATENCY = float(os.getenv("AUTH_SIMULATE_LATENCY", "0"))
+
+# Пределы длины учетных данных. Серверы (gRPC и TCP) отклоняют более длинные значения
+# до обращения к кэшам и KDF, и поток мусорных запросов не доходит до PBKDF2.
+MAX_USERNAME_LENGTH = 64
+MAX_PASSWORD_LENGTH = 256
+
+# Общий результат для попытки создать существующего пользователя (не создается заново на каждый вызов).
+_USER_EXISTS = (False, "Пользователь с таким именем уже существует.")
+
+def _plain_digest(value):
+    """BLAKE2b-128 от строки: значения фиксированной длины для сравнения за постоянное время."""
+    return hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+
+# Дайджесты сохраненных паролей в открытом виде вычисляются один раз на значение
+_stored_digest = functools.lru_cache(maxsize=1024)(_plain_digest)
+
+async def _password_matches(password, stored):
+    """
+    Сравнивает пароль с сохраненным значением.
+
+    Хеши pbkdf2-sha256 проверяются через KDF в пуле процессов, остальные записи
+    (тестовые пользователи с паролями в открытом виде) сравниваются напрямую.
+    """
+    if pbkdf2_sha256.identify(stored):
+        try:
+            return await verify_password(password, stored)
+        except ValueError:
+            logger.error("Malformed password hash in user storage.")
+            return False
+    if not isinstance(password, str): # Из JSON может прийти число или null
+        return False
+    # Сравниваются дайджесты одинаковой длины: время не зависит ни от позиции первого
+    # несовпадающего символа, ни от длины сохраненного пароля (compare_digest для строк
+    # разной длины завершается сразу).
+    return hmac.compare_digest(_stored_digest(stored), _plain_digest(password))
+
+# Кэш результатов authenticate_user. Единственный кэш результатов входа, общий для TCP- и gRPC-серверов;
+# все его уровни сбрасывает UserService.invalidate(username).
+# 1. В памяти процесса: повторный вход с тем же паролем (переподключение игрового клиента)
+#    обслуживается поиском в словаре, без сетевого обращения и проверки пароля.
+# 2. В Redis (если задан shared_cache): результат, полученный одним процессом или экземпляром
+#    сервера, используют остальные.
+# Результат хранится по паре (имя пользователя, BLAKE2b с секретом от пароля): пароль в открытом виде
+# не хранится, а неудачная попытка с другим паролем не вытесняет кэшированный успешный вход.
+# В памяти процесса ключ дополнен номером поколения пользователя, который увеличивает invalidate().
+# В Redis у пользователя одна запись "auth:<username>" - словарь дайджест -> результат, поэтому
+# invalidate(username) удаляет все результаты пользователя одной операцией DEL.
+# Неудачи кэшируются на короткое время: повтор того же неверного пароля не доходит до KDF,
+# но подбор разных паролей все равно проверяется каждый раз.
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_USER_CACHE_SIZE", "10000")) # 0 - отключен
+AUTH_CACHE_TTL = float(os.getenv("AUTH_USER_CACHE_TTL", "60")) # секунд, для успешных проверок
+AUTH_CACHE_NEGATIVE_TTL = float(os.getenv("AUTH_USER_CACHE_NEGATIVE_TTL", "5")) # секунд, для неудачных
+AUTH_CACHE_KEY_PREFIX = "auth:" # Ключи Redis: "auth:<username>"
+# Сколько дайджестов хранится в записи Redis одного пользователя; при переполнении первыми
+# вытесняются неудачные результаты, успешный вход сохраняется.
+AUTH_CACHE_MAX_PER_USER = int(os.getenv("AUTH_USER_CACHE_MAX_PER_USER", "8"))
+
+def _load_auth_cache_key():
+    """
+    Возвращает ключ BLAKE2b для дайджестов паролей в кэше результатов.
+
+    Берется из переменной окружения AUTH_CACHE_SECRET, чтобы несколько процессов и экземпляров
+    сервера понимали записи друг друга в Redis. Если переменная не задана, генерируется случайный
+    ключ процесса (записи Redis, сделанные другими процессами, тогда просто не совпадут).
+    """
+    secret = os.getenv("AUTH_CACHE_SECRET")
+    if secret:
+        return hashlib.sha256(secret.encode('utf-8')).digest() # BLAKE2b принимает ключ до 64 байт
+    return os.urandom(32)
+
+_AUTH_CACHE_KEY = _load_auth_cache_key()
+
+def _cache_digest(password):
+    """Возвращает ключевой BLAKE2b-128 пароля (значение для сравнения в кэше результатов)."""
+    return hashlib.blake2b(password.encode('utf-8', 'surrogatepass'), key=_AUTH_CACHE_KEY, digest_size=16).digest()
+
 class UserService:
     """
     Сервис для управления пользователями, включая аутентификацию и регистрацию.
     """
 
-    def __init__(self):
-        # В будущем здесь может быть инициализация клиента к Redis или другой БД
+    # Общий асинхронный клиент Redis (redis.asyncio с одним пулом соединений на процесс).
+    # Создается один раз в initialize_redis_client() и разделяется всеми экземплярами и корутинами.
+    redis_client = None
+
+    def __init__(self, shared_cache=None):
+        """
+        Args:
+            shared_cache (RedisClient, optional): Клиент Redis для общего уровня кэша
+                результатов входа. None - только кэш в памяти процесса.
+        """
+        # Свой кэш у каждого экземпляра; серверы разделяют один экземпляр (get_user_service)
+        self._auth_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+        # username -> поколение записей кэша процесса; меняется только в invalidate()
+        self._cache_generations = {}
+        self.shared_cache = shared_cache
         logger.info("UserService instance created.")
 
-    @staticmethod
-    def initialize_redis_client():
+    async def invalidate(self, username):
         """
-        Инициализирует клиент Redis.
-        В данной реализации это заглушка.
+        Удаляет кэшированный результат проверки пароля пользователя на всех уровнях кэша.
+
+        Вызывается при создании пользователя и должен вызываться при смене пароля,
+        чтобы старый результат не использовался до истечения TTL.
+        Ошибки Redis только логируются.
         """
-        # В будущем здесь будет реальная инициализация клиента Redis,
-        # например, создание пула соединений.
-        logger.info("UserService.initialize_redis_client() called. (Currently a stub)")
-        pass
+        # Старые записи процесса становятся недоступны и вытесняются по TTL или LRU
+        self._cache_generations[username] = self._cache_generations.get(username, 0) + 1
+        if self.shared_cache is None:
+            return
+        try:
+            await self.shared_cache.delete(f"{AUTH_CACHE_KEY_PREFIX}{username}")
+        except Exception as e:
+            logger.warning("Failed to invalidate auth cache entry: %s", e)
+
+    def _local_key(self, username, digest):
+        """Ключ кэша процесса: (имя, поколение пользователя, дайджест пароля)."""
+        return username, self._cache_generations.get(username, 0), digest
+
+    async def _load_shared_entries(self, username):
+        """
+        Возвращает словарь дайджест (hex) -> [authenticated, message, expires_at] из Redis.
+
+        None - Redis недоступен; пустой словарь - записи нет или она повреждена.
+        Ошибки Redis не должны ломать аутентификацию, поэтому они только логируются.
+        """
+        try:
+            cached = await self.shared_cache.get(f"{AUTH_CACHE_KEY_PREFIX}{username}")
+        except Exception as e:
+            logger.warning("Auth cache lookup failed, falling back to full verification: %s", e)
+            return None
+        if cached is None:
+            return {}
+        try:
+            entries = json.loads(cached)
+        except (ValueError, TypeError):
+            entries = None
+        if not isinstance(entries, dict):
+            logger.warning("Malformed auth cache entry for user %r, ignoring.", username)
+            return {}
+        return entries
+
+    async def _get_shared_result(self, username, digest):
+        """Возвращает результат для пароля с дайджестом digest из общего кэша Redis или None."""
+        entries = await self._load_shared_entries(username)
+        entry = entries.get(digest.hex()) if entries else None
+        try:
+            authenticated, message, expires_at = entry
+        except (ValueError, TypeError):
+            return None # Результата для этого пароля нет
+        if not isinstance(expires_at, (int, float)) or expires_at <= time.time():
+            return None
+        return bool(authenticated), message
+
+    async def _store_shared_result(self, username, digest, result, ttl):
+        """
+        Добавляет результат в запись пользователя в общем кэше Redis (ошибки только логируются).
+
+        Устаревшие результаты удаляются, а при превышении AUTH_CACHE_MAX_PER_USER вытесняются
+        самые старые неудачные: поток неверных паролей не вытесняет успешный вход.
+        Одновременные записи могут потерять результат друг друга - это лишь промах кэша.
+        """
+        entries = await self._load_shared_entries(username)
+        if entries is None:
+            return
+        now = time.time()
+        entries = {
+            digest_hex: entry for digest_hex, entry in entries.items()
+            if isinstance(entry, list) and len(entry) == 3
+            and isinstance(entry[2], (int, float)) and entry[2] > now
+        }
+        entries[digest.hex()] = [result[0], result[1], now + ttl]
+        if len(entries) > AUTH_CACHE_MAX_PER_USER:
+            failures = sorted((entry[2], digest_hex) for digest_hex, entry in entries.items() if not entry[0])
+            for _, digest_hex in failures[:len(entries) - AUTH_CACHE_MAX_PER_USER]:
+                del entries[digest_hex]
+        expires_in = max(entry[2] for entry in entries.values()) - now
+        try:
+            await self.shared_cache.set(f"{AUTH_CACHE_KEY_PREFIX}{username}",
+                                        json.dumps(entries), ex=max(1, int(expires_in)))
+        except Exception as e:
+            logger.warning("Failed to store auth result in cache: %s", e)
+
+    @classmethod
+    def initialize_redis_client(cls):
+        """
+        Инициализирует общий клиент Redis.
+
+        Используется singleton RedisClient из core.redis_client: один пул соединений
+        redis.asyncio (размер - REDIS_MAX_CONNECTIONS) на процесс. Синхронный клиент
+        redis.Redis на пути обработки запросов не используется, чтобы не блокировать цикл событий.
+
+        Returns:
+            RedisClient: Общий клиент Redis.
+        """
+        if cls.redis_client is None:
+            cls.redis_client = RedisClient()
+            logger.info("UserService Redis client initialized.")
+        return cls.redis_client
 
     async def authenticate_user(self, username, password):
         """
@@ -55,18 +249,46 @@ class UserService:
                               (True при успехе, False при неудаче), а второй -
                               сообщение о результате аутентификации.
         """
-        logger.debug(f"Attempting to authenticate user '{username}' using MOCK_USERS_DB.")
-
-        await asyncio.sleep(0.01) # Имитация небольшой задержки, как при обращении к БД.
-
-        if username in MOCK_USERS_DB and MOCK_USERS_DB[username] == password:
-            logger.info(f"User '{username}' authenticated successfully.")
+        digest = None
+        if type(username) is str and type(password) is str:
+            digest = _cache_digest(password)
+            cached = self._auth_cache.get(self._local_key(username, digest))
+            if cached is not None:
+                logger.debug("Authentication result for user '%s' served from cache.", username)
+                return cached
+            if self.shared_cache is not None:
+                result = await self._get_shared_result(username, digest)
+                if result is not None:
+                    logger.debug("Authentication result for user '%s' served from shared cache.", username)
+                    self._auth_cache.set(self._local_key(username, digest), result,
+                                         ttl=AUTH_CACHE_TTL if result[0] else AUTH_CACHE_NEGATIVE_TTL)
+                    return result
+        # Поколение фиксируется до проверки: invalidate() во время проверки отбрасывает ее результат
+        local_key = self._local_key(username, digest) if digest is not None else None
+        result = await self._check_credentials(username, password)
+        if digest is not None:
+            ttl = AUTH_CACHE_TTL if result[0] else AUTH_CACHE_NEGATIVE_TTL
+            self._auth_cache.set(local_key, result, ttl=ttl)
+            if self.shared_cache is not None:
+                await self._store_shared_result(username, digest, result, ttl)
+        return result
+
+    async def _check_credentials(self, username, password):
+        """Проверяет учетные данные по MOCK_USERS_DB без кэша (см. authenticate_user)."""
+        logger.debug("Attempting to authenticate user '%s' using MOCK_USERS_DB.", username)
+
+        if SIMULATED_DB_LATENCY: # Имитация задержки обращения к БД (AUTH_SIMULATE_LATENCY)
+            await asyncio.sleep(SIMULATED_DB_LATENCY)
+
+        stored = MOCK_USERS_DB.get(username)
+        if stored is not None and await _password_matches(password, stored):
+            logger.info("User '%s' authenticated successfully.", username)
             return True, f"Пользователь {username} успешно аутентифицирован."
-        elif username in MOCK_USERS_DB:
-            logger.warning(f"Failed authentication attempt for user '{username}': incorrect password.")
+        elif stored is not None:
+            logger.warning("Failed authentication attempt for user '%s': incorrect password.", username)
             return False, "Неверный пароль."
         else:
-            logger.warning(f"Failed authentication attempt: user '{username}' not found.")
+            logger.warning("Failed authentication attempt: user '%s' not found.", username)
             return False, "Пользователь не найден."
 
     async def register_user(self, username, password_hash): # Изменено имя параметра для ясности
@@ -86,17 +308,19 @@ class UserService:
                               (True при успехе регистрации, False при неудаче),
                               а второй - сообщение о результате.
         """
-        logger.debug(f"Attempting to register new user '{username}'.")
-        await asyncio.sleep(0.01) # Имитация задержки обращения к БД.
+        logger.debug("Attempting to register new user '%s'.", username)
+        if SIMULATED_DB_LATENCY: # Имитация задержки обращения к БД (AUTH_SIMULATE_LATENCY)
+            await asyncio.sleep(SIMULATED_DB_LATENCY)
 
         if username in MOCK_USERS_DB:
-            logger.warning(f"Attempt to register existing user '{username}'.")
+            logger.warning("Attempt to register existing user '%s'.", username)
             return False, "Пользователь с таким именем уже существует."
 
         # В реальном приложении здесь было бы сохранение в БД.
         # MOCK_USERS_DB используется для простоты примера.
         MOCK_USERS_DB[username] = password_hash # Сохраняем хеш пароля
-        logger.info(f"User '{username}' successfully registered and added to MOCK_USERS_DB with hashed password.")
+        await self.invalidate(username) # Кэшированный результат "пользователь не найден" больше неверен
+        logger.info("User '%s' successfully registered and added to MOCK_USERS_DB with hashed password.", username)
         return True, f"Пользователь {username} успешно зарегистрирован."
 
     # Для совместимости с auth_grpc_server.py, который ожидает create_user,
@@ -114,7 +338,7 @@ class UserService:
         Алиас для register_user, чтобы соответствовать ожиданиям auth_grpc_server.py.
         Регистрирует нового пользователя с хешированным паролем.
         """
-        logger.info(f"create_user called for {username}, redirecting to register_user logic.")
+        logger.info("create_user called for %s, redirecting to register_user logic.", username)
         # Поскольку register_user был переименован в create_user, этот метод больше не нужен как отдельный.
         # Вместо этого, я переименовал `register_user` в `create_user` напрямую.
         # Этот комментарий оставлен для истории правок.
@@ -129,20 +353,33 @@ class UserService:
         # logger.debug(f"Attempting to create new user '{username}'.")
         # await asyncio.sleep(0.01)
 
+        # Между проверкой и записью нет await, поэтому две регистрации одного имени не пересекаются.
         if username in MOCK_USERS_DB:
-            logger.warning(f"Attempt to create existing user '{username}'.")
-            return False, "Пользователь с таким именем уже существует."
+            logger.warning("Attempt to create existing user '%s'.", username)
+            return _USER_EXISTS
+        MOCK_USERS_DB[username] = password_hash # Сохраняем хеш пароля
+        await self.invalidate(username) # Кэшированный результат "пользователь не найден" больше неверен
 
-        MOCK_USERS_DB[username] = password_hash
-        logger.info(f"User '{username}' successfully created and added to MOCK_USERS_DB with hashed password.")
+        logger.info("User '%s' successfully created and added to MOCK_USERS_DB with hashed password.", username)
         return True, f"Пользователь {username} успешно создан."
 
+@functools.lru_cache(maxsize=1)
+def get_user_service():
+    """
+    Возвращает общий экземпляр UserService процесса, создавая его при первом вызове.
+
+    TCP- и gRPC-серверы и устаревшие глобальные функции используют один экземпляр
+    (и одно общее состояние сервиса). Тесты могут подменить его через
+    get_user_service.cache_clear() или передать свой экземпляр обработчику явно.
+    """
+    return UserService()
+
 # Для обратной совместимости, если какой-то старый код все еще вызывает глобальные функции.
 # Однако, лучше обновить весь код для использования UserService.
 # Эти функции теперь являются устаревшими и будут удалены в будущем.
 async def authenticate_user(username, password):
     logger.warning("Deprecated: Called global authenticate_user. Use UserService instance instead.") # Устарело: Вызвана глобальная функция authenticate_user. Используйте экземпляр UserService.
-    service = UserService()
+    service = get_user_service()
     return await service.authenticate_user(username, password)
 
 async def register_user(username, password): # Оригинальный register_user принимал сырой пароль
@@ -150,15 +387,17 @@ async def register_user(username, password): # Оригинальный register
     # Эта функция не может быть просто прокси, так как create_user ожидает хешированный пароль.
     # Оставляем ее как есть, но с предупреждением.
     # Для простоты, предположим, что старый register_user не хешировал пароль и добавлял как есть.
-    await asyncio.sleep(0.01)
+    if SIMULATED_DB_LATENCY:
+        await asyncio.sleep(SIMULATED_DB_LATENCY)
     if username in MOCK_USERS_DB:
         return False, "Пользователь с таким именем уже существует (устаревший глобальный вызов)."
     MOCK_USERS_DB[username] = password # Сохраняем как есть, имитируя старое поведение
+    await get_user_service().invalidate(username)
     return True, f"Пользователь {username} успешно зарегистрирован (устаревший глобальный вызов)."
 
 async def create_user(username, password_hash): # Добавим и create_user для полноты
     logger.warning("Deprecated: Called global create_user. Use UserService instance instead.") # Устарело: Вызвана глобальная функция create_user. Используйте экземпляр UserService.
-    service = UserService()
+    service = get_user_service()
     return await service.create_user(username, password_hash)
 
 # Пример использования (если этот файл запускается напрямую, что маловероятно для сервиса)
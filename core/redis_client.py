@@ -71,13 +71,20 @@ class RedisClient:
                 # Конфигурация для реального клиента Redis
                 self.redis_host = os.getenv("REDIS_HOST", "redis-service") # Хост Redis, по умолчанию "redis-service" (для K8s)
                 self.redis_port = int(os.getenv("REDIS_PORT", 6379)) # Порт Redis
+                # Верхняя граница числа соединений в пуле: все корутины процесса делят один пул.
+                # При исчерпании лимита запрос ждет освободившееся соединение (не дольше REDIS_POOL_TIMEOUT
+                # секунд) вместо ошибки "Too many connections" или лавины новых соединений.
+                self.redis_max_connections = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+                self.redis_pool_timeout = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
                 # self.redis_password = os.getenv("REDIS_PASSWORD", None) # Пароль, если используется
                 
                 # Создаем пул соединений для эффективного управления соединениями
-                self.pool = redis.ConnectionPool(
+                self.pool = redis.BlockingConnectionPool(
                     host=self.redis_host, 
                     port=self.redis_port, 
                     # password=self.redis_password, # Раскомментируйте, если используется пароль
+                    max_connections=self.redis_max_connections,
+                    timeout=self.redis_pool_timeout,
                     decode_responses=True # Автоматически декодировать ответы из байтов в строки UTF-8
                 )
                 # Создаем асинхронный клиент Redis, используя пул соединений
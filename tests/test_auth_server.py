@@ -17,8 +17,8 @@ import sys
 import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from auth_server.user_service import authenticate_user, MOCK_USERS_DB # Функции и данные для аутентификации
-from auth_server.tcp_handler import handle_auth_client # Обработчик TCP-запросов
+from auth_server.user_service import UserService, authenticate_user, MOCK_USERS_DB # Сервис, функции и данные для аутентификации
+from auth_server.tcp_handler import AuthProtocol, _BadRequestLimiter # Обработчик TCP-соединений
 from auth_server.main import main as auth_server_main # Главная функция сервера (для возможных интеграционных тестов)
 
 # Убедимся, что MOCK_USERS_DB содержит необходимых тестовых пользователей.
@@ -64,149 +64,120 @@ class TestAuthUserService(unittest.IsolatedAsyncioTestCase):
         self.assertFalse(authenticated, "Аутентификация должна провалиться для несуществующего пользователя.")
         self.assertEqual("Пользователь не найден.", message, "Сообщение должно указывать, что пользователь не найден.")
 
+async def _serve(user_service, data):
+    """
+    Проводит одно соединение через AuthProtocol с мок-транспортом: подключение,
+    строка запроса data (через get_buffer/buffer_updated, как в цикле событий), ответ и закрытие.
+
+    Returns:
+        MagicMock: Транспорт соединения (ответ - аргумент transport.write).
+    """
+    transport = MagicMock(spec=asyncio.Transport)
+    transport.get_extra_info.return_value = ('127.0.0.1', 12345) # Имитируем адрес клиента
+    transport.is_closing.return_value = False
+    protocol = AuthProtocol(user_service)
+    protocol.connection_made(transport)
+    buffer = protocol.get_buffer(len(data))
+    buffer[:len(data)] = data
+    protocol.buffer_updated(len(data))
+    if protocol._task is not None: # Действие выполняется в отдельной задаче
+        await protocol._task
+    protocol.connection_lost(None)
+    return transport
+
 class TestAuthTcpHandler(unittest.IsolatedAsyncioTestCase):
     """
     Набор тестов для проверки TCP-обработчика сервера аутентификации (`auth_server.tcp_handler`).
     Тестирует логику обработки входящих TCP-сообщений.
     """
 
+    def setUp(self):
+        # Свой лимитер некорректных запросов, чтобы тесты не влияли друг на друга
+        limiter_patcher = patch('auth_server.tcp_handler._bad_requests', _BadRequestLimiter())
+        limiter_patcher.start()
+        self.addCleanup(limiter_patcher.stop)
+
     async def test_handle_auth_client_login_success(self):
         """
         Тест успешного логина через TCP-обработчик.
         Имитирует входящее TCP-соединение с корректными данными для входа.
         Проверяет, что вызывается `authenticate_user` и клиенту отправляется верный ответ.
         """
-        reader = asyncio.StreamReader()
         # Кодируем сообщение с символом новой строки, как это делает реальный клиент.
         # Сервер ожидает JSON, поэтому отправляем JSON-строку.
         login_payload = {"action": "login", "username": "testuser_auth", "password": "testpass_auth"}
-        reader.feed_data( (f"{json.dumps(login_payload)}\n").encode('utf-8') )
-        reader.feed_eof() # Сигнализируем конец данных (EOF)
-
-        writer = MagicMock(spec=asyncio.StreamWriter) # Мок для StreamWriter
-        writer.get_extra_info.return_value = ('127.0.0.1', 12345) # Имитируем адрес клиента
-        # Мокируем асинхронные методы drain и close, чтобы они возвращали завершенный Future.
-        writer.drain = MagicMock(return_value=asyncio.Future())
-        writer.drain.return_value.set_result(None)
-        writer.close = MagicMock()
-        writer.wait_closed = MagicMock(return_value=asyncio.Future())
-        writer.wait_closed.return_value.set_result(None)
-        writer.write = MagicMock() # Мок для метода write
-        writer.is_closing = MagicMock(return_value=False) # Убедимся, что is_closing возвращает False для проверки в блоке finally
-
-        # Мокируем `authenticate_user` внутри `tcp_handler`, чтобы изолировать тест.
-        # Ожидаем, что `handle_auth_client` вызовет его с правильными аргументами.
-        # Сервер `auth_server` теперь возвращает JSON, поэтому ожидаемый ответ от `authenticate_user`
-        # должен соответствовать тому, что `handle_auth_client` ожидает для формирования JSON ответа.
-        # Предположим, что `authenticate_user` возвращает (True, "Успешный вход", "fake_session_id_123")
-        # Но `handle_auth_client` формирует свой JSON, поэтому мы мокируем то, что возвращает `authenticate_user`
-        # на более низком уровне.
-        # В данном случае, tcp_handler ожидает от user_service (True/False, сообщение_или_токен)
-        # и затем формирует JSON.
-        # Если authenticate_user возвращает (True, "токен_сессии_или_сообщение_успеха"), то handle_auth_client
-        # формирует JSON: {"status": "success", "message": "токен_сессии_или_сообщение_успеха", "token": "имя_пользователя"}
-        
-        # Обновляем мок authenticate_user, чтобы он соответствовал ожиданиям JSON-обработчика
-        # Теперь authenticate_user возвращает (bool, message_or_token)
-        # А tcp_handler.py формирует JSON {"status": "success/failure", "message": message, "token": username}
-        # Предполагаем, что fake_token_123 - это английское сообщение или действительный токен; для этого теста важно, что он передается.
-        # user_service.py был обновлен, чтобы возвращать русские сообщения, поэтому мок тоже должен это делать.
-        with patch('auth_server.tcp_handler.user_service.authenticate_user', return_value=(True, "Пользователь testuser_auth успешно аутентифицирован.")) as mock_auth:
-            await handle_auth_client(reader, writer)
+
+        # Мокируем `authenticate_user` у экземпляра сервиса, чтобы изолировать тест.
+        # tcp_handler ожидает от user_service (True/False, сообщение) и затем формирует JSON:
+        # {"status": "success", "message": сообщение, "token": имя_пользователя}
+        user_service = UserService() # Обработчик получает экземпляр сервиса явно
+        with patch.object(user_service, 'authenticate_user', return_value=(True, "Пользователь testuser_auth успешно аутентифицирован.")) as mock_auth:
+            transport = await _serve(user_service, (f"{json.dumps(login_payload)}\n").encode('utf-8'))
 
         mock_auth.assert_called_once_with("testuser_auth", "testpass_auth")
-        
-        # Проверяем, что writer.write был вызван с правильным JSON-сообщением.
-        # Ожидаем байты, так как `writer.write` принимает байты.
+
+        # Проверяем, что transport.write был вызван с правильным JSON-сообщением.
         # Также ожидаем символ новой строки в конце сообщения от сервера.
-        # Сообщение от authenticate_user используется напрямую.
         # Обработчик использует имя пользователя в качестве значения токена.
         expected_response_dict = {"status": "success", "message": "Пользователь testuser_auth успешно аутентифицирован.", "token": "testuser_auth"}
-        expected_response_bytes = (json.dumps(expected_response_dict) + "\n").encode('utf-8')
-        writer.write.assert_called_with(expected_response_bytes)
-        writer.close.assert_called_once() # Проверяем, что соединение было закрыто
+        written_bytes = transport.write.call_args[0][0] # Формат сериализации не важен, сравниваем разобранный JSON
+        self.assertTrue(written_bytes.endswith(b"\n"))
+        self.assertEqual(json.loads(written_bytes), expected_response_dict)
+        transport.close.assert_called_once() # Проверяем, что соединение было закрыто
 
     async def test_handle_auth_client_login_failure(self):
         """
         Тест неудачного логина через TCP-обработчик.
         Имитирует входящее TCP-соединение с неверными данными для входа.
         """
-        reader = asyncio.StreamReader()
         login_payload = {"action": "login", "username": "testuser_auth", "password": "wrongpass"}
-        reader.feed_data( (f"{json.dumps(login_payload)}\n").encode('utf-8') )
-        reader.feed_eof()
-
-        writer = MagicMock(spec=asyncio.StreamWriter)
-        writer.get_extra_info.return_value = ('127.0.0.1', 12345)
-        writer.drain = MagicMock(return_value=asyncio.Future()); writer.drain.return_value.set_result(None)
-        writer.close = MagicMock()
-        writer.wait_closed = MagicMock(return_value=asyncio.Future()); writer.wait_closed.return_value.set_result(None)
-        writer.write = MagicMock()
-        writer.is_closing = MagicMock(return_value=False) # Убедимся, что is_closing возвращает False
 
         # Предполагаем, что authenticate_user теперь возвращает русское сообщение "Неверный пароль."
-        with patch('auth_server.tcp_handler.user_service.authenticate_user', return_value=(False, "Неверный пароль.")) as mock_auth:
-            await handle_auth_client(reader, writer)
+        user_service = UserService() # Обработчик получает экземпляр сервиса явно
+        with patch.object(user_service, 'authenticate_user', return_value=(False, "Неверный пароль.")) as mock_auth:
+            transport = await _serve(user_service, (f"{json.dumps(login_payload)}\n").encode('utf-8'))
 
         mock_auth.assert_called_once_with("testuser_auth", "wrongpass")
         expected_response_dict = {"status": "failure", "message": "Неверный пароль."}
-        expected_response_bytes = (json.dumps(expected_response_dict) + "\n").encode('utf-8')
-        writer.write.assert_called_with(expected_response_bytes)
-        writer.close.assert_called_once()
+        written_bytes = transport.write.call_args[0][0] # Формат сериализации не важен, сравниваем разобранный JSON
+        self.assertTrue(written_bytes.endswith(b"\n"))
+        self.assertEqual(json.loads(written_bytes), expected_response_dict)
+        transport.close.assert_called_once()
 
     async def test_handle_auth_client_invalid_json_command(self):
         """
         Тест обработки невалидной JSON-команды.
         Имитирует отправку строки, которая не является корректным JSON.
         """
-        reader = asyncio.StreamReader()
-        reader.feed_data("ЭтоНеJSON\n".encode('utf-8')) # Невалидная JSON-команда
-        reader.feed_eof()
-
-        writer = MagicMock(spec=asyncio.StreamWriter)
-        writer.get_extra_info.return_value = ('127.0.0.1', 12345)
-        writer.drain = MagicMock(return_value=asyncio.Future()); writer.drain.return_value.set_result(None)
-        writer.close = MagicMock()
-        writer.wait_closed = MagicMock(return_value=asyncio.Future()); writer.wait_closed.return_value.set_result(None)
-        writer.write = MagicMock()
-        writer.is_closing = MagicMock(return_value=False) # Убедимся, что is_closing возвращает False
-
         # `authenticate_user` не должен быть вызван, так как парсинг JSON провалится раньше.
-        with patch('auth_server.tcp_handler.user_service.authenticate_user') as mock_auth:
-            await handle_auth_client(reader, writer)
+        user_service = UserService() # Обработчик получает экземпляр сервиса явно
+        with patch.object(user_service, 'authenticate_user') as mock_auth:
+            transport = await _serve(user_service, "ЭтоНеJSON\n".encode('utf-8')) # Невалидная JSON-команда
 
         mock_auth.assert_not_called() # `authenticate_user` не должен вызываться
         # Ожидаем ответ об ошибке JSON
         expected_response_dict = {"status": "error", "message": "Неверный формат JSON"}
-        expected_response_bytes = (json.dumps(expected_response_dict) + "\n").encode('utf-8')
-        writer.write.assert_called_with(expected_response_bytes)
-        writer.close.assert_called_once()
+        written_bytes = transport.write.call_args[0][0] # Формат сериализации не важен, сравниваем разобранный JSON
+        self.assertTrue(written_bytes.endswith(b"\n"))
+        self.assertEqual(json.loads(written_bytes), expected_response_dict)
+        transport.close.assert_called_once()
 
     async def test_handle_auth_client_unknown_action(self):
         """
         Тест обработки JSON-команды с неизвестным действием (action).
         """
-        reader = asyncio.StreamReader()
         payload = {"action": "UNKNOWN_ACTION", "username": "user", "password": "pw"}
-        reader.feed_data( (f"{json.dumps(payload)}\n").encode('utf-8') )
-        reader.feed_eof()
-
-        writer = MagicMock(spec=asyncio.StreamWriter)
-        writer.get_extra_info.return_value = ('127.0.0.1', 12345)
-        writer.drain = MagicMock(return_value=asyncio.Future()); writer.drain.return_value.set_result(None)
-        writer.close = MagicMock()
-        writer.wait_closed = MagicMock(return_value=asyncio.Future()); writer.wait_closed.return_value.set_result(None)
-        writer.write = MagicMock()
-        writer.is_closing = MagicMock(return_value=False) # Убедимся, что is_closing возвращает False
-        
-        with patch('auth_server.tcp_handler.user_service.authenticate_user') as mock_auth:
-            await handle_auth_client(reader, writer)
+
+        user_service = UserService() # Обработчик получает экземпляр сервиса явно
+        with patch.object(user_service, 'authenticate_user') as mock_auth:
+            transport = await _serve(user_service, (f"{json.dumps(payload)}\n").encode('utf-8'))
 
         mock_auth.assert_not_called() # `authenticate_user` не должен вызываться для неизвестного действия
         expected_response_dict = {"status": "error", "message": "Неизвестное или отсутствующее действие"}
-        expected_response_bytes = (json.dumps(expected_response_dict) + "\n").encode('utf-8')
-        writer.write.assert_called_with(expected_response_bytes)
-        writer.close.assert_called_once()
+        written_bytes = transport.write.call_args[0][0] # Формат сериализации не важен, сравниваем разобранный JSON
+        self.assertTrue(written_bytes.endswith(b"\n"))
+        self.assertEqual(json.loads(written_bytes), expected_response_dict)
+        transport.close.assert_called_once()
 
 # Блок для запуска тестов, если этот файл выполняется напрямую.
 if __name__ == '__main__':
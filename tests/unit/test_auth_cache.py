@@ -0,0 +1,48 @@
+# tests/unit/test_auth_cache.py
+# Модульные тесты для локального LRU-кэша с TTL (`auth_server.auth_cache`).
+from auth_server.auth_cache import TTLCache
+
+class FakeTimer:
+    """Управляемый источник времени."""
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+def test_get_returns_stored_value_until_ttl_expires():
+    timer = FakeTimer()
+    cache = TTLCache(maxsize=10, ttl=60, timer=timer)
+    cache.set("key", "value")
+    timer.now = 59.9
+    assert cache.get("key") == "value"
+    timer.now = 60.0
+    assert cache.get("key") is None
+    assert len(cache) == 0, "Устаревшая запись должна удаляться при обращении."
+
+def test_per_entry_ttl():
+    timer = FakeTimer()
+    cache = TTLCache(maxsize=10, ttl=60, timer=timer)
+    cache.set("short", 1, ttl=5)
+    cache.set("long", 2)
+    timer.now = 10
+    assert cache.get("short") is None
+    assert cache.get("long") == 2
+
+def test_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1 # "a" становится самой свежей записью
+    cache.set("c", 3) # вытесняется "b"
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+def test_pop_and_disabled_cache():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    assert cache.pop("a") == 1
+    assert cache.pop("a") is None
+    disabled = TTLCache(maxsize=0)
+    disabled.set("a", 1)
+    assert disabled.get("a") is None
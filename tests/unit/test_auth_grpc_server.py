@@ -1,4 +1,7 @@
 import asyncio
+import multiprocessing
+import os
+import time
 import pytest
 from unittest.mock import AsyncMock, patch, MagicMock
 
@@ -9,7 +12,7 @@ from grpc.aio import insecure_channel, server as grpc_aio_server
 # или через относительные импорты, если grpc_generated является частью пакета
 from auth_server.grpc_generated import auth_service_pb2
 from auth_server.grpc_generated import auth_service_pb2_grpc
-from auth_server.auth_grpc_server import AuthServiceServicer
+from auth_server.auth_grpc_server import AuthServiceServicer, SESSION_TTL, main as grpc_main
 from auth_server.user_service import UserService # Для мокирования
 
 # Фикстура для создания мок-экземпляра UserService
@@ -25,15 +28,15 @@ def mock_user_service():
 @pytest.fixture
 async def test_grpc_server(mock_user_service):
     test_server = grpc_aio_server()
-    auth_service_pb2_grpc.add_AuthServiceServicer_to_server(
-        AuthServiceServicer(user_svc_instance=mock_user_service), test_server # Исправлено имя аргумента
-    )
+    servicer = AuthServiceServicer(user_svc_instance=mock_user_service) # Исправлено имя аргумента
+    auth_service_pb2_grpc.add_AuthServiceServicer_to_server(servicer, test_server)
     port = test_server.add_insecure_port('[::]:0') # Используем порт 0 для автоматического выбора свободного порта
 
     await test_server.start()
     yield f'localhost:{port}', test_server # Возвращаем адрес и сам сервер
 
     await test_server.stop(None)
+    await servicer.close() # Останавливаем обработчики очереди регистраций
 
 # Тесты для AuthenticateUser
 @pytest.mark.asyncio
@@ -74,20 +77,19 @@ async def test_register_user_success(test_grpc_server, mock_user_service):
     # Предполагаем, что UserService теперь возвращает русские сообщения
     mock_user_service.create_user.return_value = (True, "Пользователь успешно зарегистрирован")
 
-    # Мокируем объект pbkdf2_sha256 в модуле auth_grpc_server
-    with patch('auth_server.auth_grpc_server.pbkdf2_sha256') as mock_pbkdf2_object:
-        # Настраиваем метод hash на мок-объекте pbkdf2_sha256
-        mock_pbkdf2_object.hash.return_value = "hashed_password_value"
+    # Мокируем асинхронную функцию хеширования в модуле auth_grpc_server
+    with patch('auth_server.auth_grpc_server.hash_password', new_callable=AsyncMock) as mock_hash_password:
+        mock_hash_password.return_value = "hashed_password_value"
 
         async with insecure_channel(server_address) as channel:
             stub = auth_service_pb2_grpc.AuthServiceStub(channel)
             request = auth_service_pb2.AuthRequest(username="newuser", password="newpassword")
             response = await stub.RegisterUser(request)
 
-    mock_pbkdf2_object.hash.assert_called_once_with("newpassword") # Проверяем вызов на мок-методе hash
+    mock_hash_password.assert_awaited_once_with("newpassword") # Проверяем вызов функции хеширования
     mock_user_service.create_user.assert_called_once_with("newuser", "hashed_password_value")
     assert response.authenticated is False # По логике RegisterUser, authenticated всегда False в ответе
-    assert response.message == "Регистрация прошла успешно. Пожалуйста, войдите в систему." // Сообщение от AuthServiceServicer
+    assert response.message == "Регистрация прошла успешно. Пожалуйста, войдите в систему." # Сообщение от AuthServiceServicer
     assert response.token == ""
 
 @pytest.mark.asyncio
@@ -96,15 +98,15 @@ async def test_register_user_failure_user_exists(test_grpc_server, mock_user_ser
     # Предполагаем, что UserService теперь возвращает русские сообщения
     mock_user_service.create_user.return_value = (False, "Пользователь уже существует")
 
-    with patch('auth_server.auth_grpc_server.pbkdf2_sha256') as mock_pbkdf2_object:
-        mock_pbkdf2_object.hash.return_value = "hashed_password_value"
+    with patch('auth_server.auth_grpc_server.hash_password', new_callable=AsyncMock) as mock_hash_password:
+        mock_hash_password.return_value = "hashed_password_value"
 
         async with insecure_channel(server_address) as channel:
             stub = auth_service_pb2_grpc.AuthServiceStub(channel)
             request = auth_service_pb2.AuthRequest(username="existinguser", password="password")
             response = await stub.RegisterUser(request)
 
-    mock_pbkdf2_object.hash.assert_called_once_with("password")
+    mock_hash_password.assert_awaited_once_with("password")
     mock_user_service.create_user.assert_called_once_with("existinguser", "hashed_password_value")
     assert response.authenticated is False
     assert response.message == "Ошибка регистрации: Пользователь уже существует" # Сообщение от AuthServiceServicer
@@ -114,8 +116,8 @@ async def test_register_user_failure_user_exists(test_grpc_server, mock_user_ser
 async def test_register_user_hash_exception(test_grpc_server, mock_user_service):
     server_address, _ = test_grpc_server
 
-    with patch('auth_server.auth_grpc_server.pbkdf2_sha256') as mock_pbkdf2_object:
-        mock_pbkdf2_object.hash.side_effect = Exception("Hashing error")
+    with patch('auth_server.auth_grpc_server.hash_password', new_callable=AsyncMock) as mock_hash_password:
+        mock_hash_password.side_effect = Exception("Hashing error")
 
         async with insecure_channel(server_address) as channel:
             stub = auth_service_pb2_grpc.AuthServiceStub(channel)
@@ -127,3 +129,249 @@ async def test_register_user_hash_exception(test_grpc_server, mock_user_service)
             assert rpc_error_info.value.code() == grpc.StatusCode.UNKNOWN # Changed from INTERNAL to UNKNOWN
 
     mock_user_service.create_user.assert_not_called() # create_user не должен быть вызван
+
+# Тесты с Redis (токены сессий)
+@pytest.fixture
+def fake_redis():
+    """Простейшая имитация RedisClient на словаре (get/set/delete)."""
+    storage = {}
+    client = MagicMock()
+    client.storage = storage
+
+    async def _get(name):
+        return storage.get(name)
+
+    async def _set(name, value, ex=None):
+        storage[name] = value
+        return True
+
+    async def _delete(*names):
+        return sum(1 for name in names if storage.pop(name, None) is not None)
+
+    client.get = AsyncMock(side_effect=_get)
+    client.set = AsyncMock(side_effect=_set)
+    client.delete = AsyncMock(side_effect=_delete)
+    return client
+
+class _Request:
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+
+# Тесты токенов сессий
+class _TokenRequest:
+    def __init__(self, token):
+        self.token = token
+
+@pytest.mark.asyncio
+async def test_authenticate_user_issues_session_token(mock_user_service, fake_redis):
+    mock_user_service.authenticate_user.return_value = (True, "ok")
+    servicer = AuthServiceServicer(mock_user_service, redis_client=fake_redis)
+
+    first = await servicer.AuthenticateUser(_Request("testuser", "password"), None)
+    second = await servicer.AuthenticateUser(_Request("testuser", "password"), None)
+
+    assert first.token and first.token != "testuser"
+    assert second.token and second.token != first.token # Каждый вход - новая сессия
+    assert fake_redis.storage[f"sess:{first.token}"] == "testuser"
+    set_ttls = {call.args[0]: call.kwargs["ex"] for call in fake_redis.set.await_args_list}
+    assert set_ttls[f"sess:{first.token}"] == SESSION_TTL
+
+@pytest.mark.asyncio
+async def test_validate_token(mock_user_service, fake_redis):
+    mock_user_service.authenticate_user.return_value = (True, "ok")
+    servicer = AuthServiceServicer(mock_user_service, redis_client=fake_redis)
+    login = await servicer.AuthenticateUser(_Request("testuser", "password"), None)
+
+    valid = await servicer.ValidateToken(_TokenRequest(login.token), None)
+    invalid = await servicer.ValidateToken(_TokenRequest("bogus"), None)
+    empty = await servicer.ValidateToken(_TokenRequest(""), None)
+
+    assert valid.valid is True and valid.username == "testuser"
+    assert invalid.valid is False and invalid.username == ""
+    assert empty.valid is False
+
+@pytest.mark.asyncio
+async def test_validate_token_redis_error_aborts(mock_user_service, fake_redis):
+    fake_redis.get.side_effect = ConnectionError("redis down")
+    servicer = AuthServiceServicer(mock_user_service, redis_client=fake_redis)
+    context = MagicMock()
+    context.abort = AsyncMock() # Мок не выбрасывает исключение, в отличие от настоящего abort()
+
+    response = await servicer.ValidateToken(_TokenRequest("some-token"), context)
+
+    context.abort.assert_awaited_once()
+    assert context.abort.await_args.args[0] == grpc.StatusCode.UNAVAILABLE
+    assert response.valid is False
+
+@pytest.mark.asyncio
+async def test_authenticate_user_session_store_error_aborts(mock_user_service, fake_redis):
+    mock_user_service.authenticate_user.return_value = (True, "ok")
+    fake_redis.set.side_effect = ConnectionError("redis down")
+    servicer = AuthServiceServicer(mock_user_service, redis_client=fake_redis)
+    context = MagicMock()
+    context.abort = AsyncMock() # Мок не выбрасывает исключение, в отличие от настоящего abort()
+
+    response = await servicer.AuthenticateUser(_Request("testuser", "password"), context)
+
+    context.abort.assert_awaited_once()
+    assert context.abort.await_args.args[0] == grpc.StatusCode.UNAVAILABLE
+    assert response.authenticated is False and response.token == "" # Пустой токен не выдается как успех
+
+@pytest.mark.asyncio
+async def test_validate_token_over_grpc_without_redis(test_grpc_server):
+    server_address, _ = test_grpc_server
+    async with insecure_channel(server_address) as channel:
+        stub = auth_service_pb2_grpc.AuthServiceStub(channel)
+        response = await stub.ValidateToken(auth_service_pb2.TokenRequest(token="testuser"))
+    assert response.valid is False
+
+@pytest.mark.asyncio
+async def test_failure_responses_are_reused(mock_user_service):
+    mock_user_service.authenticate_user.return_value = (False, "Неверный пароль.")
+    servicer = AuthServiceServicer(mock_user_service)
+
+    first = await servicer.AuthenticateUser(_Request("user_a", "x"), None)
+    second = await servicer.AuthenticateUser(_Request("user_b", "y"), None)
+
+    assert first is second # Один заранее созданный ответ на одно и то же сообщение
+    assert first.authenticated is False and first.message == "Неверный пароль." and first.token == ""
+
+# Тесты очереди регистраций
+class _AbortContext:
+    """Имитация grpc.aio.ServicerContext: abort() выбрасывает исключение, как в gRPC."""
+    def __init__(self):
+        self.code = None
+    async def abort(self, code, details):
+        self.code = code
+        raise grpc.RpcError(details)
+
+@pytest.mark.asyncio
+async def test_register_user_rejected_when_queue_full(mock_user_service):
+    servicer = AuthServiceServicer(mock_user_service)
+    with patch('auth_server.auth_grpc_server.REGISTER_QUEUE_SIZE', 1), \
+         patch('auth_server.auth_grpc_server.REGISTER_WORKERS', 1), \
+         patch('auth_server.auth_grpc_server.hash_password', new_callable=AsyncMock) as mock_hash_password:
+        release = asyncio.Event()
+        async def slow_hash(password):
+            await release.wait()
+            return "hashed"
+        mock_hash_password.side_effect = slow_hash
+        mock_user_service.create_user.return_value = (True, "ok")
+
+        first = asyncio.create_task(servicer.RegisterUser(_Request("u1", "p"), _AbortContext()))
+        await asyncio.sleep(0.01) # обработчик забрал первую заявку и "хеширует"
+        second = asyncio.create_task(servicer.RegisterUser(_Request("u2", "p"), _AbortContext()))
+        await asyncio.sleep(0.01) # вторая заявка заняла единственное место в очереди
+        context = _AbortContext()
+        with pytest.raises(grpc.RpcError):
+            await servicer.RegisterUser(_Request("u3", "p"), context)
+        assert context.code == grpc.StatusCode.RESOURCE_EXHAUSTED
+
+        release.set()
+        assert (await first) is (await second)
+    await servicer.close()
+    assert [c.args[0] for c in mock_user_service.create_user.await_args_list] == ["u1", "u2"]
+
+@pytest.mark.asyncio
+async def test_register_user_timeout_skips_registration(mock_user_service):
+    servicer = AuthServiceServicer(mock_user_service)
+    release = asyncio.Event()
+    async def slow_hash(password):
+        await release.wait()
+        return "hashed"
+    with patch('auth_server.auth_grpc_server.REGISTER_TIMEOUT', 0.01), \
+         patch('auth_server.auth_grpc_server.hash_password', new=AsyncMock(side_effect=slow_hash)):
+        context = _AbortContext()
+        with pytest.raises(grpc.RpcError):
+            await servicer.RegisterUser(_Request("slowuser", "p"), context)
+        assert context.code == grpc.StatusCode.RESOURCE_EXHAUSTED
+        release.set()
+        await asyncio.sleep(0.01)
+    await servicer.close()
+    mock_user_service.create_user.assert_not_called() # Клиент получил отказ - пользователь не создается
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("username,password", [
+    ("", "password"),
+    ("testuser", ""),
+    ("u" * 65, "password"),
+    ("testuser", "p" * 257),
+])
+async def test_authenticate_user_rejects_invalid_input_early(mock_user_service, fake_redis, username, password):
+    servicer = AuthServiceServicer(mock_user_service, redis_client=fake_redis)
+
+    response = await servicer.AuthenticateUser(_Request(username, password), None)
+
+    assert response.authenticated is False
+    assert response.message == "Неверное имя пользователя или пароль."
+    mock_user_service.authenticate_user.assert_not_called() # До KDF дело не доходит
+    fake_redis.get.assert_not_called() # и до Redis тоже
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("username,password", [
+    ("", "password"),
+    ("newuser", ""),
+    ("u" * 65, "password"),
+    ("newuser", "p" * 257),
+])
+async def test_register_user_rejects_invalid_input_early(mock_user_service, username, password):
+    servicer = AuthServiceServicer(mock_user_service)
+    context = _AbortContext()
+
+    with patch('auth_server.auth_grpc_server.hash_password', new_callable=AsyncMock) as mock_hash_password:
+        with pytest.raises(grpc.RpcError):
+            await servicer.RegisterUser(_Request(username, password), context)
+
+    assert context.code == grpc.StatusCode.INVALID_ARGUMENT
+    assert servicer._register_queue is None # Заявка не ставится в очередь
+    mock_hash_password.assert_not_called()
+    mock_user_service.create_user.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_register_user_returns_after_non_raising_abort(mock_user_service):
+    servicer = AuthServiceServicer(mock_user_service)
+    context = MagicMock()
+    context.abort = AsyncMock() # Мок не выбрасывает исключение, в отличие от настоящего abort()
+    release = asyncio.Event()
+    async def slow_hash(password):
+        await release.wait()
+        return "hashed"
+
+    with patch('auth_server.auth_grpc_server.REGISTER_TIMEOUT', 0.01), \
+         patch('auth_server.auth_grpc_server.hash_password', side_effect=slow_hash):
+        response = await servicer.RegisterUser(_Request("newuser", "newpassword"), context)
+        release.set()
+        await servicer.close()
+
+    assert context.abort.await_args.args[0] == grpc.StatusCode.RESOURCE_EXHAUSTED
+    assert response.authenticated is False and response.message.startswith("Ошибка регистрации")
+
+class _CrashingWorkersContext:
+    """Контекст spawn, в котором первый процесс сервера сразу завершается с ошибкой, а остальные ждут."""
+
+    def __init__(self):
+        self._ctx = multiprocessing.get_context("spawn")
+        self.processes = []
+
+    def Process(self, target, args, name):
+        if self.processes:
+            process = self._ctx.Process(target=time.sleep, args=(60,), name=name)
+        else:
+            process = self._ctx.Process(target=os._exit, args=(3,), name=name)
+        self.processes.append(process)
+        return process
+
+def test_main_exits_when_worker_dies(monkeypatch):
+    """Завершение процесса gRPC-сервера останавливает остальные, и родитель выходит с кодом 1."""
+    monkeypatch.setenv('AUTH_GRPC_WORKERS', '2')
+    monkeypatch.setenv('AUTH_KDF_WORKERS', '1')
+    ctx = _CrashingWorkersContext()
+    with patch('auth_server.auth_grpc_server.multiprocessing.get_context', return_value=ctx), \
+            patch('auth_server.auth_grpc_server.signal.signal'):
+        with pytest.raises(SystemExit) as exc_info:
+            grpc_main()
+
+    assert exc_info.value.code == 1
+    assert ctx.processes[0].exitcode == 3
+    assert not any(process.is_alive() for process in ctx.processes)
@@ -1,51 +1,129 @@
+import asyncio
+import multiprocessing
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 import os
+import time
 
 # Импортируем тестируемую функцию
-from auth_server.main import start_metrics_server
+from auth_server.main import start_metrics_server, _handle_metrics_request
 
 # Тест для start_metrics_server
-def test_start_metrics_server_success():
-    # Мокируем prometheus_client.start_http_server
-    with patch('auth_server.main.start_http_server') as mock_start_http:
-        # Мокируем os.getenv для предсказуемого порта, если он используется для порта метрик
-        # (в auth_server.main порт метрик 8000 жестко задан, так что это может не понадобиться)
-        # с учетом текущей реализации start_metrics_server, порт 8000 жестко задан.
+async def test_start_metrics_server_success():
+    # Мокируем asyncio.start_server, чтобы не занимать реальный порт
+    with patch('auth_server.main.asyncio.start_server', new_callable=AsyncMock) as mock_start_server:
+        metrics_server = await start_metrics_server() # Вызываем функцию
 
-        start_metrics_server() # Вызываем функцию
+        # Проверяем, что сервер был запущен в цикле событий на порту 8000
+        mock_start_server.assert_awaited_once_with(_handle_metrics_request, '0.0.0.0', 8000)
+        assert metrics_server is mock_start_server.return_value
 
-        # Проверяем, что start_http_server был вызван с портом 8000
-        mock_start_http.assert_called_once_with(8000)
-
-def test_start_metrics_server_os_error():
-    # Мокируем prometheus_client.start_http_server, чтобы он вызывал OSError
-    with patch('auth_server.main.start_http_server', side_effect=OSError("Test OSError")) as mock_start_http:
+async def test_start_metrics_server_os_error():
+    # Мокируем asyncio.start_server, чтобы он вызывал OSError
+    with patch('auth_server.main.asyncio.start_server', new_callable=AsyncMock, side_effect=OSError("Test OSError")) as mock_start_server:
         with patch('auth_server.main.logger') as mock_logger: # Мокируем логгер для проверки вывода ошибки
-            start_metrics_server()
+            metrics_server = await start_metrics_server()
 
-            mock_start_http.assert_called_once_with(8000)
+            mock_start_server.assert_awaited_once_with(_handle_metrics_request, '0.0.0.0', 8000)
+            assert metrics_server is None
             # Проверяем, что ошибка была залогирована
             mock_logger.error.assert_called_once()
             # Можно также проверить текст сообщения, если он важен
             args, kwargs = mock_logger.error.call_args
             assert "OSError starting Prometheus metrics server" in args[0]
-            # Проверяем, что exc_info содержит исключение (или равно True).
-            # unittest.mock.call_args возвращает кортеж (args, kwargs). kwargs['exc_info'] должно быть исключением или True.
-            # В зависимости от того, как вызывается logger.error с exc_info=True,
-            # exc_info в call_args может быть True или фактическим объектом исключения.
             # Код использует exc_info=True, поэтому мы проверяем на True.
             assert kwargs.get('exc_info') is True
 
-def test_start_metrics_server_generic_exception():
-    # Мокируем prometheus_client.start_http_server, чтобы он вызывал общее исключение
-    with patch('auth_server.main.start_http_server', side_effect=Exception("Test Exception")) as mock_start_http:
+async def test_start_metrics_server_generic_exception():
+    # Мокируем asyncio.start_server, чтобы он вызывал общее исключение
+    with patch('auth_server.main.asyncio.start_server', new_callable=AsyncMock, side_effect=Exception("Test Exception")) as mock_start_server:
         with patch('auth_server.main.logger') as mock_logger:
-            start_metrics_server()
+            metrics_server = await start_metrics_server()
 
-            mock_start_http.assert_called_once_with(8000)
+            mock_start_server.assert_awaited_once_with(_handle_metrics_request, '0.0.0.0', 8000)
+            assert metrics_server is None
             mock_logger.error.assert_called_once()
             args, kwargs = mock_logger.error.call_args
             assert "Failed to start Prometheus metrics server" in args[0]
             # Аналогично OSError, проверяем exc_info
             assert kwargs.get('exc_info') is True
+
+async def _http_get(port, path):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode('ascii'))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+async def test_metrics_server_serves_registry():
+    # Реальный сервер на свободном порту: /metrics отдает метрики, прочие пути - 404
+    metrics_server = await start_metrics_server(host='127.0.0.1', port=0)
+    assert metrics_server is not None
+    port = metrics_server.sockets[0].getsockname()[1]
+    try:
+        response = await _http_get(port, "/metrics")
+        assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert b"auth_server_successful_authentications_total" in response
+
+        response = await _http_get(port, "/other")
+        assert response.startswith(b"HTTP/1.1 404 Not Found\r\n")
+    finally:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+
+async def test_metrics_server_serves_custom_registry():
+    # В многопроцессном режиме родительский процесс отдает реестр с MultiProcessCollector
+    from prometheus_client import CollectorRegistry, Counter
+    registry = CollectorRegistry()
+    Counter('auth_test_custom_total', 'Test counter', registry=registry).inc()
+    metrics_server = await start_metrics_server(host='127.0.0.1', port=0, registry=registry)
+    port = metrics_server.sockets[0].getsockname()[1]
+    try:
+        response = await _http_get(port, "/metrics")
+        assert b"auth_test_custom_total 1.0" in response
+        assert b"auth_server_successful_authentications_total" not in response
+    finally:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+
+def test_server_workers_from_env(monkeypatch):
+    from auth_server.main import _server_workers
+    monkeypatch.delenv('AUTH_SERVER_WORKERS', raising=False)
+    assert _server_workers() == 1
+    monkeypatch.setenv('AUTH_SERVER_WORKERS', '4')
+    assert _server_workers() == 4
+    monkeypatch.setenv('AUTH_SERVER_WORKERS', 'many')
+    assert _server_workers() == 1
+
+class _CrashingWorkersContext:
+    """Контекст spawn, в котором первый процесс-обработчик сразу завершается с ошибкой, а остальные ждут."""
+
+    def __init__(self):
+        self._ctx = multiprocessing.get_context("spawn")
+        self.processes = []
+
+    def Process(self, target, args, name):
+        if self.processes:
+            process = self._ctx.Process(target=time.sleep, args=(60,), name=name)
+        else:
+            process = self._ctx.Process(target=os._exit, args=(3,), name=name)
+        self.processes.append(process)
+        return process
+
+def test_run_exits_when_worker_dies(monkeypatch, tmp_path):
+    """Завершение процесса-обработчика останавливает остальные, и родитель выходит с кодом 1."""
+    from auth_server import main as auth_main
+    monkeypatch.setenv('AUTH_SERVER_WORKERS', '2')
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+    monkeypatch.setenv('AUTH_KDF_WORKERS', '1')
+    ctx = _CrashingWorkersContext()
+    with patch('auth_server.main.multiprocessing.get_context', return_value=ctx), \
+            patch('auth_server.main.start_metrics_server', AsyncMock(return_value=None)), \
+            patch('auth_server.main.signal.signal'):
+        with pytest.raises(SystemExit) as exc_info:
+            auth_main.run()
+
+    assert exc_info.value.code == 1
+    assert [process.exitcode for process in ctx.processes][0] == 3
+    assert not any(process.is_alive() for process in ctx.processes)
@@ -0,0 +1,55 @@
+# tests/unit/test_auth_metrics.py
+# Модульные тесты для пакетных счетчиков Prometheus (`auth_server.metrics`).
+import asyncio
+from unittest.mock import MagicMock
+
+from auth_server.metrics import BatchedCounter, BatchedGauge, flush_metrics, run_metrics_flusher
+
+def test_batched_counter_flushes_on_threshold():
+    counter = MagicMock()
+    batched = BatchedCounter(counter, flush_every=3)
+    batched.inc()
+    batched.inc()
+    counter.inc.assert_not_called() # Приращения пока накапливаются локально
+    batched.inc()
+    counter.inc.assert_called_once_with(3)
+
+def test_flush_metrics_pushes_pending_increments():
+    counter = MagicMock()
+    batched = BatchedCounter(counter, flush_every=100)
+    batched.inc()
+    batched.inc(2)
+    flush_metrics()
+    counter.inc.assert_called_once_with(3)
+    flush_metrics() # Повторный сброс без новых приращений ничего не передает
+    counter.inc.assert_called_once()
+
+def test_batched_gauge_nets_inc_and_dec():
+    gauge = MagicMock()
+    batched = BatchedGauge(gauge, flush_every=3)
+    batched.inc()
+    batched.inc()
+    batched.dec()
+    flush_metrics()
+    gauge.inc.assert_called_once_with(1) # Датчик получает только итоговое изменение
+    batched.inc()
+    batched.dec()
+    flush_metrics() # Взаимно уничтоженные inc()/dec() не доходят до датчика
+    gauge.inc.assert_called_once()
+
+def test_batched_gauge_flushes_on_negative_threshold():
+    gauge = MagicMock()
+    batched = BatchedGauge(gauge, flush_every=2)
+    batched.dec()
+    batched.dec()
+    gauge.inc.assert_called_once_with(-2)
+
+async def test_run_metrics_flusher_flushes_periodically():
+    counter = MagicMock()
+    batched = BatchedCounter(counter, flush_every=100)
+    batched.inc()
+    task = asyncio.create_task(run_metrics_flusher(interval=0.01))
+    await asyncio.sleep(0.05)
+    counter.inc.assert_called_once_with(1)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
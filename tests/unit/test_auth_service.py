@@ -1,10 +1,11 @@
 # tests/unit/test_auth_service.py
 # Этот файл содержит модульные тесты для сервиса аутентификации пользователей
 # (`auth_server.user_service.py`) с использованием pytest.
+import json
 import pytest # Импортируем pytest для написания и запуска тестов
-from unittest.mock import patch # Импортируем patch из unittest.mock для мокирования объектов
+from unittest.mock import AsyncMock, MagicMock, patch # Инструменты для мокирования
 # Импортируем UserService и MOCK_USERS_DB из модуля user_service
-from auth_server.user_service import UserService, MOCK_USERS_DB
+from auth_server.user_service import UserService, MOCK_USERS_DB, get_user_service, AUTH_CACHE_TTL, AUTH_CACHE_MAX_PER_USER
 
 # pytest помечает асинхронные тестовые функции с помощью @pytest.mark.asyncio,
 # но если используется pytest-asyncio, достаточно просто объявить функцию как async def.
@@ -175,13 +176,156 @@ async def test_authenticate_newly_created_user_with_hash_as_password():
 
 def test_initialize_redis_client_static_method():
     """
-    Тест статического метода UserService.initialize_redis_client().
-    Проверяет, что метод вызывается без ошибок (не выбрасывает исключений).
+    Тест метода класса UserService.initialize_redis_client().
+    Проверяет, что метод вызывается без ошибок и при повторных вызовах
+    возвращает один и тот же общий клиент Redis.
     """
     try:
-        UserService.initialize_redis_client()
-        # Если метод выполнился без исключений, тест считается пройденным.
-        # Можно добавить mock для logger и проверить, что логирование происходит,
-        # но для простой заглушки это может быть излишним.
+        client = UserService.initialize_redis_client()
     except Exception as e:
         pytest.fail(f"UserService.initialize_redis_client() вызвал исключение: {e}")
+    assert client is not None
+    assert UserService.redis_client is client
+    assert UserService.initialize_redis_client() is client, "Клиент Redis должен создаваться один раз."
+
+async def test_authenticate_user_with_hashed_password():
+    """
+    Пользователи, зарегистрированные через gRPC, хранятся с хешем pbkdf2-sha256.
+    Проверяет, что `authenticate_user` проверяет такие записи через KDF.
+    """
+    from auth_server.kdf import pbkdf2_sha256
+    user_service = UserService()
+    hashed = pbkdf2_sha256.hash("hashed_pass", rounds=1000)
+    with patch.dict(MOCK_USERS_DB, {"hashed_user": hashed}):
+        is_auth, _ = await user_service.authenticate_user("hashed_user", "hashed_pass")
+        assert is_auth is True
+        is_auth, message = await user_service.authenticate_user("hashed_user", hashed)
+        assert is_auth is False, "Сам хеш не должен приниматься в качестве пароля."
+        assert message == "Неверный пароль."
+
+def test_get_user_service_returns_shared_instance():
+    """
+    Тест фабрики get_user_service.
+    Проверяет, что повторные вызовы возвращают один и тот же экземпляр,
+    а cache_clear() позволяет создать новый (например, для подмены в тестах).
+    """
+    get_user_service.cache_clear()
+    service = get_user_service()
+    assert isinstance(service, UserService)
+    assert get_user_service() is service, "Фабрика должна возвращать общий экземпляр."
+    get_user_service.cache_clear()
+    assert get_user_service() is not service, "После cache_clear() создается новый экземпляр."
+
+async def test_authenticate_user_results_are_cached_and_invalidated():
+    """
+    Тест кэша результатов authenticate_user.
+    Повтор того же пароля не проверяется заново (успех и неудача), другой пароль
+    проверяется, а create_user сбрасывает кэшированное "пользователь не найден".
+    """
+    user_service = UserService()
+    with patch.dict(MOCK_USERS_DB, {"cached_user": "cached_pass"}), \
+            patch.object(user_service, '_check_credentials', wraps=user_service._check_credentials) as check:
+        assert (await user_service.authenticate_user("cached_user", "cached_pass"))[0] is True
+        assert (await user_service.authenticate_user("cached_user", "cached_pass"))[0] is True
+        assert check.await_count == 1, "Повторный вход должен обслуживаться кэшем."
+
+        assert (await user_service.authenticate_user("cached_user", "wrong"))[0] is False
+        assert (await user_service.authenticate_user("cached_user", "wrong"))[0] is False
+        assert check.await_count == 2, "Повтор неверного пароля должен обслуживаться кэшем."
+
+        assert (await user_service.authenticate_user("late_user", "late_pass")) == (False, "Пользователь не найден.")
+        created, _ = await user_service.create_user("late_user", "late_pass")
+        assert created is True
+        assert (await user_service.authenticate_user("late_user", "late_pass"))[0] is True
+
+@pytest.fixture
+def fake_redis():
+    """Простейшая имитация RedisClient на словаре (get/set/delete)."""
+    storage = {}
+    client = MagicMock()
+    client.storage = storage
+
+    async def _get(name):
+        return storage.get(name)
+
+    async def _set(name, value, ex=None):
+        storage[name] = value
+        return True
+
+    async def _delete(*names):
+        return sum(1 for name in names if storage.pop(name, None) is not None)
+
+    client.get = AsyncMock(side_effect=_get)
+    client.set = AsyncMock(side_effect=_set)
+    client.delete = AsyncMock(side_effect=_delete)
+    return client
+
+async def test_shared_cache_serves_other_instances(fake_redis):
+    """
+    Тест общего уровня кэша в Redis.
+    Результат, полученный одним экземпляром (процессом), используется другим без проверки пароля;
+    пароль в открытом виде в Redis не попадает, TTL зависит от исхода проверки.
+    """
+    first, second = UserService(shared_cache=fake_redis), UserService(shared_cache=fake_redis)
+    with patch.dict(MOCK_USERS_DB, {"shared_user": "shared_pass"}), \
+            patch.object(second, '_check_credentials', wraps=second._check_credentials) as check:
+        assert (await first.authenticate_user("shared_user", "shared_pass"))[0] is True
+        assert (await second.authenticate_user("shared_user", "shared_pass"))[0] is True
+        check.assert_not_awaited()
+        assert "shared_pass" not in fake_redis.storage["auth:shared_user"]
+        assert fake_redis.set.await_args.kwargs["ex"] == int(AUTH_CACHE_TTL)
+
+        # Другой пароль не совпадает с дайджестом в Redis и проверяется заново;
+        # запись пользователя живет, пока не истечет самый поздний из ее результатов
+        assert (await second.authenticate_user("shared_user", "wrong"))[0] is False
+        check.assert_awaited_once()
+        assert fake_redis.set.await_args.kwargs["ex"] in (int(AUTH_CACHE_TTL) - 1, int(AUTH_CACHE_TTL))
+
+        # Повторный вход обслуживается кэшем процесса, без обращения к Redis
+        get_calls = fake_redis.get.await_count
+        await second.authenticate_user("shared_user", "wrong")
+        assert fake_redis.get.await_count == get_calls
+
+async def test_failed_attempt_does_not_evict_cached_success(fake_redis):
+    """
+    Тест ключа кэша (имя, дайджест пароля): неверный пароль не вытесняет кэшированный
+    успешный вход ни в памяти процесса, ни в Redis, в том числе при потоке разных неверных паролей.
+    """
+    first, second = UserService(shared_cache=fake_redis), UserService(shared_cache=fake_redis)
+    with patch.dict(MOCK_USERS_DB, {"busy_user": "busy_pass"}), \
+            patch.object(first, '_check_credentials', wraps=first._check_credentials) as first_check, \
+            patch.object(second, '_check_credentials', wraps=second._check_credentials) as second_check:
+        assert (await first.authenticate_user("busy_user", "busy_pass"))[0] is True
+        for attempt in range(AUTH_CACHE_MAX_PER_USER + 2):
+            assert (await first.authenticate_user("busy_user", f"wrong{attempt}"))[0] is False
+        assert first_check.await_count == AUTH_CACHE_MAX_PER_USER + 3
+
+        assert (await first.authenticate_user("busy_user", "busy_pass"))[0] is True
+        assert first_check.await_count == AUTH_CACHE_MAX_PER_USER + 3, "Успешный вход должен остаться в кэше процесса."
+        assert (await second.authenticate_user("busy_user", "busy_pass"))[0] is True
+        second_check.assert_not_awaited() # и в записи Redis
+        assert len(json.loads(fake_redis.storage["auth:busy_user"])) == AUTH_CACHE_MAX_PER_USER
+
+async def test_invalidate_clears_shared_cache(fake_redis):
+    """
+    Тест invalidate: create_user сбрасывает кэшированное "пользователь не найден"
+    и в памяти процесса, и в Redis - вход в другом процессе сразу видит нового пользователя.
+    """
+    first, second = UserService(shared_cache=fake_redis), UserService(shared_cache=fake_redis)
+    with patch.dict(MOCK_USERS_DB, {}):
+        assert (await first.authenticate_user("late_user", "late_pass"))[0] is False
+        assert "auth:late_user" in fake_redis.storage
+        created, _ = await first.create_user("late_user", "late_pass")
+        assert created is True
+        assert "auth:late_user" not in fake_redis.storage
+        assert (await second.authenticate_user("late_user", "late_pass"))[0] is True
+
+async def test_shared_cache_errors_fall_back_to_verification(fake_redis):
+    """Тест отказа Redis: ошибки общего кэша только логируются, пароль проверяется как обычно."""
+    fake_redis.get.side_effect = ConnectionError("redis down")
+    fake_redis.set.side_effect = ConnectionError("redis down")
+    fake_redis.delete.side_effect = ConnectionError("redis down")
+    user_service = UserService(shared_cache=fake_redis)
+    with patch.dict(MOCK_USERS_DB, {"flaky_user": "flaky_pass"}):
+        assert (await user_service.authenticate_user("flaky_user", "flaky_pass"))[0] is True
+        await user_service.invalidate("flaky_user")
@@ -0,0 +1,27 @@
+import asyncio
+import pytest
+
+from auth_server import event_loop
+
+
+@pytest.fixture(autouse=True)
+def restore_event_loop_policy():
+    # event_loop.run() устанавливает политику uvloop глобально
+    yield
+    asyncio.set_event_loop_policy(None)
+
+
+async def _loop_debug():
+    return asyncio.get_running_loop().get_debug()
+
+
+def test_run_disables_asyncio_debug_from_env(monkeypatch, caplog):
+    monkeypatch.setenv("PYTHONASYNCIODEBUG", "1")
+    with caplog.at_level("WARNING", logger="auth_server.event_loop"):
+        assert event_loop.run(_loop_debug()) is False
+    assert "asyncio debug mode requested" in caplog.text
+
+
+def test_run_can_enable_debug_explicitly(monkeypatch):
+    monkeypatch.delenv("PYTHONASYNCIODEBUG", raising=False)
+    assert event_loop.run(_loop_debug(), debug=True) is True
@@ -0,0 +1,114 @@
+# tests/unit/test_kdf.py
+# Модульные тесты для обертки PBKDF2-SHA256 (`auth_server.kdf`).
+# Проверяют совместимость формата хешей с passlib в обе стороны.
+import asyncio
+import concurrent.futures
+import threading
+
+import pytest
+from passlib.hash import pbkdf2_sha256 as passlib_pbkdf2_sha256
+
+from auth_server import kdf
+from auth_server.kdf import pbkdf2_sha256
+
+def test_hash_verify_roundtrip():
+    """Хеш, созданный оберткой, проверяется ею же; неверный пароль отклоняется."""
+    hashed = pbkdf2_sha256.hash("secret", rounds=1000)
+    assert hashed.startswith("$pbkdf2-sha256$1000$")
+    assert pbkdf2_sha256.verify("secret", hashed) is True
+    assert pbkdf2_sha256.verify("wrong", hashed) is False
+
+def test_passlib_hash_verified_by_kdf():
+    """Хеши, ранее созданные passlib, должны проверяться без изменений."""
+    hashed = passlib_pbkdf2_sha256.hash("пароль", rounds=1000)
+    assert pbkdf2_sha256.verify("пароль", hashed) is True
+    assert pbkdf2_sha256.verify("пароль2", hashed) is False
+
+def test_kdf_hash_verified_by_passlib():
+    """Новые хеши читаются passlib (формат и кодировка ab64 совпадают)."""
+    hashed = pbkdf2_sha256.hash("secret", rounds=1000)
+    assert passlib_pbkdf2_sha256.verify("secret", hashed) is True
+
+def test_hash_matches_passlib_for_same_salt():
+    """При одинаковой соли и числе итераций строки хешей идентичны."""
+    salt = bytes(range(kdf.SALT_SIZE))
+    expected = passlib_pbkdf2_sha256.using(salt=salt, rounds=1000).hash("secret")
+    assert pbkdf2_sha256.hash("secret", rounds=1000, salt=salt) == expected
+
+def test_default_rounds_match_passlib():
+    assert pbkdf2_sha256.default_rounds == passlib_pbkdf2_sha256.default_rounds
+
+@pytest.mark.parametrize("bad_hash", [
+    "plaintext",
+    "$pbkdf2-sha256$",
+    "$pbkdf2-sha256$abc$c2FsdA$Y2hlY2s",
+    "$pbkdf2-sha256$1000$c2FsdA$c2hvcnQ", # checksum неверной длины
+])
+def test_verify_rejects_malformed_hash(bad_hash):
+    with pytest.raises(ValueError):
+        pbkdf2_sha256.verify("secret", bad_hash)
+
+def test_identify():
+    assert pbkdf2_sha256.identify(pbkdf2_sha256.hash("x", rounds=1000)) is True
+    assert pbkdf2_sha256.identify("password123") is False
+    assert pbkdf2_sha256.identify(None) is False
+
+async def test_async_hash_and_verify_use_pool():
+    """Асинхронные обертки выполняют KDF в пуле процессов и дают совместимый результат."""
+    try:
+        hashed = await kdf.hash_password("secret")
+        assert await kdf.verify_password("secret", hashed) is True
+        assert await kdf.verify_password("wrong", hashed) is False
+        assert passlib_pbkdf2_sha256.verify("secret", hashed) is True
+    finally:
+        kdf.shutdown_kdf_pool()
+
+async def test_kdf_gate_bounds_concurrent_calls(monkeypatch):
+    """Одновременно в пуле находится не больше KDF_MAX_CONCURRENCY задач, остальные ждут на семафоре."""
+    monkeypatch.setattr(kdf, "KDF_MAX_CONCURRENCY", 2)
+    monkeypatch.setattr(kdf, "_kdf_gates", kdf.weakref.WeakKeyDictionary())
+    active = peak = 0
+    lock = threading.Lock()
+
+    def slow_hash(password):
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        threading.Event().wait(0.02)
+        with lock:
+            active -= 1
+        return password
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        monkeypatch.setattr(kdf, "get_kdf_pool", lambda: pool)
+        monkeypatch.setattr(kdf, "_hash_password", slow_hash)
+        results = await asyncio.gather(*(kdf.hash_password(str(i)) for i in range(6)))
+
+    assert results == [str(i) for i in range(6)]
+    assert peak == 2
+
+def test_parse_hash_cached_parses_once():
+    """Повторная проверка того же хеша не разбирает строку заново."""
+    hashed = pbkdf2_sha256.hash("secret", rounds=1000)
+    kdf.parse_hash_cached.cache_clear()
+    assert pbkdf2_sha256.verify("secret", hashed) is True
+    assert pbkdf2_sha256.verify("wrong", hashed) is False
+    info = kdf.parse_hash_cached.cache_info()
+    assert info.misses == 1 and info.hits == 1
+
+def test_select_backend_prefers_faster_implementation():
+    """При наличии альтернативной реализации выбирается более быстрая по замеру."""
+    import hashlib
+    from unittest.mock import patch
+
+    def fake_fast(name, password, salt, rounds, dklen):
+        return b"\0" * dklen # "мгновенная" реализация
+
+    with patch.object(kdf, "_fast_pbkdf2_hmac", fake_fast):
+        func, backend = kdf._select_backend()
+    assert backend == "fastpbkdf2" and func is fake_fast
+
+    with patch.object(kdf, "_fast_pbkdf2_hmac", None):
+        func, backend = kdf._select_backend()
+    assert backend == "hashlib" and func is hashlib.pbkdf2_hmac
@@ -0,0 +1,40 @@
+import logging
+import logging.handlers
+from unittest.mock import patch
+
+from auth_server import logging_config
+
+
+def _fresh_root():
+    # Отдельный корневой логгер: настоящий во время теста содержит обработчики pytest.
+    # Подменяем getLogger только внутри теста, иначе pytest добавит свой обработчик в подмену.
+    root = logging.RootLogger(logging.WARNING)
+    return root, patch('auth_server.logging_config.logging.getLogger', return_value=root)
+
+
+def test_configure_logging_installs_queue_handler(capsys):
+    root, patched = _fresh_root()
+    try:
+        with patched:
+            listener = logging_config.configure_logging("debug")
+
+        assert isinstance(listener, logging.handlers.QueueListener)
+        assert len(root.handlers) == 1
+        assert isinstance(root.handlers[0], logging.handlers.QueueHandler)
+        assert root.level == logging.DEBUG
+
+        root.info("queued %s", "record")
+    finally:
+        logging_config.stop_logging() # Останавливает поток слушателя и дописывает очередь
+    assert "queued record" in capsys.readouterr().err
+
+
+def test_configure_logging_is_idempotent():
+    root, patched = _fresh_root()
+    try:
+        with patched:
+            assert logging_config.configure_logging() is not None
+            assert logging_config.configure_logging() is None
+        assert len(root.handlers) == 1
+    finally:
+        logging_config.stop_logging()
@@ -56,17 +56,17 @@ class TestRedisClient(unittest.IsolatedAsyncioTestCase):
         os.environ.pop('REDIS_HOST', None)
         os.environ.pop('REDIS_PORT', None)
         # Мокируем зависимости, чтобы избежать реальных соединений
-        with patch('core.redis_client.redis.ConnectionPool'), patch('core.redis_client.redis.Redis'):
+        with patch('core.redis_client.redis.BlockingConnectionPool'), patch('core.redis_client.redis.Redis'):
             client1 = RedisClient()
             client2 = RedisClient()
             self.assertIs(client1, client2, "RedisClient должен быть реализован как Singleton (возвращать тот же экземпляр).")
 
     @patch('core.redis_client.redis.Redis') # Мок для класса redis.Redis
-    @patch('core.redis_client.redis.ConnectionPool') # Мок для класса redis.ConnectionPool
-    async def test_initialization_default_values(self, MockConnectionPool, MockRedis):
+    @patch('core.redis_client.redis.BlockingConnectionPool') # Мок для класса redis.BlockingConnectionPool
+    async def test_initialization_default_values(self, MockBlockingConnectionPool, MockRedis):
         """
         Тест инициализации RedisClient со значениями по умолчанию.
-        Проверяет, что ConnectionPool и Redis вызываются с хостом "redis-service" и портом 6379,
+        Проверяет, что BlockingConnectionPool и Redis вызываются с хостом "redis-service" и портом 6379,
         когда переменные окружения не установлены.
         """
         RedisClient._instance = None
@@ -84,16 +84,18 @@ class TestRedisClient(unittest.IsolatedAsyncioTestCase):
         os.environ.pop('REDIS_HOST', None)
         os.environ.pop('REDIS_PORT', None)
             
-        mock_pool_instance = MockConnectionPool.return_value # Мок экземпляра ConnectionPool
+        mock_pool_instance = MockBlockingConnectionPool.return_value # Мок экземпляра BlockingConnectionPool
         mock_redis_instance = AsyncMock() # Мок для асинхронного клиента Redis
         MockRedis.return_value = mock_redis_instance # Настраиваем мок класса Redis, чтобы он возвращал наш мок-экземпляр
 
         client = RedisClient() # Инициализируем тестируемый клиент
 
-        # Проверяем, что ConnectionPool был вызван с параметрами по умолчанию
-        MockConnectionPool.assert_called_once_with(
+        # Проверяем, что BlockingConnectionPool был вызван с параметрами по умолчанию
+        MockBlockingConnectionPool.assert_called_once_with(
             host="redis-service", # Ожидаемый хост по умолчанию
             port=6379,            # Ожидаемый порт по умолчанию
+            max_connections=64,   # Размер пула по умолчанию
+            timeout=5.0,          # Ожидание свободного соединения вместо ошибки
             decode_responses=True # Ответы должны декодироваться
         )
         # Проверяем, что Redis был вызван с созданным пулом соединений
@@ -102,11 +104,11 @@ class TestRedisClient(unittest.IsolatedAsyncioTestCase):
         self.assertIs(client.client, mock_redis_instance)
 
     @patch('core.redis_client.redis.Redis')
-    @patch('core.redis_client.redis.ConnectionPool')
-    async def test_initialization_with_env_vars(self, MockConnectionPool, MockRedis):
+    @patch('core.redis_client.redis.BlockingConnectionPool')
+    async def test_initialization_with_env_vars(self, MockBlockingConnectionPool, MockRedis):
         """
         Тест инициализации RedisClient с использованием переменных окружения.
-        Проверяет, что ConnectionPool и Redis вызываются с хостом и портом,
+        Проверяет, что BlockingConnectionPool и Redis вызываются с хостом и портом,
         указанными в переменных окружения REDIS_HOST и REDIS_PORT.
         """
         RedisClient._instance = None
@@ -124,16 +126,18 @@ class TestRedisClient(unittest.IsolatedAsyncioTestCase):
         os.environ['REDIS_HOST'] = "my-custom-redis"
         os.environ['REDIS_PORT'] = "1234"
             
-        mock_pool_instance = MockConnectionPool.return_value
+        mock_pool_instance = MockBlockingConnectionPool.return_value
         mock_redis_instance = AsyncMock()
         MockRedis.return_value = mock_redis_instance
 
         client = RedisClient()
 
-        # Проверяем, что ConnectionPool был вызван со значениями из переменных окружения
-        MockConnectionPool.assert_called_once_with(
+        # Проверяем, что BlockingConnectionPool был вызван со значениями из переменных окружения
+        MockBlockingConnectionPool.assert_called_once_with(
             host="my-custom-redis", # Ожидаемый хост из переменной окружения
             port=1234,              # Ожидаемый порт из переменной окружения
+            max_connections=64,
+            timeout=5.0,
             decode_responses=True
         )
         MockRedis.assert_called_once_with(connection_pool=mock_pool_instance)
@@ -145,8 +149,8 @@ class TestRedisClient(unittest.IsolatedAsyncioTestCase):
         Проверяет, что внутренний метод `client.get` вызывается с правильным ключом
         и что результат возвращается корректно.
         """
-        # Мокируем ConnectionPool, чтобы RedisClient мог инициализироваться без реального соединения
-        with patch('core.redis_client.redis.ConnectionPool'):
+        # Мокируем BlockingConnectionPool, чтобы RedisClient мог инициализироваться без реального соединения
+        with patch('core.redis_client.redis.BlockingConnectionPool'):
             client = RedisClient()
         client.client = AsyncMock() # Мокируем сам клиент Redis (экземпляр redis.Redis)
         client.client.get.return_value = "test_value" # Настраиваем возвращаемое значение для get
@@ -162,7 +166,7 @@ class TestRedisClient(unittest.IsolatedAsyncioTestCase):
         Проверяет, что внутренний метод `client.set` вызывается с правильными аргументами
         (ключ, значение, время жизни) и что результат возвращается корректно.
         """
-        with patch('core.redis_client.redis.ConnectionPool'):
+        with patch('core.redis_client.redis.BlockingConnectionPool'):
             client = RedisClient()
         client.client = AsyncMock()
         client.client.set.return_value = True # Имитируем успешную установку
@@ -178,7 +182,7 @@ class TestRedisClient(unittest.IsolatedAsyncioTestCase):
         Проверяет, что внутренний метод `client.delete` вызывается с правильными ключами
         и что результат (количество удаленных ключей) возвращается корректно.
         """
-        with patch('core.redis_client.redis.ConnectionPool'):
+        with patch('core.redis_client.redis.BlockingConnectionPool'):
             client = RedisClient()
         client.client = AsyncMock()
         client.client.delete.return_value = 1 # Имитируем удаление одного ключа
@@ -193,7 +197,7 @@ class TestRedisClient(unittest.IsolatedAsyncioTestCase):
         Тест успешного выполнения команды `ping`.
         Проверяет, что внутренний метод `client.ping` вызывается и возвращает True.
         """
-        with patch('core.redis_client.redis.ConnectionPool'):
+        with patch('core.redis_client.redis.BlockingConnectionPool'):
             client = RedisClient()
         client.client = AsyncMock()
         client.client.ping.return_value = True # Имитируем успешный ping
@@ -209,7 +213,7 @@ class TestRedisClient(unittest.IsolatedAsyncioTestCase):
         Проверяет, что внутренний метод `client.ping` вызывается, обрабатывает исключение
         и возвращает False. Также проверяет, что ошибка логируется (через print в текущей реализации).
         """
-        with patch('core.redis_client.redis.ConnectionPool'):
+        with patch('core.redis_client.redis.BlockingConnectionPool'):
             client = RedisClient()
         client.client = AsyncMock()
         client.client.ping.side_effect = Exception("Connection error") # Имитируем ошибку соединения
@@ -1,332 +1,453 @@
 # tests/unit/test_tcp_handler_auth.py
 # Этот файл содержит модульные тесты для TCP-обработчика сервера аутентификации
-# (auth_server.tcp_handler.handle_auth_client).
+# (auth_server.tcp_handler.AuthProtocol).
 # Тесты проверяют различные сценарии взаимодействия клиента с сервером,
 # включая успешный и неудачный вход, а также обработку некорректных запросов.
 
 import asyncio
+import functools
 import json # Для работы с JSON-сообщениями
 import unittest
-from unittest.mock import AsyncMock, patch, call # Инструменты для мокирования
+from unittest.mock import AsyncMock, MagicMock, patch, call # Инструменты для мокирования
 
-# Импортируем тестируемую функцию
-from auth_server.tcp_handler import handle_auth_client
+# Импортируем тестируемые объекты
+from auth_server.tcp_handler import _frame, _BadRequestLimiter, MAX_AUTH_MESSAGE, _prepare_request, AuthProtocol
+from auth_server import tcp_handler
 # UserService будет мокироваться, поэтому его прямой импорт для использования не нужен.
 
+def _mock_transport(peer=('127.0.0.1', 12345)):
+    """Мок транспорта соединения с адресом клиента peer."""
+    transport = MagicMock(spec=asyncio.Transport)
+    transport.get_extra_info.return_value = peer
+    transport.is_closing.return_value = False
+    transport.can_write_eof.return_value = True
+    return transport
+
+def _feed(protocol, data):
+    """Передает байты протоколу так же, как цикл событий: через get_buffer()/buffer_updated()."""
+    data = memoryview(data)
+    while data:
+        buffer = protocol.get_buffer(-1)
+        size = min(len(buffer), len(data))
+        buffer[:size] = data[:size]
+        protocol.buffer_updated(size)
+        data = data[size:]
+
+def _response(transport):
+    """Разбирает единственный кадр ответа, записанный в транспорт."""
+    transport.write.assert_called_once()
+    frame = transport.write.call_args[0][0]
+    assert frame.endswith(b"\n"), "Ответ сервера должен заканчиваться новой строкой."
+    return json.loads(frame)
+
 class TestAuthTcpHandler(unittest.IsolatedAsyncioTestCase):
     """
     Набор тестов для TCP-обработчика сервера аутентификации.
-    Использует `unittest.IsolatedAsyncioTestCase` для асинхронных тестов.
+    AuthProtocol получает данные от мок-транспорта так же, как от цикла событий.
     """
 
-    @patch('auth_server.tcp_handler.user_service') # Мокируем экземпляр user_service
-    async def test_successful_login(self, mock_user_service_instance):
+    def setUp(self):
+        # Экземпляр UserService передается протоколу явно (functools.partial в main())
+        self.user_service = MagicMock()
+        # Свой лимитер некорректных запросов на каждый тест, чтобы тесты не влияли друг на друга
+        limiter_patcher = patch('auth_server.tcp_handler._bad_requests', _BadRequestLimiter())
+        self.bad_requests = limiter_patcher.start()
+        self.addCleanup(limiter_patcher.stop)
+
+    async def _serve(self, data, peer=('127.0.0.1', 12345)):
+        """
+        Проводит одно соединение: подключение, строка запроса data, ответ и закрытие.
+
+        Returns:
+            MagicMock: Транспорт соединения (ответ - аргумент transport.write).
+        """
+        transport = _mock_transport(peer)
+        protocol = AuthProtocol(self.user_service)
+        protocol.connection_made(transport)
+        if protocol.log is None: # Соединение отклонено в connection_made
+            return transport
+        _feed(protocol, data)
+        if protocol._task is not None:
+            await protocol._task
+        protocol.connection_lost(None)
+        return transport
+
+    async def _request(self, request, **kwargs):
+        """Отправляет запрос-словарь строкой JSON и возвращает транспорт."""
+        return await self._serve((json.dumps(request) + '\n').encode('utf-8'), **kwargs)
+
+    async def test_successful_login(self):
         """
         Тест успешного входа пользователя.
         Проверяет, что при корректных учетных данных сервер возвращает
         сообщение об успехе и соответствующий токен/сообщение сессии.
         """
-        # mock_user_service_instance теперь напрямую является моком экземпляра user_service
-        # Конфигурируем метод authenticate_user как AsyncMock
-        mock_user_service_instance.authenticate_user = AsyncMock(return_value=(True, "Пользователь player1 успешно аутентифицирован.")) # Ожидаем русский текст
+        self.user_service.authenticate_user = AsyncMock(return_value=(True, "Пользователь player1 успешно аутентифицирован.")) # Ожидаем русский текст
 
-        reader = AsyncMock(spec=asyncio.StreamReader)
-        writer = AsyncMock(spec=asyncio.StreamWriter)
-        writer.is_closing.return_value = False
-        
-        login_request = {"action": "login", "username": "player1", "password": "password123"}
-        reader.readuntil.return_value = (json.dumps(login_request) + '\n').encode('utf-8')
+        transport = await self._request({"action": "login", "username": "player1", "password": "password123"})
 
-        await handle_auth_client(reader, writer)
-
-        mock_user_service_instance.authenticate_user.assert_called_once_with("player1", "password123")
-        
+        self.user_service.authenticate_user.assert_called_once_with("player1", "password123")
         expected_response = {"status": "success", "message": "Пользователь player1 успешно аутентифицирован.", "token": "player1"} # Ожидаем русский текст
-        
-        self.assertTrue(writer.write.called, "Метод writer.write не был вызван.")
-        actual_call_args_bytes = writer.write.call_args[0][0]
-        
-        self.assertEqual(json.loads(actual_call_args_bytes.decode('utf-8').strip()), expected_response, "Ответ сервера не соответствует ожидаемому.")
-        self.assertTrue(actual_call_args_bytes.endswith(b'\n'), "Ответ сервера должен заканчиваться новой строкой.")
-        writer.drain.assert_called_once()
-        writer.close.assert_called_once()
-        writer.wait_closed.assert_called_once()
-
-    @patch('auth_server.tcp_handler.user_service')
-    async def test_failed_login_wrong_password(self, mock_user_service_instance):
+        self.assertEqual(_response(transport), expected_response, "Ответ сервера не соответствует ожидаемому.")
+        transport.close.assert_called_once()
+
+    async def test_failed_login_wrong_password(self):
         """
         Тест неудачного входа пользователя из-за неверного пароля.
         Проверяет, что сервер возвращает сообщение о неудаче.
         """
-        mock_user_service_instance.authenticate_user = AsyncMock(return_value=(False, "Неверный пароль.")) # Ожидаем русский текст
-
-        reader = AsyncMock(spec=asyncio.StreamReader)
-        writer = AsyncMock(spec=asyncio.StreamWriter)
-        writer.is_closing.return_value = False
-
-        login_request = {"action": "login", "username": "player1", "password": "wrongpassword"}
-        reader.readuntil.return_value = (json.dumps(login_request) + '\n').encode('utf-8')
+        self.user_service.authenticate_user = AsyncMock(return_value=(False, "Неверный пароль.")) # Ожидаем русский текст
 
-        await handle_auth_client(reader, writer)
+        transport = await self._request({"action": "login", "username": "player1", "password": "wrongpassword"})
 
-        mock_user_service_instance.authenticate_user.assert_called_once_with("player1", "wrongpassword")
-        expected_response = {"status": "failure", "message": "Неверный пароль."} # Ожидаем русский текст
-        
-        actual_call_args_bytes = writer.write.call_args[0][0]
-        self.assertEqual(json.loads(actual_call_args_bytes.decode('utf-8').strip()), expected_response)
-        self.assertTrue(actual_call_args_bytes.endswith(b'\n'))
-        writer.drain.assert_called_once()
-        writer.close.assert_called_once()
-        writer.wait_closed.assert_called_once()
+        self.user_service.authenticate_user.assert_called_once_with("player1", "wrongpassword")
+        self.assertEqual(_response(transport), {"status": "failure", "message": "Неверный пароль."})
+        transport.close.assert_called_once()
 
-    @patch('auth_server.tcp_handler.user_service')
-    async def test_successful_registration(self, mock_user_service_instance):
+    async def test_successful_registration(self):
         """Тест успешной регистрации нового пользователя."""
-        mock_user_service_instance.create_user = AsyncMock(return_value=(True, "Пользователь newuser успешно зарегистрирован.")) # Ожидаем русский текст
+        self.user_service.create_user = AsyncMock(return_value=(True, "Пользователь newuser успешно зарегистрирован.")) # Ожидаем русский текст
 
-        reader = AsyncMock(spec=asyncio.StreamReader)
-        writer = AsyncMock(spec=asyncio.StreamWriter)
-        writer.is_closing.return_value = False
+        transport = await self._request({"action": "register", "username": "newuser", "password": "newpassword"})
 
-        register_request = {"action": "register", "username": "newuser", "password": "newpassword"}
-        reader.readuntil.return_value = (json.dumps(register_request) + '\n').encode('utf-8')
+        self.user_service.create_user.assert_called_once_with("newuser", "newpassword")
+        self.assertEqual(_response(transport), {"status": "success", "message": "Пользователь newuser успешно зарегистрирован."})
+        transport.close.assert_called_once()
 
-        await handle_auth_client(reader, writer)
-
-        mock_user_service_instance.create_user.assert_called_once_with("newuser", "newpassword")
-        expected_response = {"status": "success", "message": "Пользователь newuser успешно зарегистрирован."} # Ожидаем русский текст
-
-        actual_call_args_bytes = writer.write.call_args[0][0]
-        self.assertEqual(json.loads(actual_call_args_bytes.decode('utf-8').strip()), expected_response)
-        self.assertTrue(actual_call_args_bytes.endswith(b'\n'))
-        writer.drain.assert_called_once()
-        writer.close.assert_called_once()
-        writer.wait_closed.assert_called_once()
-
-    @patch('auth_server.tcp_handler.user_service')
-    async def test_registration_user_already_exists(self, mock_user_service_instance):
+    async def test_registration_user_already_exists(self):
         """Тест регистрации пользователя, который уже существует."""
-        mock_user_service_instance.create_user = AsyncMock(return_value=(False, "Пользователь с таким именем уже существует.")) # Ожидаем русский текст
-
-        reader = AsyncMock(spec=asyncio.StreamReader)
-        writer = AsyncMock(spec=asyncio.StreamWriter)
-        writer.is_closing.return_value = False
+        self.user_service.create_user = AsyncMock(return_value=(False, "Пользователь с таким именем уже существует.")) # Ожидаем русский текст
 
-        register_request = {"action": "register", "username": "existinguser", "password": "password123"}
-        reader.readuntil.return_value = (json.dumps(register_request) + '\n').encode('utf-8')
+        transport = await self._request({"action": "register", "username": "existinguser", "password": "password123"})
 
-        await handle_auth_client(reader, writer)
+        self.user_service.create_user.assert_called_once_with("existinguser", "password123")
+        self.assertEqual(_response(transport), {"status": "failure", "message": "Пользователь с таким именем уже существует."})
+        transport.close.assert_called_once()
 
-        mock_user_service_instance.create_user.assert_called_once_with("existinguser", "password123")
-        expected_response = {"status": "failure", "message": "Пользователь с таким именем уже существует."} # Ожидаем русский текст
-
-        actual_call_args_bytes = writer.write.call_args[0][0]
-        self.assertEqual(json.loads(actual_call_args_bytes.decode('utf-8').strip()), expected_response)
-        self.assertTrue(actual_call_args_bytes.endswith(b'\n'))
-        writer.drain.assert_called_once()
-        writer.close.assert_called_once()
-        writer.wait_closed.assert_called_once()
-
-    @patch('auth_server.tcp_handler.user_service')
-    async def test_registration_missing_fields(self, mock_user_service_instance):
+    async def test_registration_missing_fields(self):
         """Тест регистрации пользователя с отсутствующими полями (например, без пароля)."""
-        reader = AsyncMock(spec=asyncio.StreamReader)
-        writer = AsyncMock(spec=asyncio.StreamWriter)
-        writer.is_closing.return_value = False
-
         # Запрос без поля "password"
-        register_request = {"action": "register", "username": "user_no_pass"}
-        reader.readuntil.return_value = (json.dumps(register_request) + '\n').encode('utf-8')
-
-        await handle_auth_client(reader, writer)
+        transport = await self._request({"action": "register", "username": "user_no_pass"})
 
         # create_user не должен быть вызван
-        mock_user_service_instance.create_user.assert_not_called()
-
+        self.user_service.create_user.assert_not_called()
         # Ожидаем ответ об ошибке из-за отсутствия полей
-        expected_response = {"status": "error", "message": "Отсутствует имя пользователя или пароль для регистрации."} # Сообщение из tcp_handler.py
-
-        actual_call_args_bytes = writer.write.call_args[0][0]
-        self.assertEqual(json.loads(actual_call_args_bytes.decode('utf-8').strip()), expected_response)
-        self.assertTrue(actual_call_args_bytes.endswith(b'\n'))
-        writer.drain.assert_called_once()
-        writer.close.assert_called_once()
-        writer.wait_closed.assert_called_once()
+        self.assertEqual(_response(transport), {"status": "error", "message": "Отсутствует имя пользователя или пароль для регистрации."})
+        transport.close.assert_called_once()
 
-    # --- Существующие тесты для других сценариев ---
-    # Они не требуют мокирования user_service, так как не доходят до вызова его методов
+    # --- Сценарии, которые не доходят до вызова методов user_service ---
     async def test_invalid_json_format(self):
         """
         Тест обработки запроса с невалидным форматом JSON.
         Проверяет, что сервер возвращает ошибку о неверном формате JSON.
         """
-        reader = AsyncMock(spec=asyncio.StreamReader)
-        writer = AsyncMock(spec=asyncio.StreamWriter)
-        writer.is_closing.return_value = False
-
-        malformed_json_request = b'{"action": "login, "username": "player1"}\n'
-        reader.readuntil.return_value = malformed_json_request
-
-        await handle_auth_client(reader, writer)
+        transport = await self._serve(b'{"action": "login, "username": "player1"}\n')
 
-        expected_response = {"status": "error", "message": "Неверный формат JSON"} # Сообщение из tcp_handler.py
-        actual_call_args_bytes = writer.write.call_args[0][0]
-        self.assertEqual(json.loads(actual_call_args_bytes.decode('utf-8').strip()), expected_response)
-        self.assertTrue(actual_call_args_bytes.endswith(b'\n'))
-        writer.drain.assert_called_once()
-        writer.close.assert_called_once()
-        writer.wait_closed.assert_called_once()
+        self.assertEqual(_response(transport), {"status": "error", "message": "Неверный формат JSON"})
+        transport.close.assert_called_once()
 
     async def test_unicode_decode_error(self):
         """
         Тест обработки запроса с ошибкой декодирования Unicode (не UTF-8).
         Проверяет, что сервер возвращает ошибку о неверной кодировке.
         """
-        reader = AsyncMock(spec=asyncio.StreamReader)
-        writer = AsyncMock(spec=asyncio.StreamWriter)
-        writer.is_closing.return_value = False
+        transport = await self._serve(b'\xff\xfe\xfd{"action": "login"}\n')
 
-        invalid_utf8_request = b'\xff\xfe\xfd{"action": "login"}\n'
-        reader.readuntil.return_value = invalid_utf8_request
+        self.assertEqual(_response(transport), {"status": "error", "message": "Неверная кодировка символов. Ожидается UTF-8."})
+        transport.close.assert_called_once()
 
-        await handle_auth_client(reader, writer)
-
-        expected_response = {"status": "error", "message": "Неверная кодировка символов. Ожидается UTF-8."} # Сообщение из tcp_handler.py
-        actual_call_args_bytes = writer.write.call_args[0][0]
-        self.assertEqual(json.loads(actual_call_args_bytes.decode('utf-8').strip()), expected_response)
-        self.assertTrue(actual_call_args_bytes.endswith(b'\n'))
-        writer.drain.assert_called_once()
-        writer.close.assert_called_once()
-        writer.wait_closed.assert_called_once()
-
-    @patch('auth_server.tcp_handler.user_service') # Мокируем экземпляр user_service
-    async def test_unknown_action(self, mock_user_service_instance):
+    async def test_unknown_action(self):
         """
         Тест обработки запроса с неизвестным действием (action).
         Проверяет, что сервер возвращает ошибку о неизвестном действии.
         """
-        reader = AsyncMock(spec=asyncio.StreamReader)
-        writer = AsyncMock(spec=asyncio.StreamWriter)
-        writer.is_closing.return_value = False
-
-        unknown_action_request = {"action": "unknown_action", "username": "player1"}
-        reader.readuntil.return_value = (json.dumps(unknown_action_request) + '\n').encode('utf-8')
-
-        await handle_auth_client(reader, writer)
-        
-        mock_user_service_instance.authenticate_user.assert_not_called()
-        mock_user_service_instance.create_user.assert_not_called()
-        expected_response = {"status": "error", "message": "Неизвестное или отсутствующее действие"} # Сообщение из tcp_handler.py
-        actual_call_args_bytes = writer.write.call_args[0][0]
-        self.assertEqual(json.loads(actual_call_args_bytes.decode('utf-8').strip()), expected_response)
-        self.assertTrue(actual_call_args_bytes.endswith(b'\n'))
-        writer.drain.assert_called_once()
-        writer.close.assert_called_once()
-        writer.wait_closed.assert_called_once()
-
-    @patch('auth_server.tcp_handler.logger')
-    # @patch('auth_server.tcp_handler.config') # Удалено
-    # @patch('auth_server.tcp_handler.UserService') # Удалено
-    # @patch('auth_server.tcp_handler.KafkaProducerClient') # Удалено, так как не импортируется напрямую в tcp_handler
+        transport = await self._request({"action": "unknown_action", "username": "player1"})
+
+        self.user_service.authenticate_user.assert_not_called()
+        self.user_service.create_user.assert_not_called()
+        self.assertEqual(_response(transport), {"status": "error", "message": "Неизвестное или отсутствующее действие"})
+        transport.close.assert_called_once()
+
     @patch('auth_server.tcp_handler.ACTIVE_CONNECTIONS_AUTH')
-    # @patch('auth_server.tcp_handler.TOTAL_AUTH_REQUESTS') # Удалено, так как метрика отсутствует
     @patch('auth_server.tcp_handler.SUCCESSFUL_AUTHS')
     @patch('auth_server.tcp_handler.FAILED_AUTHS')
     async def test_empty_message_just_newline(
             self,
             MockFailedAuths,
             MockSuccessfulAuths,
-            # MockTotalAuthRequests, # Удалено из аргументов
             MockActiveConnections,
-            # MockKafkaClient, # Удалено из аргументов
-            # MockUserService, # Удалено из аргументов
-            # mock_config, # Удалено из аргументов
-            mock_logger
     ):
         '''Тестирует обработку пустого сообщения (только символ новой строки).'''
-        # Мокируем конфиг, если он используется для определения формата ответа - Удалено
-        # mock_config.AUTH_SERVER_HOST = 'localhost'
-        # mock_config.AUTH_SERVER_PORT = 8888
-
-        # Мокируем сервисы, если они вызываются (маловероятно для пустого сообщения) - Удалено
-        # mock_user_service_instance = MockUserService.return_value 
-        # mock_kafka_producer_instance = MockKafkaClient.return_value
-
-        mock_reader = AsyncMock(spec=asyncio.StreamReader)
-        mock_writer = AsyncMock(spec=asyncio.StreamWriter)
-        mock_writer.get_extra_info.return_value = ('127.0.0.1', 12345)
-        mock_writer.is_closing.return_value = False # Явно устанавливаем для проверки в finally
-
-        # Симулируем получение пустого сообщения, затем ошибку для выхода из цикла
-        mock_reader.readuntil.side_effect = [
-            b'\n',
-            asyncio.IncompleteReadError(b'', 0)
-        ]
-        
-        await handle_auth_client(mock_reader, mock_writer)
-
-        expected_response_json = {
-            "status": "error",
-            "message": "Получено пустое сообщение" # Сообщение из tcp_handler.py
-        }
-        expected_response_bytes = json.dumps(expected_response_json).encode('utf-8') + b'\n'
-
-        # Проверяем, что writer.write был вызван с правильным сообщением
-        # Используем any_call, если могут быть другие write (например, логи)
-        mock_writer.write.assert_any_call(expected_response_bytes)
-        
-        # Проверяем, что соединение было закрыто
-        mock_writer.close.assert_called_once()
-        mock_writer.wait_closed.assert_called_once() # Убедимся, что и wait_closed проверяется
-
-        # Проверка вызова логгера
-        # Сообщение в логгере также должно быть на английском, если оно генерируется в tcp_handler
-        # На основе предыдущего вывода, логгер использует английский:
-        # "Empty message or only newline character received from ..."
-        # Handler log is "Empty message received."
-        # Обновлено на основе фактического сообщения об ошибке из вывода теста:
-        mock_logger.warning.assert_any_call("handle_auth_client: [('127.0.0.1', 12345)] Empty message after strip from raw: b'\\n'.")
-        # Удалена проверка logger.error, так как она не вызывается в этом сценарии
-        # mock_logger.error.assert_any_call("Ошибка обработки запроса от %s:%s: %s", 
-        #                                   '127.0.0.1', 12345, "Получено пустое сообщение или только символ новой строки")
+        with self.assertLogs('auth_server.tcp_handler', level='WARNING') as captured_logs:
+            transport = await self._serve(b'\n')
+
+        self.assertEqual(_response(transport), {"status": "error", "message": "Получено пустое сообщение"})
+        transport.close.assert_called_once()
+
+        # Предупреждение содержит адрес клиента (LoggerAdapter) и сырые данные
+        self.assertIn(
+            "WARNING:auth_server.tcp_handler:[('127.0.0.1', 12345)] Пустое сообщение после обработки из сырых данных: b'\\n'.",
+            captured_logs.output,
+        )
 
         # Проверка метрик
         MockActiveConnections.inc.assert_called_once() # Проверяем инкремент счетчика активных соединений
-        # MockTotalAuthRequests.inc.assert_called_once() # Удалено, так как метрика отсутствует
-        # MockFailedAuths.inc.assert_called_once() # Удалено, так как FAILED_AUTHS.inc() не вызывается для пустого сообщения
         MockSuccessfulAuths.inc.assert_not_called() # Успешной аутентификации не было
         MockActiveConnections.dec.assert_called_once() # Проверяем декремент счетчика активных соединений
 
-        # Убедимся, что основные сервисные методы не вызывались - Удалено, так как моки удалены
-        # MockUserService.return_value.register_user.assert_not_called()
-        # MockUserService.return_value.login_user.assert_not_called()
-        # MockKafkaClient был удален, поэтому и проверка его вызова удалена
-
     async def test_no_data_from_client(self):
         """
-        Тест ситуации, когда клиент не отправляет данные (соединение закрывается или EOF).
-        Проверяет, что сервер не отправляет ответ и корректно закрывает соединение.
+        Тест ситуации, когда клиент закрывает соединение, не отправив строку запроса.
+        Проверяет, что сервер не отправляет ответ и закрывает соединение.
+        """
+        transport = _mock_transport()
+        protocol = AuthProtocol(self.user_service)
+        protocol.connection_made(transport)
+        _feed(protocol, b'{"act')
+
+        self.assertFalse(protocol.eof_received()) # False - транспорт закрывается сам
+        protocol.connection_lost(None)
+
+        transport.write.assert_not_called()
+        self.assertEqual(tcp_handler._open_connections, 0)
+
+    def test_failure_frame_is_reused(self):
+        """Кадры неудачи по одной причине собираются один раз и совпадают с обычной сериализацией."""
+        frame = tcp_handler._failure_frame("Неверный пароль.")
+        self.assertIs(tcp_handler._failure_frame("Неверный пароль."), frame)
+        self.assertEqual(frame, _frame({"status": "failure", "message": "Неверный пароль."}))
+
+    def test_frame_is_compact_utf8_json_line(self):
+        """Кадр ответа одинаков для orjson и json: компактный JSON в UTF-8 с переводом строки."""
+        frame = _frame({"status": "error", "message": "Таймаут запроса"})
+        self.assertEqual(frame, '{"status":"error","message":"Таймаут запроса"}\n'.encode('utf-8'))
+
+    async def test_peer_over_bad_request_limit_is_aborted(self):
+        """После BAD_REQUEST_BURST некорректных запросов соединения клиента сбрасываются без ответа."""
+        for _ in range(self.bad_requests.burst):
+            transport = await self._serve(b'not json\n', peer=('10.0.0.1', 40000))
+            transport.write.assert_called_once() # Пока лимит не превышен, клиент получает ответ об ошибке
+
+        transport = await self._serve(b'not json\n', peer=('10.0.0.1', 40001)) # Другой порт того же клиента
+
+        transport.abort.assert_called_once()
+        transport.write.assert_not_called()
+
+    async def test_invalid_credentials_rejected_before_service(self):
+        """Нестроковые или слишком длинные учетные данные не доходят до UserService."""
+        self.user_service.authenticate_user = AsyncMock(return_value=(True, "ok"))
+        self.user_service.create_user = AsyncMock(return_value=(True, "ok"))
+        cases = [
+            ({"action": "login", "username": "u" * 65, "password": "x"}, "failure"),
+            ({"action": "login", "username": "player1", "password": 12345}, "failure"),
+            ({"action": "register", "username": ["player1"], "password": "x"}, "error"),
+            ({"action": "register", "username": "player1", "password": "x" * 257}, "error"),
+        ]
+        for request, status in cases:
+            with self.subTest(request=request):
+                transport = await self._request(request)
+                self.assertEqual(_response(transport)["status"], status)
+        self.user_service.authenticate_user.assert_not_called()
+        self.user_service.create_user.assert_not_called()
+
+    async def test_connection_over_limit_gets_busy_error(self):
+        """Сверх MAX_CONNECTIONS соединение сразу получает ошибку перегрузки; место освобождается после обработки."""
+        transport = _mock_transport()
+        protocol = AuthProtocol(self.user_service)
+        with patch('auth_server.tcp_handler.MAX_CONNECTIONS', 1), \
+                patch('auth_server.tcp_handler._open_connections', 1):
+            protocol.connection_made(transport)
+        self.assertEqual(_response(transport), {"status": "error", "message": "Сервер перегружен, повторите попытку позже"})
+        # Ответ и FIN; запрос клиента читается и отбрасывается до его EOF, без закрытия с RST
+        transport.write_eof.assert_called_once()
+        transport.close.assert_not_called()
+        _feed(protocol, b'{"action": "login"}\n')
+        self.assertFalse(protocol.eof_received())
+        protocol.connection_lost(None)
+        self.user_service.authenticate_user.assert_not_called()
+
+        with patch('auth_server.tcp_handler.MAX_CONNECTIONS', 1), \
+                patch('auth_server.tcp_handler._open_connections', 0):
+            await self._serve(b'\n')
+            self.assertEqual(tcp_handler._open_connections, 0)
+
+    async def test_cancelled_action_closes_connection(self):
+        """Отмена задачи действия (остановка сервера) закрывает соединение без ответа."""
+        async def never_done(*args):
+            await asyncio.Event().wait()
+        self.user_service.authenticate_user = AsyncMock(side_effect=never_done)
+        transport = _mock_transport()
+        protocol = AuthProtocol(self.user_service)
+        protocol.connection_made(transport)
+        _feed(protocol, b'{"action": "login", "username": "player1", "password": "x"}\n')
+        await asyncio.sleep(0)
+
+        protocol._task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await protocol._task
+        protocol.connection_lost(None)
+
+        transport.write.assert_not_called()
+        transport.close.assert_called_once()
+
+    async def test_reply_after_connection_lost_is_dropped(self):
+        """Ответ действия, завершившегося после разрыва соединения, не пишется в закрытый транспорт."""
+        self.user_service.authenticate_user = AsyncMock(return_value=(True, "ok"))
+        transport = _mock_transport()
+        protocol = AuthProtocol(self.user_service)
+        protocol.connection_made(transport)
+        _feed(protocol, b'{"action": "login", "username": "player1", "password": "x"}\n')
+
+        protocol.connection_lost(ConnectionResetError())
+        await protocol._task
+
+        transport.write.assert_not_called()
+        transport.close.assert_not_called()
+        transport.is_closing.assert_not_called()
+
+    def test_prepare_request_without_transport(self):
+        """Разбор запроса не зависит от транспорта: отказ - готовый кадр, иначе - действие и учетные данные."""
+        log = MagicMock()
+
+        handler, username, password = _prepare_request(
+            b'{"action": "login", "username": "player1", "password": "x"}\n', log, "127.0.0.1")
+
+        self.assertIs(handler, tcp_handler._ACTIONS["login"])
+        self.assertEqual((username, password), ("player1", "x"))
+        self.assertEqual(_prepare_request(b'\n', log, "127.0.0.1"),
+                         _frame({"status": "error", "message": "Получено пустое сообщение"}))
+
+    async def test_fast_reject_before_json_parsing(self):
+        """Не-объекты и запросы без "action" отклоняются без вызова парсера JSON."""
+        cases = [
+            (b'["login", "player1"]\n', "Неверный формат JSON"),
+            (b'{"action": "login", "username": "play\n', "Неверный формат JSON"),
+            (b'{"username": "player1", "password": "x"}\n', "Неизвестное или отсутствующее действие"),
+        ]
+        for request, message in cases:
+            with self.subTest(request=request), patch('auth_server.tcp_handler._loads') as mock_loads:
+                transport = await self._serve(request)
+
+                mock_loads.assert_not_called()
+                self.assertEqual(_response(transport), {"status": "error", "message": message})
+
+class TestBadRequestLimiter(unittest.TestCase):
+    """Тесты "протекающего ведра" некорректных запросов."""
+
+    def test_bucket_fills_and_leaks(self):
+        now = [0.0]
+        limiter = _BadRequestLimiter(burst=3, window=3.0, timer=lambda: now[0])
+        for _ in range(3):
+            self.assertFalse(limiter.is_blocked("peer"))
+            limiter.record("peer")
+        self.assertTrue(limiter.is_blocked("peer"))
+        self.assertFalse(limiter.is_blocked("other")) # Ведра разных клиентов независимы
+
+        now[0] = 1.0 # За секунду вытекает burst/window = 1 запрос
+        self.assertFalse(limiter.is_blocked("peer"))
+        limiter.record("peer")
+        self.assertTrue(limiter.is_blocked("peer"))
+
+    def test_zero_burst_disables_limit(self):
+        limiter = _BadRequestLimiter(burst=0, window=1.0)
+        limiter.record("peer")
+        self.assertFalse(limiter.is_blocked("peer"))
+
+    def test_zero_window_disables_limit(self):
+        limiter = _BadRequestLimiter(burst=1, window=0)
+        limiter.record("peer")
+        limiter.record("peer")
+        self.assertFalse(limiter.is_blocked("peer"))
+
+class TestAuthProtocol(unittest.IsolatedAsyncioTestCase):
+    """Тесты AuthProtocol через настоящий TCP-сервер на loopback."""
+
+    async def asyncSetUp(self):
+        self.user_service = MagicMock()
+        limiter_patcher = patch('auth_server.tcp_handler._bad_requests', _BadRequestLimiter())
+        limiter_patcher.start()
+        self.addCleanup(limiter_patcher.stop)
+        self.server = await asyncio.get_running_loop().create_server(
+            functools.partial(AuthProtocol, self.user_service), '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _request(self, data, eof=False):
+        """Отправляет сырые байты и возвращает все, что сервер ответил до закрытия соединения."""
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        writer.write(data)
+        if eof:
+            writer.write_eof()
+        response = await asyncio.wait_for(reader.read(), timeout=5)
+        writer.close()
+        return response
+
+    async def test_login_request_in_several_segments(self):
+        """Строка запроса, пришедшая частями, собирается в буфере и обрабатывается один раз."""
+        self.user_service.authenticate_user = AsyncMock(return_value=(True, "ok"))
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        for chunk in (b'{"action": "login", ', b'"username": "player1", ', b'"password": "password123"}\n'):
+            writer.write(chunk)
+            await writer.drain()
+            await asyncio.sleep(0.01)
+        response = await asyncio.wait_for(reader.read(), timeout=5)
+        writer.close()
+
+        self.user_service.authenticate_user.assert_awaited_once_with("player1", "password123")
+        self.assertEqual(json.loads(response), {"status": "success", "message": "ok", "token": "player1"})
+
+    async def test_response_sent_after_client_half_close(self):
+        """Клиент может закрыть свою сторону сразу после запроса - ответ все равно доставляется."""
+        self.user_service.authenticate_user = AsyncMock(return_value=(False, "Неверный пароль."))
+        response = await self._request(b'{"action": "login", "username": "player1", "password": "x"}\n', eof=True)
+        self.assertEqual(json.loads(response), {"status": "failure", "message": "Неверный пароль."})
+
+    async def test_oversized_request_is_rejected(self):
+        """Запрос, не поместившийся в буфер MAX_AUTH_MESSAGE, отклоняется без вызова сервиса."""
+        response = await self._request(b'{"action": "login", "username": "' + b"a" * MAX_AUTH_MESSAGE + b'"}\n')
+        self.user_service.authenticate_user.assert_not_called()
+        self.assertEqual(json.loads(response), {"status": "error", "message": "Слишком длинный запрос"})
+
+    async def test_read_timeout(self):
+        """Без строки запроса за CLIENT_READ_TIMEOUT клиент получает ошибку таймаута."""
+        with patch('auth_server.tcp_handler.CLIENT_READ_TIMEOUT', 0.05):
+            response = await self._request(b'{"action"')
+        self.assertEqual(json.loads(response), {"status": "error", "message": "Таймаут запроса"})
+
+    async def test_connection_over_limit_receives_busy_error(self):
+        """
+        Клиент сверх MAX_CONNECTIONS, успевший отправить запрос, получает ошибку перегрузки:
+        сервер не закрывает сокет с непрочитанным вводом (RST), а ждет EOF клиента.
         """
-        reader = AsyncMock(spec=asyncio.StreamReader)
-        writer = AsyncMock(spec=asyncio.StreamWriter)
-        writer.is_closing.return_value = False
-        
-        reader.readuntil.return_value = b'' # Имитируем закрытие соединения или отсутствие данных перед EOF
-
-        await handle_auth_client(reader, writer)
-
-        # Ожидаем, что будет отправлено сообщение об ошибке
-        expected_response_json = {
-            "status": "error",
-            "message": "Получено пустое сообщение" # Сообщение из tcp_handler.py
-        }
-        expected_response_bytes = json.dumps(expected_response_json).encode('utf-8') + b'\n'
-        
-        writer.write.assert_called_once_with(expected_response_bytes)
-        writer.drain.assert_called_once() # Добавлена проверка drain
-        # Соединение должно быть корректно закрыто
-        writer.close.assert_called_once()
-        writer.wait_closed.assert_called_once()
+        payload = b'{"action": "login", "username": "player1", "password": "' + b"x" * 200 + b'"}\n'
+        with patch('auth_server.tcp_handler.MAX_CONNECTIONS', 1), \
+                patch('auth_server.tcp_handler._open_connections', 1):
+            for _ in range(5):
+                response = await self._request(payload * 50, eof=True)
+                self.assertEqual(json.loads(response), {"status": "error", "message": "Сервер перегружен, повторите попытку позже"})
+            # Клиент, не закрывший свою сторону, отключается по истечении REJECT_LINGER
+            with patch('auth_server.tcp_handler.REJECT_LINGER', 0.05):
+                response = await self._request(payload)
+            self.assertEqual(json.loads(response), {"status": "error", "message": "Сервер перегружен, повторите попытку позже"})
+        self.user_service.authenticate_user.assert_not_called()
+
+    async def test_rejected_request_answered_without_task(self):
+        """Отказ, определенный при разборе, отправляется прямо из buffer_updated, без задачи."""
+        with patch('auth_server.tcp_handler.asyncio.ensure_future') as ensure_future:
+            response = await self._request(b'{"action": "dance"}\n')
+        ensure_future.assert_not_called()
+        self.assertEqual(json.loads(response), {"status": "error", "message": "Неизвестное или отсутствующее действие"})
+
+    async def test_non_string_action_is_unknown(self):
+        """Список или объект в поле action - неизвестное действие, а не ошибка протокола."""
+        for payload in (b'{"action": ["x"], "username": "a", "password": "b"}\n', b'{"action": {"a": 1}}\n'):
+            with self.subTest(payload=payload):
+                response = await self._request(payload)
+                self.assertEqual(json.loads(response), {"status": "error", "message": "Неизвестное или отсутствующее действие"})
+        self.user_service.authenticate_user.assert_not_called()
 
 if __name__ == '__main__':
     # Запуск тестов, если файл выполняется напрямую